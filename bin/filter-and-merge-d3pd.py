@@ -8,11 +8,29 @@ import os
 import sys
 import getopt
 import atexit
+import bisect
+import collections
+import threading
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 # 3rd party imports
 import ROOT
 import PyCintex; PyCintex.Cintex.Enable()
 
+# optional imports (only needed for the --batch mode)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import root_numpy
+except ImportError:
+    root_numpy = None
+
 # root globals to prevent ROOT garbage collector to sweep the rug....
 _root_files = []
 _root_trees = []
@@ -56,6 +74,124 @@ class LBRange(object):
         self.lbmin = lbmin
         self.lbmax = lbmax
 
+class GoodRunsList(object):
+    """a compiled good-runs-list.
+    for each run, the lumi-block ranges are sorted and merged into disjoint
+    intervals, which are then queried with bisect.
+    as events are (mostly) run-ordered, the intervals of the last queried run
+    and the last matching interval are cached.
+    """
+    def __init__(self, lbranges=()):
+        object.__init__(self)
+        self._runs = {} # run -> (sorted lbmins, lbmaxs)
+        self._reset_cache()
+        self.extend(lbranges)
+
+    def _reset_cache(self):
+        self._last_run = None
+        self._last_ranges = None
+        self._last_lbmin = 1
+        self._last_lbmax = 0
+
+    def extend(self, lbranges):
+        """add a sequence of LBRange to the good-runs-list"""
+        from collections import defaultdict
+        ranges = defaultdict(list)
+        for run, (lbmins, lbmaxs) in self._runs.iteritems():
+            ranges[run].extend(zip(lbmins, lbmaxs))
+        for r in lbranges:
+            ranges[r.run].append((r.lbmin, r.lbmax))
+        self._runs = {}
+        for run, lbs in ranges.iteritems():
+            lbs.sort()
+            merged = []
+            for lbmin, lbmax in lbs:
+                if merged and lbmin <= merged[-1][1] + 1:
+                    if lbmax > merged[-1][1]:
+                        merged[-1][1] = lbmax
+                else:
+                    merged.append([lbmin, lbmax])
+            self._runs[run] = ([m[0] for m in merged],
+                               [m[1] for m in merged])
+        self._reset_cache()
+        return self
+
+    def contains(self, run, lb):
+        """return whether (run, lb) is part of the good-runs-list"""
+        if run != self._last_run:
+            self._last_run = run
+            self._last_ranges = self._runs.get(run)
+            self._last_lbmin, self._last_lbmax = 1, 0
+        elif self._last_lbmin <= lb <= self._last_lbmax:
+            return True
+        if self._last_ranges is None:
+            return False
+        lbmins, lbmaxs = self._last_ranges
+        i = bisect.bisect_right(lbmins, lb) - 1
+        if i < 0 or lb > lbmaxs[i]:
+            return False
+        self._last_lbmin, self._last_lbmax = lbmins[i], lbmaxs[i]
+        return True
+
+    def mask(self, runs, lbs):
+        """vectorized `contains`: return the boolean numpy array of the
+        (runs[i], lbs[i]) pairs which are part of the good-runs-list
+        """
+        runs = np.asarray(runs)
+        lbs = np.asarray(lbs)
+        ok = np.zeros(len(runs), dtype=bool)
+        for run in np.unique(runs):
+            ranges = self._runs.get(int(run))
+            if ranges is None:
+                continue
+            sel = runs == run
+            lbmins, lbmaxs = np.asarray(ranges[0]), np.asarray(ranges[1])
+            run_lbs = lbs[sel]
+            i = np.searchsorted(lbmins, run_lbs, side='right') - 1
+            ok[sel] = (i >= 0) & (run_lbs <= lbmaxs[np.maximum(i, 0)])
+        return ok
+
+    def intersection(self, other):
+        """return the GoodRunsList of the lumi-blocks in both `self` and
+        `other`
+        """
+        grl = GoodRunsList()
+        for run, (lbmins, lbmaxs) in self._runs.iteritems():
+            if run not in other._runs:
+                continue
+            olbmins, olbmaxs = other._runs[run]
+            mins, maxs = [], []
+            i = j = 0
+            while i < len(lbmins) and j < len(olbmins):
+                lbmin = max(lbmins[i], olbmins[j])
+                lbmax = min(lbmaxs[i], olbmaxs[j])
+                if lbmin <= lbmax:
+                    mins.append(lbmin)
+                    maxs.append(lbmax)
+                if lbmaxs[i] < olbmaxs[j]:
+                    i += 1
+                else:
+                    j += 1
+            if mins:
+                grl._runs[run] = (mins, maxs)
+        return grl
+
+    def union(self, other):
+        """return the GoodRunsList of the lumi-blocks in `self` or `other`"""
+        return GoodRunsList(self).extend(other)
+
+    def runs(self):
+        return sorted(self._runs.keys())
+
+    def __iter__(self):
+        for run in self.runs():
+            lbmins, lbmaxs = self._runs[run]
+            for lbmin, lbmax in zip(lbmins, lbmaxs):
+                yield LBRange(run, lbmin, lbmax)
+
+    def __len__(self):
+        return sum(len(lbmins) for lbmins,_ in self._runs.itervalues())
+
 def _interpret_grl(fname):
     if not os.path.exists(fname):
         raise OSError
@@ -67,15 +203,54 @@ def _interpret_grl(fname):
             run, lbmin, lbmax = map(int, l.split())
             lbs.append(LBRange(run, lbmin, lbmax))
     elif fname.endswith('.xml'):
-        data = extract_data_from_xml(fname)
-        for i in data:
-            run, lbmin, lbmax = map(int, i)
+        for run, lbmin, lbmax in iterparse_grl(fname):
             lbs.append(LBRange(run, lbmin, lbmax))
     else:
         raise RuntimeError("unknown file extension (%s)" % (fname,))
     return lbs
 
-def interpret_grl(fname="GRL.dat"):
+def iterparse_grl(fname="GRL.xml"):
+    """streaming reader of a GRL xml file: yields the (run-nbr,
+    lumi-block-start, lumi-block-stop) tuples as they are parsed, without
+    building the whole document in memory.
+    """
+    run = None
+    for event, elem in etree.ElementTree.iterparse(str(fname),
+                                                   events=('end',)):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if tag == 'Run':
+            # the Run element may carry attributes (PrescaleRD0, ...)
+            run = int(elem.text)
+        elif tag == 'LBRange':
+            yield run, int(elem.get('Start')), int(elem.get('End'))
+        elif tag == 'LumiBlockCollection':
+            run = None
+            elem.clear()
+
+def _grl_cache_key(fnames, mode):
+    """return the hash of the content of the `fnames` GRL files (and of the
+    way they are combined)
+    """
+    import hashlib
+    key = hashlib.sha1(mode)
+    for fname in fnames:
+        h = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            while True:
+                buf = f.read(1024*1024)
+                if not buf:
+                    break
+                h.update(buf)
+        key.update(h.hexdigest())
+    return key.hexdigest()
+
+def interpret_grl(fname="GRL.dat", mode='union', cache_dir=None):
+    """load one or more GRL files (.dat or .xml) into a GoodRunsList.
+    the GRLs are combined according to `mode` ('union' or 'intersection').
+    if `cache_dir` is given, the compiled GoodRunsList is persisted there
+    (as json), keyed on the content hash of the files, and re-used by the
+    next jobs using the same GRL files.
+    """
     fnames = []
     if isinstance(fname, basestring):
         fnames = [fname]
@@ -84,13 +259,185 @@ def interpret_grl(fname="GRL.dat"):
     else:
         raise TypeError('fname must be a string or a sequence (got: %s)' %
                         type(fname))
-    lbs = []
+    if mode not in ('union', 'intersection'):
+        raise ValueError("invalid GRL mode [%s] (union|intersection)" % mode)
     for fname in fnames:
-        lbs.extend(_interpret_grl(fname))
-    return lbs
+        if not os.path.exists(fname):
+            raise OSError("no such GRL file [%s]" % (fname,))
+
+    cache_fname = None
+    if cache_dir:
+        cache_fname = os.path.join(cache_dir,
+                                   _grl_cache_key(fnames, mode) + '.json')
+        if os.path.exists(cache_fname):
+            try:
+                with open(cache_fname, 'r') as f:
+                    runs = json.load(f)
+                grl = GoodRunsList()
+                grl._runs = dict(
+                    (int(run), (map(int, lbmins), map(int, lbmaxs)))
+                    for run, (lbmins, lbmaxs) in runs.iteritems())
+                print "::: loaded compiled GRL from [%s]" % (cache_fname,)
+                return grl
+            except Exception, err:
+                print "***warning*** could not load compiled GRL [%s]: %s" % (
+                    cache_fname, err)
+
+    grl = None
+    for fname in fnames:
+        file_grl = GoodRunsList(_interpret_grl(fname))
+        if grl is None:
+            grl = file_grl
+        elif mode == 'union':
+            grl.extend(file_grl)
+        else:
+            grl = grl.intersection(file_grl)
+    if grl is None:
+        grl = GoodRunsList()
 
-def pass_grl(run, lb, good_lbs):
+    if cache_fname:
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # write then rename, as concurrent jobs may share the cache
+            tmp_fname = "%s.%i.tmp" % (cache_fname, os.getpid())
+            with open(tmp_fname, 'w') as f:
+                json.dump(grl._runs, f)
+            os.rename(tmp_fname, cache_fname)
+        except (IOError, OSError), err:
+            print "***warning*** could not save compiled GRL [%s]: %s" % (
+                cache_fname, err)
+    return grl
+
+class EventSet(object):
+    """a compact set of (run-nbr, event-nbr) pairs, to drop duplicate events.
+    for each run, the event numbers are kept in a sorted array('L') (8 bytes
+    per event on 64-bit platforms, so the 64-bit event numbers fit) and a
+    small insertion buffer, merged into the sorted array when it grows over
+    1/8th of it.
+    with `spill_dir`, the arrays of the least recently used runs are spilled
+    to disk (and re-loaded when needed) once the set uses more than
+    `max_memory` bytes, down to 3/4 of `max_memory`. without `spill_dir`,
+    `max_memory` is advisory: a warning is printed when it is exceeded.
+    """
+    _BUF_ITEM_SZ = 80 # approx. memory of an int in a python set
+
+    def __init__(self, max_memory=2*1024**3, spill_dir=None):
+        object.__init__(self)
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self._events = {}   # run -> sorted array of event numbers
+        self._buffers = {}  # run -> set of event numbers
+        self._spilled = {}  # run -> file name
+        # runs in memory, least recently used first
+        self._lru = collections.OrderedDict()
+        self._last_run = None
+        self._nbytes = 0
+        self.nevents = 0
+        self.nspills = 0
+        self._over_budget = False
+
+    def _load(self, run):
+        from array import array
+        if run in self._spilled:
+            fname = self._spilled.pop(run)
+            events = array('L')
+            with open(fname, 'rb') as f:
+                events.fromstring(f.read())
+            os.remove(fname)
+            self._events[run] = events
+            self._buffers[run] = set()
+            self._nbytes += events.itemsize * len(events)
+        elif run not in self._events:
+            self._events[run] = array('L')
+            self._buffers[run] = set()
+        self._lru.pop(run, None)
+        self._lru[run] = None
+        self._last_run = run
+
+    def _merge(self, run):
+        from array import array
+        import heapq
+        events = self._events[run]
+        buf = self._buffers[run]
+        self._nbytes -= (events.itemsize * len(events) +
+                         self._BUF_ITEM_SZ * len(buf))
+        events = array('L', heapq.merge(events, sorted(buf)))
+        self._events[run] = events
+        self._buffers[run] = set()
+        self._nbytes += events.itemsize * len(events)
+
+    def _spill(self):
+        import tempfile
+        while (self._nbytes > 0.75 * self.max_memory and len(self._lru) > 1):
+            run, _ = self._lru.popitem(last=False)
+            self._merge(run)
+            events = self._events.pop(run)
+            del self._buffers[run]
+            fd, fname = tempfile.mkstemp(prefix='run%i-' % run,
+                                         suffix='.evts', dir=self.spill_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(events.tostring())
+            self._spilled[run] = fname
+            self._nbytes -= events.itemsize * len(events)
+            self.nspills += 1
+
+    def add(self, run, evt):
+        """add the (run, evt) event to the set.
+        returns False if it was already in the set.
+        """
+        if run != self._last_run:
+            self._load(run)
+        buf = self._buffers[run]
+        if evt in buf:
+            return False
+        events = self._events[run]
+        i = bisect.bisect_left(events, evt)
+        if i < len(events) and events[i] == evt:
+            return False
+        buf.add(evt)
+        self.nevents += 1
+        self._nbytes += self._BUF_ITEM_SZ
+        if len(buf) > max(4096, len(events) // 8):
+            self._merge(run)
+        if self._nbytes > self.max_memory:
+            if self.spill_dir is not None:
+                self._spill()
+            elif not self._over_budget:
+                self._over_budget = True
+                print "***warning*** the event set uses more than its memory" \
+                      " budget (%8.3f Mb) and has no spill directory" % (
+                          self.max_memory / 1024. / 1024.,)
+        return True
+
+    def __contains__(self, (run, evt)):
+        if run != self._last_run:
+            if run not in self._events and run not in self._spilled:
+                return False
+            self._load(run)
+        if evt in self._buffers[run]:
+            return True
+        events = self._events[run]
+        i = bisect.bisect_left(events, evt)
+        return i < len(events) and events[i] == evt
+
+    def __len__(self):
+        return self.nevents
+
+    def memory(self):
+        """the (approximate) memory used by the set, in bytes"""
+        return self._nbytes
+
+    def clear(self):
+        for fname in self._spilled.itervalues():
+            if os.path.exists(fname):
+                os.remove(fname)
+        self.__init__(self.max_memory, self.spill_dir)
+
+    pass # class EventSet
 
+def _pass_grl_scan(run, lb, good_lbs):
+    """the (slow) linear scan over a sequence of LBRange"""
     for ilb in good_lbs:
         if run != ilb.run:
             continue
@@ -100,50 +447,583 @@ def pass_grl(run, lb, good_lbs):
 
     return False
 
+def pass_grl(run, lb, good_lbs):
+    if isinstance(good_lbs, GoodRunsList):
+        return good_lbs.contains(run, lb)
+    return _pass_grl_scan(run, lb, good_lbs)
+
+def bench_grl(nruns=200, nranges=20, nevts=200000):
+    """micro-benchmark of the GoodRunsList lookup against the linear scan,
+    with a synthetic GRL of `nruns` x `nranges` ranges and `nevts` run-ordered
+    events
+    """
+    import random
+    import timeit
+    rnd = random.Random(1234)
+    lbs = []
+    for run in xrange(nruns):
+        lbmin = 1
+        for _ in xrange(nranges):
+            lbmin += rnd.randint(1, 20)
+            lbmax = lbmin + rnd.randint(0, 50)
+            lbs.append(LBRange(run, lbmin, lbmax))
+            lbmin = lbmax + 1
+    evts = sorted((rnd.randrange(nruns), rnd.randint(1, nranges*70))
+                  for _ in xrange(nevts))
+    grl = GoodRunsList(lbs)
+    # the linear scan is way too slow to be run over all events...
+    nscan = min(nevts, 2000)
+    scan_evts = evts[::max(1, nevts//nscan)]
+
+    assert ([pass_grl(run, lb, grl) for run, lb in scan_evts] ==
+            [_pass_grl_scan(run, lb, lbs) for run, lb in scan_evts])
+
+    t_scan = min(timeit.repeat(
+        lambda: [_pass_grl_scan(run, lb, lbs) for run, lb in scan_evts],
+        repeat=3, number=1)) / len(scan_evts)
+    t_grl = min(timeit.repeat(
+        lambda: [grl.contains(run, lb) for run, lb in evts],
+        repeat=3, number=1)) / len(evts)
+    print "::: GRL benchmark: [%i] ranges, [%i] runs" % (len(lbs), nruns)
+    print ":::   linear scan:   %10.3f us/evt" % (t_scan * 1e6,)
+    print ":::   GoodRunsList:  %10.3f us/evt" % (t_grl * 1e6,)
+    print ":::   speed-up:      %10.1f" % (t_scan / t_grl,)
+    return 0
+
 def warm_up(fname):
     assert os.path.exists(fname)
     import commands
     rc,_ = commands.getstatusoutput("/bin/dd if=%s of=/dev/null" % (fname,))
     return rc
 
+class BranchMatcher(object):
+    """the ordered list of branch patterns (of a --var file), compiled once.
+    a pattern adds ('+' prefix, the default) or removes ('-' prefix) the
+    branches it matches: it is either a glob (fnmatch) or, with the 're:'
+    prefix, a regular expression matching the whole branch name
+    (ex: '-re:el_(px|py)'). a branch is decided by the last pattern matching
+    it: the exact names are looked up in a dict and the wildcard patterns are
+    tried from the last one, until one matches.
+    """
+
+    def __init__(self, patterns):
+        object.__init__(self)
+        import re
+        from fnmatch import translate
+        self.patterns = []  # (pattern, op, regex or None, body)
+        self._exact = {}    # branch name -> index of the last exact pattern
+        self._regexes = []  # (index, regex), from the last pattern
+        for p in patterns:
+            p = p.strip()
+            if not p:
+                continue
+            op, body = '+', p
+            if body[0] in '+-':
+                op, body = body[0], body[1:]
+            idx = len(self.patterns)
+            if body.startswith('re:'):
+                try:
+                    rx = re.compile(r'(?:%s)\Z' % (body[3:],))
+                except re.error, err:
+                    print "*** invalid regex pattern [%s]: %s" % (p, err)
+                    raise
+            elif '*' in body or '?' in body or '[' in body:
+                rx = re.compile(translate(body))
+            else:
+                rx = None
+                self._exact[body] = idx
+            self.patterns.append((p, op, rx, body))
+            if rx is not None:
+                self._regexes.append((idx, rx))
+        self._regexes.reverse()
+
+    def match(self, name):
+        """return the index of the last pattern matching the branch `name`
+        (-1 if none)
+        """
+        idx = self._exact.get(name, -1)
+        for i, rx in self._regexes:
+            if i < idx:
+                break
+            if rx.match(name):
+                return i
+        return idx
+
+    def keep(self, name):
+        idx = self.match(name)
+        return idx >= 0 and self.patterns[idx][1] == '+'
+
+    def select(self, names):
+        """return the (sorted) names of the branches to keep"""
+        return sorted(n for n in names if self.keep(n))
+
+    def unmatched(self, names):
+        """return the patterns which match none of the `names` branches"""
+        names = list(names)
+        decided = set(self.match(n) for n in names)
+        unmatched = []
+        for idx, (p, op, rx, body) in enumerate(self.patterns):
+            if idx in decided:
+                continue
+            # (the branches it matches may all be decided by later patterns)
+            if rx is None:
+                if body in names:
+                    continue
+            elif any(rx.match(n) for n in names):
+                continue
+            unmatched.append(p)
+        return unmatched
+
+    pass # class BranchMatcher
+
 def apply_filters(branches, patterns):
     """extract the branches which match the patterns.
     a pattern can add or remove a branch.
     if a branch matches no pattern, it is discarded.
     if a branch matches several patterns, the last pattern wins.
+    (see `BranchMatcher`)
     """
-    from fnmatch import fnmatch
-    from collections import defaultdict
-    filtered = defaultdict(list)
-    matched_patterns = []
-    for br in branches:
-        for p in patterns:
-            if p == '':
+    matcher = BranchMatcher(patterns)
+    for p in matcher.unmatched(branches):
+        print '::: warning: pattern [%s] could not be matched against any branch' % p
+    return matcher.select(branches)
+
+def _read_patterns(vars_fname):
+    """return the branch patterns of the `vars_fname` file"""
+    with open(vars_fname, 'r') as br_file:
+        return [p.strip() for p in br_file]
+
+def plan_branches(fnames, tree_name, vars_fname=None):
+    """dry-run of the selection of branches of `vars_fname` (all branches if
+    None): print the kept branches with their estimated (compressed) size
+    per event over the trees `tree_name` of the `fnames` files, the
+    estimated output size and the unmatched patterns.
+    returns the estimated output size per event (in bytes), or None if an
+    input file or tree could not be read.
+    """
+    nentries = 0
+    sizes = collections.defaultdict(float)
+    all_names = []
+    for fname in fnames:
+        f = ROOT.TFile.Open(fname, "read")
+        if not f or f.IsZombie():
+            print "*** could not open file [%s]" % (fname,)
+            return None
+        tree = f.Get(tree_name)
+        if not tree:
+            print "*** no tree [%s] in file [%s]" % (tree_name, fname)
+            f.Close()
+            return None
+        nentries += tree.GetEntries()
+        for br in tree.GetListOfBranches():
+            sizes[br.GetName()] += br.GetZipBytes("*")
+        if not all_names:
+            all_names = [br.GetName() for br in tree.GetListOfBranches()]
+        del tree
+        f.Close()
+        del f
+
+    unmatched = []
+    if vars_fname is None:
+        br_names = sorted(all_names)
+    else:
+        matcher = BranchMatcher(_read_patterns(vars_fname))
+        br_names = matcher.select(all_names)
+        unmatched = matcher.unmatched(all_names)
+
+    nentries = nentries or 1
+    evt_sizes = sorted(((sizes[n] / nentries, n) for n in br_names),
+                       reverse=True)
+    print "::: dry-run: keeping [%i/%i] branches (from file-list %s)" % (
+        len(br_names), len(all_names), vars_fname)
+    for sz, n in evt_sizes:
+        print ":::   [%s] %10.1f bytes/evt" % (n, sz)
+    tot_sz = sum(sz for sz, n in evt_sizes)
+    print "::: dry-run: estimated output size: %10.1f bytes/evt" \
+          " (%8.3f Mb for [%i] entries, before selection)" % (
+              tot_sz, tot_sz * nentries / 1024. / 1024., nentries)
+    for p in unmatched:
+        print "::: dry-run: pattern [%s] could not be matched against" \
+              " any branch" % (p,)
+    return tot_sz
+
+class _SizePredictor(object):
+    """decides when the output file has to be changed, before it grows over
+    `threshold` bytes.
+    the (costly) TFile::Flush + TFile::GetSize are only done at checkpoints:
+    the next checkpoint is scheduled half-way to the entry where the file is
+    predicted to reach the threshold. the prediction uses the uncompressed
+    size per entry of the output trees, an upper bound of the zipped one,
+    averaged over the whole file and over the entries filled since the last
+    checkpoint (so a sudden growth of the entries is taken into account at
+    the next checkpoint): the threshold is not overshot in between two
+    checkpoints unless the entries grow more than twice as big.
+    """
+    def __init__(self, threshold, nmin=1):
+        object.__init__(self)
+        self.threshold = threshold
+        self.nmin = nmin # entries filled before the first checkpoint
+        self.nchecks = 0
+        self.reset()
+
+    def reset(self):
+        """start a new output file"""
+        self.nentries = 0
+        self.next_check = self.nmin
+        self.last_sizes = None # see _tree_sizes, at the last checkpoint
+
+    @staticmethod
+    def _tree_sizes(trees):
+        return [(t.GetTotBytes(), t.GetEntries()) for t in trees]
+
+    def fill(self):
+        self.nentries += 1
+
+    def need_change(self, fout, trees):
+        """return whether the output file `fout` must be changed before the
+        next entry of `trees` is filled
+        """
+        if self.last_sizes is None:
+            self.last_sizes = self._tree_sizes(trees)
+        if self.nentries < self.next_check:
+            return False
+        self.nchecks += 1
+        fout.Flush()
+        fsize = fout.GetSize()
+        avg_entry_sz = fsize / float(self.nentries or 1.)
+        sizes = self._tree_sizes(trees)
+        max_entry_sz = sum(nbytes / float(n or 1.) for nbytes, n in sizes)
+        last_entry_sz = sum((nbytes - nbytes0) / float(n - n0 or 1.)
+                            for (nbytes, n), (nbytes0, n0)
+                            in zip(sizes, self.last_sizes))
+        self.last_sizes = sizes
+        max_entry_sz = max(max_entry_sz, last_entry_sz, avg_entry_sz, 1.)
+        if fsize + max_entry_sz > self.threshold:
+            return True
+        nleft = (self.threshold - fsize) / max_entry_sz
+        self.next_check = self.nentries + max(1, int(nleft // 2))
+        return False
+
+def _branch_sizes(args):
+    """return the number of entries and the sizes of the branches of the
+    tree `tree_name` of the file `fname`
+    """
+    fname, tree_name = args
+    f = ROOT.TFile.Open(fname, "read")
+    tree = getattr(f, tree_name)
+    nentries = tree.GetEntries()
+    sizes = dict((br.GetName(), br.GetTotBytes())
+                 for br in tree.GetListOfBranches())
+    del tree
+    f.Close()
+    del f
+    return nentries, sizes
+
+def collect_branch_sizes(fnames, tree_name, jobs=1):
+    """sum the sizes of the branches of the tree `tree_name` over the
+    `fnames` files, reading the files with `jobs` processes.
+    returns the total number of entries and a dict branch-name -> size (in
+    bytes)
+    """
+    args = [(fname, tree_name) for fname in fnames]
+    if jobs > 1 and len(fnames) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(fnames)))
+        try:
+            all_sizes = pool.map(_branch_sizes, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        all_sizes = map(_branch_sizes, args)
+    tot_entries = 0
+    tot_sz = {}
+    for nentries, sizes in all_sizes:
+        tot_entries += nentries
+        for br_name, sz in sizes.iteritems():
+            tot_sz[br_name] = tot_sz.get(br_name, 0) + sz
+    return tot_entries, tot_sz
+
+def optimize_baskets(tot_sz, memory):
+    """split the branches' total sizes `tot_sz` into baskets until the sum
+    of the basket sizes fits in `memory` (bytes): each step adds a basket to
+    the branch whose basket size would shrink the most.
+    the candidates are kept in a heap, keyed by that gain.
+    returns the lists of basket sizes and numbers of baskets.
+    raises ValueError if `memory` is not > 0 (the sum would never fit).
+    """
+    import heapq
+    if memory <= 0:
+        raise ValueError("invalid basket memory [%r] (must be > 0)" %
+                         (memory,))
+    nleaves = len(tot_sz)
+    basket_sz = tot_sz[:]
+    baskets = [1]*nleaves
+    def spare(i):
+        return tot_sz[i]/baskets[i] - tot_sz[i]/(baskets[i]+1)
+    heap = [(-spare(i), i) for i in xrange(nleaves)]
+    heapq.heapify(heap)
+    tot_mem = sum(basket_sz)
+    while heap and tot_mem >= memory:
+        _, i = heapq.heappop(heap)
+        baskets[i] += 1
+        new_sz = tot_sz[i]/baskets[i]
+        tot_mem -= basket_sz[i] - new_sz
+        basket_sz[i] = new_sz
+        heapq.heappush(heap, (-spare(i), i))
+    return basket_sz, baskets
+
+def cluster_baskets(tot_sz, nentries, memory, margin=1.1):
+    """size the baskets so that each one holds the same (cluster of) entries
+    for all the branches, with their sum fitting in `memory` (bytes).
+    flushing the tree every cluster then writes the baskets sorted by entry,
+    without the need for a re-ordering pass.
+    returns the lists of basket sizes and numbers of baskets and the number
+    of entries per cluster.
+    """
+    entry_sz = sum(tot_sz) / float(nentries or 1)
+    cluster_sz = max(1, int(memory / (margin * entry_sz or 1.)))
+    cluster_sz = min(cluster_sz, max(1, nentries))
+    nclusters = max(1, (nentries + cluster_sz - 1) // cluster_sz)
+    basket_sz = [int(margin * sz * cluster_sz / float(nentries or 1))
+                 for sz in tot_sz]
+    baskets = [nclusters] * len(tot_sz)
+    return basket_sz, baskets, cluster_sz
+
+def _kept_branches(orig_tree, vars_fname):
+    """return the names of the branches of `orig_tree` to be kept, according
+    to the patterns of the `vars_fname` file (all branches if None), and
+    only enable those in `orig_tree`
+    """
+    if vars_fname is None:
+        return [br.GetName() for br in orig_tree.GetListOfBranches()]
+
+    all_br_names = set(br.GetName() for br in orig_tree.GetListOfBranches())
+    # open the file containing the list of branches to keep or discard
+    patterns = _read_patterns(vars_fname)
+    orig_tree.SetBranchStatus("*", 0)
+    # apply_filters returns the list of branches to keep
+    br_names = apply_filters(all_br_names, patterns)
+    print "::: keeping only the following branches: (from file-list %s)" %\
+          vars_fname
+    for b in br_names:
+        print ":::   [%s]" % (b,)
+        orig_tree.SetBranchStatus(b,1)
+    return br_names
+
+def _tree_paths(d, prefix=''):
+    """return the paths (dir1/dir2/tree0,...) of all the trees under the `d`
+    directory, from the class names of the keys (no object is read)
+    """
+    paths = []
+    seen = set()
+    for key in d.GetListOfKeys():
+        name = key.GetName()
+        if name in seen:
+            # another cycle of the same object
+            continue
+        seen.add(name)
+        cls = ROOT.TClass.GetClass(key.GetClassName())
+        if not cls:
+            continue
+        if cls.InheritsFrom(ROOT.TDirectory.Class()):
+            paths.extend(_tree_paths(d.Get(name), prefix + name + '/'))
+        elif cls.InheritsFrom(ROOT.TTree.Class()):
+            paths.append(prefix + name)
+    return paths
+
+def _payload_tree_names(orig_file, orig_tree, tree_name):
+    """return the paths of the other payload-trees of `orig_file` (including
+    the ones of nested directories: dir1/dir2/tree0,...).
+    to decide if a tree is a payload-tree (and not a metadata tree which we
+    don't know -by default- what is the correct way to merge) we just
+    compare its number of events with the one of `orig_tree`.
+    """
+    _all_tree_names = [n for n in _tree_paths(orig_file) if n != tree_name]
+    names = []
+    for n in _all_tree_names:
+        _old_tree = orig_file.Get(n)
+        print ":::  ->",n,
+        if _old_tree.GetEntries() != orig_tree.GetEntries():
+            # probably not a payload-tree but a metadata one...
+            print "[reject]"
+        else:
+            print "[keep]"
+            names.append(n)
+        del _old_tree
+    return names
+
+def _output_dir(fout, tree_path):
+    """return the directory of `fout` holding the `tree_path` tree, creating
+    the intermediate sub-directories as needed
+    """
+    d = fout
+    for name in tree_path.split('/')[:-1]:
+        sub = d.GetDirectory(name)
+        if not sub:
+            sub = d.mkdir(name)
+        d = sub
+    return d
+
+def _change_file(tree, fout, nested_trees=()):
+    """switch `tree` to the next (split) output file with TTree::ChangeFile,
+    which also moves the trees of the top directory of `fout`. the
+    `nested_trees` (path, tree) pairs, in sub-directories, are saved into
+    `fout` and moved to the same sub-directories of the new file.
+    returns the new output file.
+    """
+    for path, t in nested_trees:
+        t.Write("", ROOT.TObject.kOverwrite)
+        t.Reset()
+        t.SetDirectory(0)
+    fout = tree.ChangeFile(fout)
+    for path, t in nested_trees:
+        t.SetDirectory(_output_dir(fout, path))
+    return fout
+
+class PayloadTrees(object):
+    """copy engine of the other payload-trees (see `_payload_tree_names`):
+    the `names` trees of an input file are resolved and bound to the
+    addresses of the `out_trees` once per file (`bind`), then read in
+    lock-step with the main tree, entry by entry (`read`).
+    """
+
+    def __init__(self, names, out_trees, cache_size=None, cache_learn=100):
+        object.__init__(self)
+        self.names = list(names)
+        self.out_trees = list(out_trees)
+        self.cache_size = cache_size
+        self.cache_learn = cache_learn
+        self.trees = []
+
+    def nested(self):
+        """return the (path, output tree) pairs of the trees held in
+        sub-directories (see `_change_file`)
+        """
+        return [(n, t) for n, t in zip(self.names, self.out_trees) if '/' in n]
+
+    def bind(self, f, nentries):
+        """resolve the payload-trees of the input file `f` (whose main tree
+        has `nentries` entries) and bind them to the output trees
+        """
+        self.trees = []
+        for name, out_tree in zip(self.names, self.out_trees):
+            tree = f.Get(name)
+            if not tree:
+                print "*** no payload-tree [%s] in [%s]" % (name, f.GetName())
+                raise RuntimeError
+            if tree.GetEntries() != nentries:
+                print "*** payload-tree [%s] of [%s] has [%i] entries" \
+                      " (expected: [%i])" % (name, f.GetName(),
+                                             tree.GetEntries(), nentries)
+                raise RuntimeError
+            out_tree.CopyAddresses(tree)
+            setup_read_cache(tree, cache_size=self.cache_size,
+                             learn_entries=self.cache_learn)
+            self.trees.append(tree)
+        return
+
+    def read(self, i):
+        """read the entry `i` of all the payload-trees. returns the output
+        trees whose entry could be read
+        """
+        out_trees = []
+        for tree, out_tree in zip(self.trees, self.out_trees):
+            nb = tree.GetEntry(i)
+            if nb <= 0:
+                print "*** error loading entry [%i] for tree [%s]." \
+                      " got (%i) bytes" % (i, tree.GetName(), nb)
                 continue
-            op = '-'
-            if p.startswith('+') or not p.startswith('-'):
-                if p[0] == '+':
-                    p = p[1:]
-                op = '+'
-            if p.startswith('-'):
-                op = '-'
-                p = p[1:]
-            if fnmatch(br, p):
-                filtered[br].append(op)
-                matched_patterns.append(p)
-    for p in patterns:
-        if not (p in matched_patterns):
-            print '::: warning: pattern [%s] could not be matched against any branch' % p
-            pass
-        pass
-    filtered = dict(filtered)
-    return sorted([k for k,v in filtered.iteritems() if v[-1] == '+'])
+            out_trees.append(out_tree)
+        return out_trees
+
+    def release(self):
+        del self.trees[:]
+
+    pass # class PayloadTrees
+
+def _set_basket_sizes(tree, br_names, basket_sz, baskets):
+    """set the (optimized) basket sizes of the `br_names` branches of `tree`"""
+    tot_mem = 0.
+    tot_bkt = 0
+    max_bkt = 0
+    min_bkt = 1024**3
+
+    for ibr in xrange(len(br_names)):
+        br = tree.GetBranch(br_names[ibr])
+        if basket_sz[ibr] == 0:
+            basket_sz[ibr] = 16
+
+        basket_sz[ibr] = basket_sz[ibr] - (basket_sz[ibr] % 8)
+        br.SetBasketSize(basket_sz[ibr])
+
+        tot_mem += basket_sz[ibr]
+        tot_bkt += baskets[ibr]
+
+        if basket_sz[ibr] < min_bkt:
+            min_bkt = basket_sz[ibr]
+        if basket_sz[ibr] > max_bkt:
+            max_bkt = basket_sz[ibr]
+
+        pass # loop over leaves
+
+    print "::: optimize baskets: "
+    print ":::   total memory buffer: %8.3f kb" % (tot_mem/1024,)
+    print ":::   total baskets:       %8.3f (min= %8.3f) (max= %8.3f) kb" % (
+        tot_bkt, min_bkt, max_bkt)
+    return
 
 def merge_all_trees(fnames, tree_name, memory, sfo,
                     vars_fname=None, grl_fname=None,
                     filter_fct=None,
                     keep_all_trees=False,
-                    apply_recursive_opt=True):
+                    apply_recursive_opt=True,
+                    two_phase=False,
+                    batch_size=0,
+                    branch_sizes=None,
+                    jobs=1,
+                    ordered=False,
+                    manifest_fname=None,
+                    resume=None,
+                    progress=10.,
+                    stats_fname=None,
+                    grl_mode='union',
+                    grl_cache_dir=None,
+                    dedup=None,
+                    cache_size=None,
+                    cache_learn=100,
+                    prefetch=0):
+    """filter and merge the trees `tree_name` from the `fnames` input files.
+    with `two_phase`, only the branches needed by the GRL and the user
+    selection are read before the selection is evaluated: the full entry is
+    then only read for the accepted events.
+    with `batch_size`, the selection branches are read by chunks of
+    `batch_size` entries into numpy arrays and `filter_fct` is a vectorized
+    selection (see `_load_chunk_filter`) returning the mask of the accepted
+    entries of a chunk.
+    the baskets are optimized from the `branch_sizes` (as returned by
+    `collect_branch_sizes`, default: collected over `fnames` with `jobs`
+    processes), so their total size fits in `memory` kb.
+    with `ordered`, the baskets are sized and flushed by clusters of entries
+    (see `cluster_baskets`) so the output is written sorted by entry.
+    with `manifest_fname`, the output trees are saved after each input file
+    and each split of the output file, and a checkpoint manifest is written
+    to `manifest_fname` (see `save_manifest`).
+    with `resume` (a loaded manifest), the output file of the checkpoint is
+    re-opened and filled with the entries of the `fnames` files (the input
+    files which were not completed).
+    the throughput of the event loop is printed every `progress` seconds
+    and summarized at the end (and saved as json into `stats_fname`).
+    the `grl_fname` GRL files are combined according to `grl_mode` and
+    compiled once into `grl_cache_dir` (see `interpret_grl`).
+    with `dedup` (an EventSet), the accepted events already in the set are
+    dropped.
+    the inputs are read through a TTreeCache of `cache_size` Mb (sized after
+    the read branches if None, see `setup_read_cache`), the branches of the
+    other trees being learnt over `cache_learn` entries, and the next
+    `prefetch` input files are prefetched in the background.
+    returns the number of accepted and processed entries.
+    """
     
     oname = sfo[:]
     if not oname.endswith(".root"):
@@ -151,7 +1031,15 @@ def merge_all_trees(fnames, tree_name, memory, sfo,
         pass
 
     root_open = ROOT.TFile.Open
-    fout = root_open(oname, "RECREATE", "", 1)
+    if resume is None:
+        fout = root_open(oname, "RECREATE", "", 1)
+    else:
+        print "::: resuming from [%s] (%i entries)" % (resume['output'],
+                                                      resume['entries'])
+        fout = root_open(resume['output'], "UPDATE")
+        # the output trees are restored with their basket sizes
+        apply_recursive_opt = False
+        ordered = False
     fout.ResetBit(ROOT.kCanDelete)
     
     memory *= 1024 # change to bytes
@@ -161,78 +1049,47 @@ def merge_all_trees(fnames, tree_name, memory, sfo,
     ## summing up branch sizes over all the files
     orig_file = root_open(fnames[0], "read")
     orig_tree = getattr(orig_file, tree_name)
-    br_names = []
-    all_br_names = set(br.GetName() for br in orig_tree.GetListOfBranches())
-    
-    if not (vars_fname is None):
-        # open the file containing the list of branches to keep or discard
-        patterns = []
-        with open(vars_fname, 'r') as br_file:
-            for p in br_file:
-                patterns.append(p.strip())
-        orig_tree.SetBranchStatus("*", 0)
-        # apply_filters returns the list of branches to keep
-        br_names = apply_filters(all_br_names, patterns)
-        print "::: keeping only the following branches: (from file-list %s)" %\
-              vars_fname
-        for b in br_names:
-            print ":::   [%s]" % (b,)
-            orig_tree.SetBranchStatus(b,1)                            
-    else:
-        br_names = [br.GetName() for br in orig_tree.GetListOfBranches()]
+    br_names = _kept_branches(orig_tree, vars_fname)
 
     nleaves = len(br_names)
     print "::: nleaves=[%04i] tree=[%s]" % (nleaves, orig_tree.GetName())
 
-    tot_sz = [0]*nleaves    # zipped sizes collected from all files
-    basket_sz = [0]*nleaves # size to be optimized (starts with `tot_sz`)
-    baskets = [1]*nleaves   # cache
-
-    for idx,fname in enumerate(fnames):
-        f = root_open(fname, "read")
-        tree = getattr(f, tree_name)
-        for ibr,br_name in enumerate(br_names):
-            branch = tree.GetBranch(br_name)
-            if not branch:
-                print "***warning*** - tree [%s] has no branch [%s]" % (tree.GetName(),
-                                                                        br_name)
-                continue
-            branch.SetAddress(0)
-
-            tot_sz[ibr] += branch.GetTotBytes()
-            basket_sz[ibr] = tot_sz[ibr]
-            #baskets[ibr] = 1
-
-            pass # loop over branches
-        del tree
-        f.Close()
-        del f
-        pass # loop over trees
-
-    if apply_recursive_opt:
-        while 1: # recursive optimization
-            tot_mem = sum(basket_sz)
-            if tot_mem < memory:
-                break
-
-            max_spare = -1
-            max_spare_idx = None
-            for i in xrange(nleaves):
-                spare = tot_sz[i]/baskets[i] - tot_sz[i]/(baskets[i]+1)
-                if max_spare < spare:
-                    max_spare = spare
-                    max_spare_idx = i
-            if max_spare_idx is not None:
-                idx = max_spare_idx
-                baskets[idx] += 1
-                basket_sz[idx] = tot_sz[idx]/baskets[idx]
-            pass # end-while
-        pass # apply_recursive_opt
+    cluster_sz = None
+    if apply_recursive_opt or ordered:
+        if branch_sizes is None:
+            branch_sizes = collect_branch_sizes(fnames, tree_name, jobs=jobs)
+        tot_entries, branch_sizes = branch_sizes
+        # zipped sizes collected from all files
+        tot_sz = [branch_sizes.get(br_name, 0) for br_name in br_names]
+        for br_name in br_names:
+            if br_name not in branch_sizes:
+                print "***warning*** - tree [%s] has no branch [%s]" % (
+                    tree_name, br_name)
+
+        if ordered:
+            basket_sz, baskets, cluster_sz = cluster_baskets(tot_sz,
+                                                             tot_entries,
+                                                             memory)
+        else:
+            basket_sz, baskets = optimize_baskets(tot_sz, memory)
     
-    # create the new (optimized) tree
-    new_tree = orig_tree.CloneTree(0) # no copy of events
+    if resume is None:
+        # create the new (optimized) tree
+        new_tree = orig_tree.CloneTree(0) # no copy of events
+        new_tree.SetDirectory(fout)
+    else:
+        new_tree = fout.Get(tree_name)
+        if (not new_tree or
+            new_tree.GetEntries() != resume.get('tree_entries')):
+            # the output file went on after the checkpoint (or is damaged):
+            # resuming would write the same events twice
+            print "*** the tree [%s] of [%s] does not hold the [%s] entries" \
+                  " of the checkpoint: can not resume" % (
+                      tree_name, resume['output'], resume.get('tree_entries'))
+            raise RuntimeError
+        # so the next split file is named after the current one
+        new_tree.SetFileNumber(resume['file_number'])
     new_tree.ResetBit(ROOT.kCanDelete)
-    new_tree.SetDirectory(fout)
     # once cloning is done, separate the trees to avoid as many side-effects
     # as possible
     #orig_tree.GetListOfClones().Remove(new_tree)
@@ -247,223 +1104,1291 @@ def merge_all_trees(fnames, tree_name, memory, sfo,
             new_tree.SetBranchStatus(br_name, 1)
 
     # a list of other tree names to filter-and-merge
+    other_names = []
     other_trees = []
     if keep_all_trees:
         print "::: capturing other trees to filter and merge..."
         # also handle all other payload-trees
-        # to decide if a tree is a payload-tree (and not a metadata tree
-        # which we don't know -by default- what is the correct way to merge)
-        # we just compare the number of events...
-        # FIXME: handle deeply-nested structures (/dir1/dir2/tree0,...)
-        _all_tree_names = list(n.GetName()
-                               for n in orig_file.GetListOfKeys()
-                               if (isinstance(getattr(orig_file, n.GetName()),
-                                              ROOT.TTree)
-                                   and n.GetName() != tree_name))
-        for n in _all_tree_names:
+        if resume is None:
+            other_names = _payload_tree_names(orig_file, orig_tree, tree_name)
+        else:
+            other_names = resume['other_trees']
+        for n in other_names:
             _old_tree = orig_file.Get(n)
-            print ":::  ->",n,
-            if _old_tree.GetEntries() != orig_tree.GetEntries():
-                # probably not a payload-tree but a metadata one...
-                del _old_tree
-                print "[reject]"
-                continue
-            print "[keep]"
-            _new_tree = _old_tree.CloneTree(0) # no copy of events
+            if resume is None:
+                _new_tree = _old_tree.CloneTree(0) # no copy of events
+                _new_tree.SetDirectory(_output_dir(fout, n))
+            else:
+                _new_tree = fout.Get(n)
             _new_tree.ResetBit(ROOT.kCanDelete)
-            _new_tree.SetDirectory(fout)
             _old_tree.ResetBranchAddresses()
             _new_tree.ResetBranchAddresses()
             other_trees.append(_new_tree)
             del _old_tree
         print "::: capturing other trees to filter and merge... [done]"
 
-    if apply_recursive_opt:
-        # setting optimized basket sizes
-        tot_mem = 0.
-        tot_bkt = 0
-        max_bkt = 0
-        min_bkt = 1024**3
-
-        for ibr in xrange(nleaves):
-            br = new_tree.GetBranch(br_names[ibr])
-            if basket_sz[ibr] == 0:
-                basket_sz[ibr] = 16
-
-            basket_sz[ibr] = basket_sz[ibr] - (basket_sz[ibr] % 8)
-            br.SetBasketSize(basket_sz[ibr])
-
-            tot_mem += basket_sz[ibr]
-            tot_bkt += baskets[ibr]
-
-            if basket_sz[ibr] < min_bkt:
-                min_bkt = basket_sz[ibr]
-            if basket_sz[ibr] > max_bkt:
-                max_bkt = basket_sz[ibr]
-
-            pass # loop over leaves
-
-        print "::: optimize baskets: "
-        print ":::   total memory buffer: %8.3f kb" % (tot_mem/1024,)
-        print ":::   total baskets:       %8.3f (min= %8.3f) (max= %8.3f) kb" % (
-            tot_bkt, min_bkt, max_bkt)
+    if cluster_sz is not None:
+        print "::: entry-ordered clusters of [%i] entries" % (cluster_sz,)
+        for t in [new_tree] + other_trees:
+            t.SetAutoFlush(cluster_sz)
 
+    if apply_recursive_opt or ordered:
+        # setting optimized basket sizes
+        _set_basket_sizes(new_tree, br_names, basket_sz, baskets)
         del tot_sz, basket_sz, baskets
         pass # apply_recursive_opt
 
     # copying data
     n_pass = 0
     n_tot = 0
+    file_number = 0
+    done_fnames = []
+    first_entry = 0 # of the first input file
+    if resume is not None:
+        n_pass = resume['n_pass']
+        n_tot = resume['n_tot']
+        file_number = resume['file_number']
+        done_fnames = resume['done'][:]
+        if fnames and resume['current'] == fnames[0]:
+            # the output file was split in the middle of this input file
+            first_entry = resume['first_entry']
     do_grl_selection = not (grl_fname is None)
     
     if do_grl_selection:
-        good_lbs = interpret_grl(fname=grl_fname)
+        grl = interpret_grl(fname=grl_fname, mode=grl_mode,
+                            cache_dir=grl_cache_dir)
+
+    sel_names = None
+    if batch_size:
+        sel_names = _selection_branches(filter_fct, do_grl_selection)
+        if sel_names is None:
+            raise RuntimeError("--batch: the selection reads no branch (declare"
+                               " them in 'filter_branches')")
+        print "::: batch selection: [%i] entries/chunk, branches: %s" % (
+            batch_size, sel_names)
+    elif two_phase:
+        sel_names = _selection_branches(filter_fct, do_grl_selection)
+        if sel_names is None:
+            print "***warning*** two-phase read: the branches read by the"
+            print "***warning*** selection could not be derived (declare them"
+            print "***warning*** in 'filter_branches'): reading full entries"
+        else:
+            print "::: two-phase read: selection branches:", sel_names
+
+    if dedup is not None and sel_names is not None:
+        sel_names = sorted(set(sel_names + ['RunNumber', 'EventNumber']))
+    if dedup is not None and resume is not None:
+        print "***warning*** the events of the completed input files are not"
+        print "***warning*** known to --dedup when resuming"
+    n_dup_tot = 0
+
+    size_predictor = _SizePredictor(0.9 * tree_maxsz)
+    if resume is not None:
+        size_predictor.nentries = resume['entries']
+    out_trees = [new_tree] + other_trees
+    # the checkpoints are the only saved states of the output trees
+    for t in out_trees:
+        t.SetAutoSave(0)
+
+    stats = ThroughputStats(nfiles=len(fnames), period=progress,
+                            n_tot=n_tot, n_pass=n_pass)
+    _now = time.time
+    prefetcher = Prefetcher(fnames, depth=prefetch)
+    payload = PayloadTrees(other_names, other_trees,
+                           cache_size=cache_size, cache_learn=cache_learn)
+    nested_trees = payload.nested()
+
+    def checkpoint(current=None, first_entry=0):
+        """save the output trees, then the manifest. `current` is the input
+        file being processed, from its `first_entry`-th entry on
+        """
+        for t in out_trees:
+            t.AutoSave("FlushBaskets SaveSelf")
+        fout = new_tree.GetCurrentFile()
+        fout.Flush()
+        save_manifest(manifest_fname, dict(
+            tree=tree_name,
+            other_trees=other_names,
+            done=done_fnames,
+            current=current,
+            first_entry=first_entry,
+            output=fout.GetName(),
+            file_number=file_number,
+            entries=size_predictor.nentries,
+            tree_entries=new_tree.GetEntries(),
+            n_pass=n_pass,
+            n_tot=n_tot,
+            complete=False,
+            ))
 
     print "::: processing [%i] trees..." % (len(fnames,))
     for idx, fname in enumerate(fnames):
-        f = root_open(fname, "READ")
+        f = prefetcher.open(idx)
 
-        for other_tree in other_trees:
-            tree = getattr(f, other_tree.GetName())
-            other_tree.CopyAddresses(tree)
-                    
         tree = getattr(f, tree_name)
         new_tree.CopyAddresses(tree)
         nentries = tree.GetEntries()
         print ":::   entries:", nentries
-        for i in xrange(nentries):
-
-            nb = tree.GetEntry(i)
-            if nb <= 0:
-                print "*** error loading entry [%i]. got (%i) bytes" % (i,nb)
-                raise RuntimeError
-            n_tot += 1
+        payload.bind(f, nentries)
+        stats.begin_file(fname, f, tree)
+        n_dup = 0
+
+        sel_branches = None
+        if sel_names is not None:
+            # phase-1 reads the selection branches, phase-2 (tree.GetEntry)
+            # only the branches which are copied over
+            sel_branches = [tree.GetBranch(n) for n in sel_names]
+            missing = [n for n, br in zip(sel_names, sel_branches) if not br]
+            if missing and not batch_size:
+                print "***warning*** two-phase read: no branch %s in [%s]:" % (
+                    missing, fname)
+                print "***warning*** reading full entries for this file"
+                sel_branches = None
+            if vars_fname is not None:
+                tree.SetBranchStatus("*", 0)
+                for br_name in br_names + sel_names:
+                    tree.SetBranchStatus(br_name, 1)
+            rd_names = sorted(set(br_names + sel_names))
+        else:
+            rd_names = br_names
+        sz = setup_read_cache(tree, rd_names, cache_size=cache_size)
+        print ":::   read cache: %8.3f Mb" % (sz / 1024. / 1024.,)
+
+        sel_file = sel_tree = None
+        if batch_size:
+            # the chunks are read through their own handle on the file:
+            # root_numpy resets the addresses and statuses of the branches
+            # of the tree it reads, which are bound to the output tree
+            sel_file = ROOT.TFile.Open(f.GetName(), "read")
+            sel_tree = sel_file.Get(tree_name) if sel_file else None
+            if not sel_tree:
+                raise RuntimeError("could not re-open tree [%s] of [%s]" %
+                                   (tree_name, f.GetName()))
+
+        if idx > 0:
+            first_entry = 0
+        elif first_entry:
+            print ":::   resuming from entry [%i]" % (first_entry,)
+        for i in xrange(first_entry, nentries):
+
+            if batch_size:
+                ichunk = (i - first_entry) % batch_size
+                if ichunk == 0:
+                    t0 = _now()
+                    chunk_stop = min(i + batch_size, nentries)
+                    chunk = _read_chunk(sel_tree, sel_names, i, chunk_stop)
+                    t1 = _now()
+                    stats.times['read'] += t1 - t0
+                    mask = np.ones(chunk_stop - i, dtype=bool)
+                    if do_grl_selection:
+                        mask &= grl.mask(chunk['RunNumber'], chunk['lbn'])
+                    if filter_fct:
+                        try:
+                            mask &= np.asarray(filter_fct(chunk), dtype=bool)
+                        except Exception, err:
+                            print "*** problem running user filter fct:"
+                            print err
+                            print "*** (filter fct is now disabled)"
+                            filter_fct = None
+                    stats.times['select'] += _now() - t1
+                n_tot += 1
+                accept_entry = mask[ichunk]
+                if accept_entry:
+                    t0 = _now()
+                    nb = tree.GetEntry(i)
+                    stats.times['read'] += _now() - t0
+                    if nb <= 0:
+                        print "*** error loading entry [%i]. got (%i) bytes" % (i,nb)
+                        raise RuntimeError
+            else:
+                t0 = _now()
+                if sel_branches is None:
+                    nb = tree.GetEntry(i)
+                else:
+                    tree.LoadTree(i)
+                    # each selection branch has to be read
+                    nb = min(br.GetEntry(i) for br in sel_branches)
+                t1 = _now()
+                stats.times['read'] += t1 - t0
+                if nb <= 0:
+                    print "*** error loading entry [%i]. got (%i) bytes" % (i,nb)
+                    raise RuntimeError
+                n_tot += 1
+
+                accept_entry = True
+                if do_grl_selection:
+                    if not grl.contains(tree.RunNumber, tree.lbn):
+                        accept_entry = False
+                    pass
+            
+                if filter_fct and accept_entry:
+                    try:
+                        if not filter_fct(tree):
+                            accept_entry = False
+                    except Exception, err:
+                        print "*** problem running user filter fct:"
+                        print err
+                        print "*** (filter fct is now disabled)"
+                        filter_fct = None
+                t0 = _now()
+                stats.times['select'] += t0 - t1
+
+                if accept_entry and sel_branches is not None:
+                    nb = tree.GetEntry(i)
+                    stats.times['read'] += _now() - t0
+                    if nb <= 0:
+                        print "*** error loading entry [%i]. got (%i) bytes" % (i,nb)
+                        raise RuntimeError
 
-            accept_entry = True
-            if do_grl_selection:
-                if not pass_grl(tree.RunNumber, tree.lbn, good_lbs):
+            if accept_entry and dedup is not None:
+                if not dedup.add(tree.RunNumber, tree.EventNumber):
+                    # duplicate event: dropped before the Fill
                     accept_entry = False
-                pass
-            
-            if filter_fct and accept_entry:
-                try:
-                    if not filter_fct(tree):
-                        accept_entry = False
-                except Exception, err:
-                    print "*** problem running user filter fct:"
-                    print err
-                    print "*** (filter fct is now disabled)"
-                    filter_fct = None
+                    n_dup += 1
 
             if accept_entry:
                 n_pass += 1
-                if n_pass > 10:
-                    _nentries_cur = new_tree.GetEntries()
-                    fout = new_tree.GetCurrentFile()
-                    fout.Flush()
-                    out_fsize = fout.GetSize()
-                    avg_entry_sz = out_fsize / float(_nentries_cur or 1.)
-                    do_change_file = out_fsize + avg_entry_sz > 0.9 * tree_maxsz
-                    if do_change_file:
-                        #print "--- manually triggering TTree::ChangeFile..."
-                        # manually trigger the file split...
-                        # this is to ensure the split doesn't happen in between
-                        # the new_tree.Fill() and the other_tree.Fill() which
-                        # would de-synchronize the entries between the trees...
-                        fout = new_tree.ChangeFile(fout)
+                t0 = _now()
+                fout = new_tree.GetCurrentFile()
+                if size_predictor.need_change(fout, out_trees):
+                    #print "--- manually triggering TTree::ChangeFile..."
+                    # manually trigger the file split...
+                    # this is to ensure the split doesn't happen in between
+                    # the new_tree.Fill() and the other_tree.Fill() which
+                    # would de-synchronize the entries between the trees...
+                    fout = _change_file(new_tree, fout, nested_trees)
+                    size_predictor.reset()
+                    file_number += 1
+                    if manifest_fname:
+                        # the entries before this one are in the closed
+                        # file: resume from this one (not yet counted)
+                        n_pass -= 1
+                        n_tot -= 1
+                        checkpoint(current=fname, first_entry=i)
+                        n_pass += 1
+                        n_tot += 1
+                t1 = _now()
+                stats.times['flush'] += t1 - t0
+                # the payload-trees are copied with the same decision as
+                # the main tree (the chunk mask, in --batch mode)
+                payload_trees = payload.read(i)
+                t0 = _now()
+                stats.times['read'] += t0 - t1
                 new_tree.Fill()
-                for other_tree in other_trees:
-                    _tree = f.Get(other_tree.GetName())
-                    nb = _tree.GetEntry(i)
-                    if nb <= 0:
-                        print "*** error loading entry [%i] for tree [%s]. got (%i) bytes" % (
-                            i, other_tree.GetName(), nb)
-                        continue
-                    other_tree.Fill()
-                    del _tree
-                    pass # loop over other trees
+                size_predictor.fill()
+                for t in payload_trees:
+                    t.Fill()
+                stats.times['fill'] += _now() - t0
                 pass # entry accepted
+            stats.tick(n_tot, n_pass)
             pass # loop over entries
+        if dedup is not None:
+            print ":::   dropped duplicates: %i" % (n_dup,)
+            n_dup_tot += n_dup
+            stats.end_file(n_dup=n_dup)
+        else:
+            stats.end_file()
+        payload.release()
+        if sel_file:
+            del sel_tree
+            sel_file.Close()
+            del sel_file
         del tree
         f.Close()
         del f
+
+        done_fnames.append(fname)
+        if manifest_fname:
+            checkpoint()
         pass # loop over input trees
+    prefetcher.close()
     print "::: processing [%i] trees... [done]" % (len(fnames,))
+    if prefetch > 0:
+        print "::: prefetched: [%i] files (%8.3f Mb read ahead)" % (
+            prefetcher.nprefetched,
+            prefetcher.bytes_prefetched / 1024. / 1024.)
 
     eff = 0.
     if n_tot != 0:
         eff = float(n_pass)/float(n_tot)
     print "::: filter efficiency: %d/%d -> %s" % (n_pass, n_tot, eff)
+    print "::: output size checks: [%i] (for [%i] entries)" % (
+        size_predictor.nchecks, n_pass)
+    if dedup is not None:
+        print "::: dropped duplicates: %i (%i unique events, %8.3f Mb," \
+              " %i spills)" % (n_dup_tot, len(dedup),
+                               dedup.memory() / 1024. / 1024., dedup.nspills)
 
     fout = new_tree.GetCurrentFile()
     fout.Write()
     fout.Close()
     del fout
 
+    stats.print_summary()
+    if stats_fname:
+        stats.save(stats_fname)
+
+    if manifest_fname:
+        manifest = load_manifest(manifest_fname)
+        manifest['complete'] = True
+        save_manifest(manifest_fname, manifest)
+    return n_pass, n_tot
+
+def _read_cache(f, tree):
+    """return the read cache of `tree` (None if no cache)"""
+    try:
+        cache = f.GetCacheRead(tree)
+    except TypeError:
+        cache = f.GetCacheRead()
+    if not cache or not hasattr(cache, 'GetEfficiency'):
+        return None
+    return cache
+
+def _cache_efficiency(f, tree):
+    """return the efficiency of the read cache of `tree` (None if no cache)"""
+    cache = _read_cache(f, tree)
+    if cache is None:
+        return None
+    return cache.GetEfficiency()
+
+# bounds of the automatic size of the read caches (bytes)
+_MIN_CACHE_SIZE = 1 * 1024 * 1024
+_MAX_CACHE_SIZE = 256 * 1024 * 1024
+
+def read_cache_size(tree, br_names=None, cache_size=None, margin=1.1):
+    """return the size (in bytes) of the read cache of `tree`: `cache_size`
+    Mb if given, otherwise the compressed size of one cluster of entries of
+    the `br_names` branches (all the active branches if None), within
+    [_MIN_CACHE_SIZE, _MAX_CACHE_SIZE].
+    """
+    if cache_size is not None:
+        return int(cache_size * 1024 * 1024)
+    if br_names is None:
+        br_names = [br.GetName() for br in tree.GetListOfBranches()
+                    if tree.GetBranchStatus(br.GetName())]
+    nentries = tree.GetEntries()
+    if nentries <= 0:
+        return _MIN_CACHE_SIZE
+    zip_bytes = 0
+    for br_name in br_names:
+        br = tree.GetBranch(br_name)
+        if br:
+            zip_bytes += br.GetZipBytes("*")
+    cluster = tree.GetAutoFlush()
+    if cluster > 0:
+        # one cluster of entries of the active branches
+        zip_bytes = zip_bytes * min(cluster, nentries) / float(nentries)
+    elif cluster < 0:
+        # clusters of -cluster (compressed) bytes of all the branches
+        tot_bytes = tree.GetZipBytes() or 1
+        zip_bytes = min(zip_bytes, zip_bytes * -cluster / float(tot_bytes))
+    sz = int(zip_bytes * margin)
+    return max(_MIN_CACHE_SIZE, min(sz, _MAX_CACHE_SIZE))
+
+def setup_read_cache(tree, br_names=None, cache_size=None, learn_entries=100):
+    """configure the TTreeCache of `tree` (see `read_cache_size`, 0 disables
+    the cache): the `br_names` branches are cached, or if None, the branches
+    read during the first `learn_entries` entries.
+    returns the size of the cache.
+    """
+    sz = read_cache_size(tree, br_names, cache_size)
+    if br_names is None and sz > 0:
+        tree.SetCacheLearnEntries(learn_entries)
+    tree.SetCacheSize(sz)
+    if sz <= 0:
+        return 0
+    if br_names is not None:
+        for br_name in br_names:
+            tree.AddBranchToCache(br_name, True)
+        tree.StopCacheLearningPhase()
+    return sz
+
+class Prefetcher(object):
+    """open the `fnames` input files in order, while the next `depth` ones
+    are prefetched in the background: remote files are opened asynchronously
+    (TFile::AsyncOpen) and local files are read ahead into the page cache of
+    the OS by a thread, until about `max_bytes` are read ahead of the files
+    not opened yet.
+    """
+    BLOCK_SIZE = 8 * 1024 * 1024
+    MAX_BYTES = 512 * 1024 * 1024
+
+    def __init__(self, fnames, depth=0, max_bytes=MAX_BYTES):
+        object.__init__(self)
+        self.fnames = list(fnames)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.nprefetched = 0
+        self.bytes_prefetched = 0
+        self._pending = {}
+        self._threads = []
+        self._stop = threading.Event()
+        # the bytes read ahead of the files not opened yet (guarded by _cond)
+        self._in_flight = {}
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _is_remote(fname):
+        return '://' in fname and not fname.startswith('file:')
+
+    def bytes_in_flight(self):
+        with self._cond:
+            return sum(self._in_flight.itervalues())
+
+    def _read_ahead(self, fname):
+        cond = self._cond
+        try:
+            with open(fname, 'rb') as f:
+                while True:
+                    with cond:
+                        # wait for the files read ahead to be opened
+                        while (not self._stop.is_set() and
+                               fname in self._in_flight and
+                               sum(self._in_flight.itervalues()) >=
+                               self.max_bytes):
+                            cond.wait()
+                        if self._stop.is_set() or fname not in self._in_flight:
+                            break
+                    buf = f.read(self.BLOCK_SIZE)
+                    if not buf:
+                        break
+                    with cond:
+                        self.bytes_prefetched += len(buf)
+                        if fname in self._in_flight:
+                            self._in_flight[fname] += len(buf)
+        except (IOError, OSError):
+            pass
+
+    def _prefetch(self, idx):
+        for fname in self.fnames[idx+1:idx+1+self.depth]:
+            if fname in self._pending:
+                continue
+            if self._is_remote(fname):
+                handle = ROOT.TFile.AsyncOpen(fname)
+            else:
+                with self._cond:
+                    self._in_flight[fname] = 0
+                handle = threading.Thread(target=self._read_ahead,
+                                          args=(fname,))
+                handle.daemon = True
+                handle.start()
+                self._threads.append(handle)
+            self._pending[fname] = handle
+
+    def open(self, idx):
+        """open the `idx`-th input file (and prefetch the next ones)"""
+        fname = self.fnames[idx]
+        handle = self._pending.pop(fname, None)
+        with self._cond:
+            # the read-ahead of this file is over: let the next ones proceed
+            if self._in_flight.pop(fname, None) is not None:
+                self._cond.notify_all()
+        if self.depth > 0:
+            self._prefetch(idx)
+        if handle is None:
+            return ROOT.TFile.Open(fname, "READ")
+        self.nprefetched += 1
+        if isinstance(handle, threading.Thread):
+            # the file is (being) read ahead into the page cache
+            return ROOT.TFile.Open(fname, "READ")
+        return ROOT.TFile.Open(handle)
+
+    def close(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        del self._threads[:]
+        for handle in self._pending.itervalues():
+            if not isinstance(handle, threading.Thread):
+                # the asynchronous opens which were never used
+                f = ROOT.TFile.Open(handle)
+                if f:
+                    f.Close()
+        self._pending.clear()
+        self._in_flight.clear()
+
+    pass # class Prefetcher
+
+class ThroughputStats(object):
+    """throughput instrumentation of the event loop of merge_all_trees:
+    per-file and rolling rates of entries and of bytes read and written, the
+    time spent in each phase of the loop and the read-cache efficiencies.
+    """
+    PHASES = ('read', 'select', 'fill', 'flush')
+
+    def __init__(self, nfiles, period=10., n_tot=0, n_pass=0):
+        object.__init__(self)
+        self.nfiles = nfiles
+        self.period = period
+        self.times = dict.fromkeys(self.PHASES, 0.)
+        self.files = []
+        self.n_tot = self.n_tot0 = n_tot
+        self.n_pass = self.n_pass0 = n_pass
+        self.bytes_read = 0 # of the completed files
+        self.start = time.time()
+        self._written0 = ROOT.TFile.GetFileBytesWritten()
+        self._f = None
+        self._tree = None
+        self._cur = None
+        self._last = (self.start, self.n_tot, 0, 0)
+        self._next = self.start + period if period > 0 else None
+
+    def bytes_written(self):
+        return ROOT.TFile.GetFileBytesWritten() - self._written0
+
+    def total_bytes_read(self):
+        nbytes = self.bytes_read
+        if self._f is not None:
+            nbytes += self._f.GetBytesRead()
+        return nbytes
+
+    def begin_file(self, fname, f, tree):
+        self._f = f
+        self._tree = tree
+        self._cur = dict(name=fname,
+                         start=time.time(),
+                         n_tot=self.n_tot,
+                         n_pass=self.n_pass,
+                         bytes_written=self.bytes_written())
+
+    def end_file(self, **extra):
+        """close the record of the current file (with the `extra` infos)"""
+        cur = self._cur
+        f = self._f
+        dt = time.time() - cur['start']
+        nread = f.GetBytesRead()
+        cache = _read_cache(f, self._tree)
+        rec = dict(name=cur['name'],
+                   time=dt,
+                   n_tot=self.n_tot - cur['n_tot'],
+                   n_pass=self.n_pass - cur['n_pass'],
+                   bytes_read=nread,
+                   read_calls=f.GetReadCalls(),
+                   bytes_written=self.bytes_written() - cur['bytes_written'],
+                   cache_size=cache.GetBufferSize() if cache else 0,
+                   cache_efficiency=cache.GetEfficiency() if cache else None,
+                   cache_efficiency_rel=(cache.GetEfficiencyRel()
+                                         if cache else None))
+        rec.update(extra)
+        self.bytes_read += nread
+        self._f = self._tree = self._cur = None
+        self.files.append(rec)
+        dt = dt or 1e-9
+        print ":::   [%s] %i entries in %.1f s: %9.1f evts/s" \
+              " %8.2f Mb/s read %8.2f Mb/s written" % (
+                  os.path.basename(rec['name']), rec['n_tot'], rec['time'],
+                  rec['n_tot'] / dt, rec['bytes_read'] / dt / 1024. / 1024.,
+                  rec['bytes_written'] / dt / 1024. / 1024.)
+        return rec
+
+    def tick(self, n_tot, n_pass):
+        """update the entry counters and print the rolling rates every
+        `period` seconds
+        """
+        self.n_tot = n_tot
+        self.n_pass = n_pass
+        if self._next is None or n_tot & 0xff:
+            return
+        now = time.time()
+        if now < self._next:
+            return
+        self._next = now + self.period
+        nread = self.total_bytes_read()
+        nwritten = self.bytes_written()
+        t0, n0, r0, w0 = self._last
+        self._last = (now, n_tot, nread, nwritten)
+        dt = (now - t0) or 1e-9
+        print ":::   [%i/%i files] %10i entries (%10i accepted):" \
+              " %9.1f evts/s %8.2f Mb/s read %8.2f Mb/s written" % (
+                  len(self.files) + 1, self.nfiles, n_tot, n_pass,
+                  (n_tot - n0) / dt, (nread - r0) / dt / 1024. / 1024.,
+                  (nwritten - w0) / dt / 1024. / 1024.)
+        sys.stdout.flush()
+
+    def summary(self):
+        """return the summary of the throughput, as a dict"""
+        dt = (time.time() - self.start) or 1e-9
+        n_tot = self.n_tot - self.n_tot0
+        nread = self.total_bytes_read()
+        nwritten = self.bytes_written()
+        return dict(time=dt,
+                    n_tot=n_tot,
+                    n_pass=self.n_pass - self.n_pass0,
+                    evts_per_sec=n_tot / dt,
+                    bytes_read=nread,
+                    read_calls=sum(r['read_calls'] for r in self.files),
+                    bytes_written=nwritten,
+                    mb_per_sec_read=nread / dt / 1024. / 1024.,
+                    mb_per_sec_written=nwritten / dt / 1024. / 1024.,
+                    phases=dict(self.times),
+                    files=self.files)
+
+    def print_summary(self):
+        summary = self.summary()
+        dt = summary['time']
+        print "::: throughput:"
+        print ":::   %10i entries in %.1f s: %9.1f evts/s" % (
+            summary['n_tot'], dt, summary['evts_per_sec'])
+        print ":::   read:    %10.3f Mb (%8.2f Mb/s)" % (
+            summary['bytes_read'] / 1024. / 1024., summary['mb_per_sec_read'])
+        print ":::   written: %10.3f Mb (%8.2f Mb/s)" % (
+            summary['bytes_written'] / 1024. / 1024.,
+            summary['mb_per_sec_written'])
+        for phase in self.PHASES:
+            print ":::   time in %-7s %10.3f s (%5.1f%%)" % (
+                phase + ':', self.times[phase],
+                100. * self.times[phase] / dt)
+        ncalls = summary['read_calls']
+        if ncalls:
+            nbytes = sum(r['bytes_read'] for r in self.files)
+            print ":::   read calls: %10i (%8.1f kb/call)" % (
+                ncalls, nbytes / 1024. / ncalls)
+        caches = [r for r in self.files if r['cache_efficiency'] is not None]
+        if caches:
+            n = len(caches)
+            print ":::   cache size: %8.3f Mb (mean over %i files)" % (
+                sum(r['cache_size'] for r in caches) / 1024. / 1024. / n, n)
+            print ":::   cache efficiency: %5.1f%% (relative: %5.1f%%)" % (
+                100. * sum(r['cache_efficiency'] for r in caches) / n,
+                100. * sum(r['cache_efficiency_rel'] for r in caches) / n)
+        return summary
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+        print "::: throughput summary saved into [%s]" % (fname,)
+
+    pass # class ThroughputStats
+
+def merge_throughput_summaries(summaries, dt):
+    """merge the throughput `summaries` (see `ThroughputStats.summary`) of
+    workers running concurrently for `dt` seconds: the counters and the time
+    spent in each phase are summed over the workers, the rates are computed
+    over the `dt` wallclock time.
+    """
+    dt = dt or 1e-9
+    def _sum(k):
+        return sum(s[k] for s in summaries)
+    nread = _sum('bytes_read')
+    nwritten = _sum('bytes_written')
+    phases = dict.fromkeys(ThroughputStats.PHASES, 0.)
+    for s in summaries:
+        for phase, t in s['phases'].iteritems():
+            phases[phase] = phases.get(phase, 0.) + t
+    files = []
+    for s in summaries:
+        files.extend(s['files'])
+    return dict(time=dt,
+                jobs=len(summaries),
+                n_tot=_sum('n_tot'),
+                n_pass=_sum('n_pass'),
+                evts_per_sec=_sum('n_tot') / dt,
+                bytes_read=nread,
+                read_calls=_sum('read_calls'),
+                bytes_written=nwritten,
+                mb_per_sec_read=nread / dt / 1024. / 1024.,
+                mb_per_sec_written=nwritten / dt / 1024. / 1024.,
+                phases=phases,
+                files=files)
+
+def save_manifest(fname, manifest):
+    """write the checkpoint `manifest` (a dict) to the `fname` json file.
+    the manifest holds the completed input files ('done'), the input file
+    being processed when the output file was split ('current', to resume
+    from its 'first_entry'), the current output file ('output',
+    'file_number' of the split files) and its numbers of entries ('entries'
+    since the split, 'tree_entries' of the main tree), the running 'n_pass'
+    and 'n_tot' counters and the names of the output trees ('tree',
+    'other_trees').
+    the file is replaced atomically.
+    """
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_fname, fname)
+    return
+
+def load_manifest(fname):
+    """load a checkpoint manifest written by `save_manifest`"""
+    with open(fname, 'r') as f:
+        manifest = json.load(f)
+    # json gives back unicode strings, ROOT wants str
+    for k in ('tree', 'output'):
+        manifest[k] = str(manifest[k])
+    manifest.setdefault('first_entry', 0)
+    if manifest.get('current') is not None:
+        manifest['current'] = str(manifest['current'])
+    else:
+        manifest['current'] = None
+    for k in ('other_trees', 'done'):
+        manifest[k] = [str(v) for v in manifest[k]]
+    return manifest
+
+def _partial_fnames(oname):
+    """return the files of a (possibly split) output `oname`, in order:
+    foo.root, foo_1.root, foo_2.root, ...
+    """
+    import glob
+    import re
+    base = oname[:-len('.root')]
+    fnames = [oname]
+    pat = re.compile(re.escape(base) + r'_(\d+)\.root$')
+    idx = []
+    for fname in glob.glob(base + '_*.root'):
+        m = pat.match(fname)
+        if m:
+            idx.append((int(m.group(1)), fname))
+    fnames.extend(fname for _, fname in sorted(idx))
+    return [fname for fname in fnames if os.path.exists(fname)]
+
+# the arguments of the merge_all_trees workers, inherited at fork time
+# (the user filter function can not be pickled)
+_worker_args = None
+
+def _merge_worker(igroup):
+    fnames, sfo, kwds, with_stats = _worker_args
+    oname = "%s-%03i.root" % (sfo, igroup)
+    stats_fname = None
+    if with_stats:
+        stats_fname = "%s-%03i.stats.json" % (sfo, igroup)
+    n_pass, n_tot = merge_all_trees(fnames=fnames[igroup], sfo=oname,
+                                    stats_fname=stats_fname, **kwds)
+    return n_pass, n_tot, _partial_fnames(oname), stats_fname
+
+def merge_all_trees_parallel(fnames, tree_name, sfo, jobs, stats_fname=None,
+                             **kwds):
+    """filter the `fnames` input files with `jobs` worker processes running
+    merge_all_trees on contiguous groups of inputs, then merge their partial
+    outputs into `sfo` with a fast (basket-level) copy.
+    the branch selection and basket sizes are computed over all the inputs,
+    so the partial outputs share the same layout.
+    the throughput summaries of the workers are merged (see
+    `merge_throughput_summaries`) and saved as json into `stats_fname`.
+    returns the number of accepted and processed entries.
+    """
+    global _worker_args
+    import multiprocessing
+    import shutil
+    import tempfile
+
+    ngroups = min(jobs, len(fnames))
+    groups = [fnames[i*len(fnames)//ngroups:(i+1)*len(fnames)//ngroups]
+              for i in xrange(ngroups)]
+    workdir = tempfile.mkdtemp(prefix='fm-d3pd-',
+                               dir=os.path.dirname(os.path.abspath(sfo)))
+    branch_sizes = collect_branch_sizes(fnames, tree_name, jobs=jobs)
+    kwds = dict(kwds, tree_name=tree_name, branch_sizes=branch_sizes)
+    _worker_args = (groups, os.path.join(workdir, 'part'), kwds,
+                    bool(stats_fname))
+    print "::: filtering [%i] files in [%i] groups with [%i] jobs..." % (
+        len(fnames), ngroups, jobs)
+    try:
+        start = time.time()
+        pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+        try:
+            results = pool.map(_merge_worker, range(ngroups), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        _worker_args = None
+        n_pass = sum(r[0] for r in results)
+        n_tot  = sum(r[1] for r in results)
+        if stats_fname:
+            summaries = []
+            for r in results:
+                with open(r[3]) as f:
+                    summaries.append(json.load(f))
+            summary = merge_throughput_summaries(summaries,
+                                                 time.time() - start)
+            with open(stats_fname, 'w') as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+            print "::: throughput summary of [%i] jobs saved into [%s]" % (
+                len(summaries), stats_fname)
+        partials = []
+        for r in results:
+            partials.extend(r[2])
+        merge_partial_files(partials, tree_name, sfo)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return n_pass, n_tot
+
+def merge_partial_files(fnames, tree_name, sfo):
+    """merge the partial outputs `fnames` (produced by merge_all_trees) into
+    `sfo` with a fast (basket-level) copy of all their trees.
+    the output file is only changed in between two partial files, to keep
+    the trees synchronized.
+    """
+    oname = sfo[:]
+    if not oname.endswith(".root"):
+        oname = oname + ".root"
+        pass
+
+    root_open = ROOT.TFile.Open
+    fout = root_open(oname, "RECREATE", "", 1)
+    fout.ResetBit(ROOT.kCanDelete)
+    tree_maxsz = ROOT.TTree.GetMaxTreeSize()
+
+    print "::: fast-merging [%i] partial files..." % (len(fnames),)
+    new_trees = []
+    orig_file = None
+    for fname in fnames:
+        f = root_open(fname, "READ")
+        if not new_trees:
+            # main tree first, then the other (payload) trees
+            names = [tree_name]
+            names.extend(n for n in _tree_paths(f) if n != tree_name)
+            for n in names:
+                old_tree = f.Get(n)
+                new_tree = old_tree.CloneTree(0) # no copy of events
+                new_tree.ResetBit(ROOT.kCanDelete)
+                new_tree.SetDirectory(_output_dir(fout, n))
+                old_tree.ResetBranchAddresses()
+                new_tree.ResetBranchAddresses()
+                new_trees.append(new_tree)
+            # keep the file holding the cloned trees alive
+            orig_file = f
+        else:
+            fout = new_trees[0].GetCurrentFile()
+            # the size of the output so far: its baskets are flushed first,
+            # as GetSize() ignores the ones still in memory
+            for t in new_trees:
+                t.FlushBaskets()
+            fsize = os.path.getsize(fname)
+            if (new_trees[0].GetEntries() > 0 and
+                fout.GetEND() + fsize > 0.9 * tree_maxsz):
+                nested_trees = [(n, t) for n, t in zip(names, new_trees)
+                                if '/' in n]
+                fout = _change_file(new_trees[0], fout, nested_trees)
+        for n, new_tree in zip(names, new_trees):
+            tree = f.Get(n)
+            new_tree.CopyEntries(tree, -1, "fast")
+            del tree
+        if f is not orig_file:
+            f.Close()
+        del f
+    print "::: fast-merging [%i] partial files... [done]" % (len(fnames),)
+
+    fout = new_trees[0].GetCurrentFile()
+    fout.Write()
+    fout.Close()
+    del fout
+    if orig_file is not None:
+        orig_file.Close()
     return
 
-def order(m, chain_name, fnames, workdir):
+class OutputStream(object):
+    """one output of `fan_out_trees`, with its own kept branches, GRL and
+    selection, and its own basket optimization and file splitting.
+    """
+    def __init__(self, name, sfo, vars_fname=None, grl_fname=None,
+                 selection=None, grl_mode='union', grl_cache_dir=None):
+        object.__init__(self)
+        self.name = name
+        self.sfo = sfo
+        if not self.sfo.endswith(".root"):
+            self.sfo = self.sfo + ".root"
+        self.vars_fname = vars_fname
+        self.grl = None
+        if grl_fname:
+            from glob import glob
+            grl_fnames = []
+            for fname in grl_fname.split(','):
+                grl_fnames.extend(glob(fname.strip()))
+            self.grl = interpret_grl(fname=grl_fnames, mode=grl_mode,
+                                     cache_dir=grl_cache_dir)
+        self.filter_fct = _load_filter_fct(selection)
+        self.br_names = []
+        self.tree = None
+        self.other_names = []
+        self.other_trees = []
+        self.size_predictor = None
+        self.n_pass = 0
+
+    def selection_branches(self):
+        """the branches needed by the GRL and the selection (None if unknown)"""
+        return _selection_branches(self.filter_fct, self.grl is not None)
+
+    def setup(self, orig_file, orig_tree, other_names, branch_sizes, memory,
+              apply_recursive_opt=True, ordered=False):
+        """create the output file and (optimized) trees, cloned from the
+        `orig_tree` tree and `other_names` trees of `orig_file`
+        """
+        print "::: [%s] output: [%s]" % (self.name, self.sfo)
+        fout = ROOT.TFile.Open(self.sfo, "RECREATE", "", 1)
+        fout.ResetBit(ROOT.kCanDelete)
+
+        orig_tree.SetBranchStatus("*", 1)
+        self.br_names = _kept_branches(orig_tree, self.vars_fname)
+        print "::: [%s] nleaves=[%04i]" % (self.name, len(self.br_names))
+
+        self.tree = orig_tree.CloneTree(0) # no copy of events
+        self.tree.ResetBit(ROOT.kCanDelete)
+        self.tree.SetDirectory(fout)
+        orig_tree.ResetBranchAddresses()
+        self.tree.ResetBranchAddresses()
+        if self.vars_fname is not None:
+            self.tree.SetBranchStatus("*", 0)
+            for br_name in self.br_names:
+                self.tree.SetBranchStatus(br_name, 1)
+
+        self.other_names = list(other_names)
+        for n in other_names:
+            _old_tree = orig_file.Get(n)
+            _new_tree = _old_tree.CloneTree(0) # no copy of events
+            _new_tree.ResetBit(ROOT.kCanDelete)
+            _new_tree.SetDirectory(_output_dir(fout, n))
+            _old_tree.ResetBranchAddresses()
+            _new_tree.ResetBranchAddresses()
+            self.other_trees.append(_new_tree)
+            del _old_tree
+
+        tot_entries, branch_sizes = branch_sizes
+        tot_sz = [branch_sizes.get(br_name, 0) for br_name in self.br_names]
+        baskets = [1]*len(tot_sz)
+        if ordered:
+            basket_sz, baskets, cluster_sz = cluster_baskets(tot_sz,
+                                                             tot_entries,
+                                                             memory)
+            print "::: [%s] entry-ordered clusters of [%i] entries" % (
+                self.name, cluster_sz)
+            for t in [self.tree] + self.other_trees:
+                t.SetAutoFlush(cluster_sz)
+        elif apply_recursive_opt:
+            basket_sz, baskets = optimize_baskets(tot_sz, memory)
+        if apply_recursive_opt or ordered:
+            _set_basket_sizes(self.tree, self.br_names, basket_sz, baskets)
+
+        self.size_predictor = _SizePredictor(0.9 * ROOT.TTree.GetMaxTreeSize())
+        return
+
+    def accept(self, tree):
+        """return whether the current entry of `tree` passes the GRL and the
+        selection of this output
+        """
+        if self.grl is not None:
+            if not self.grl.contains(tree.RunNumber, tree.lbn):
+                return False
+        if self.filter_fct:
+            try:
+                if not self.filter_fct(tree):
+                    return False
+            except Exception, err:
+                print "*** [%s] problem running user filter fct:" % (self.name,)
+                print err
+                print "*** (filter fct is now disabled)"
+                self.filter_fct = None
+        return True
+
+    def fill(self):
+        """fill all the trees of this output, changing file if needed"""
+        fout = self.tree.GetCurrentFile()
+        if self.size_predictor.need_change(fout,
+                                           [self.tree] + self.other_trees):
+            # the split happens before the Fill of all the trees, to keep
+            # them synchronized
+            nested_trees = [(n, t) for n, t in zip(self.other_names,
+                                                   self.other_trees)
+                            if '/' in n]
+            fout = _change_file(self.tree, fout, nested_trees)
+            self.size_predictor.reset()
+        self.tree.Fill()
+        for other_tree in self.other_trees:
+            other_tree.Fill()
+        self.size_predictor.fill()
+        self.n_pass += 1
+
+    def close(self):
+        fout = self.tree.GetCurrentFile()
+        fout.Write()
+        fout.Close()
+        del fout
+
+    pass # class OutputStream
+
+def load_fan_out_config(fname, grl_cache_dir=None):
+    """load the outputs of `fan_out_trees` from the `fname` config file: one
+    section per output, with an 'out' file name and optional 'var', 'grl',
+    'grl-mode' and 'selection' entries (same meaning as the --var, --grl,
+    --grl-mode and --selection options). ex:
+
+    [electrons]
+    out = electrons.root
+    var = el_vars.txt
+    grl = data11_7TeV.xml
+    selection = t.el_n > 0
+
+    raises OSError if the file can not be read, ValueError if it is not a
+    valid config (unknown option, missing or duplicated 'out' file, invalid
+    GRL or selection expression)
+    """
+    import ConfigParser
+    cfg = ConfigParser.RawConfigParser()
+    try:
+        if not cfg.read(os.path.expanduser(os.path.expandvars(fname))):
+            raise OSError("could not read fan-out config file [%s]" %
+                          (fname,))
+    except ConfigParser.Error, err:
+        raise ValueError("could not parse fan-out config file [%s]: %s" %
+                         (fname, err))
+    if not cfg.sections():
+        raise ValueError("no output in fan-out config file [%s]" % (fname,))
+    allowed = ('out', 'var', 'grl', 'grl-mode', 'selection')
+    def get(section, key):
+        if cfg.has_option(section, key):
+            return cfg.get(section, key).strip() or None
+        return None
+    streams = []
+    for section in cfg.sections():
+        unknown = [k for k in cfg.options(section) if k not in allowed]
+        if unknown:
+            raise ValueError("unknown option(s) %s for output [%s] in [%s]"
+                             " (allowed: %s)" % (unknown, section, fname,
+                                                 ', '.join(allowed)))
+        if not get(section, 'out'):
+            raise ValueError("no 'out' file for output [%s] in [%s]" %
+                             (section, fname))
+        try:
+            stream = OutputStream(name=section,
+                                  sfo=get(section, 'out'),
+                                  vars_fname=get(section, 'var'),
+                                  grl_fname=get(section, 'grl'),
+                                  selection=get(section, 'selection'),
+                                  grl_mode=get(section, 'grl-mode') or 'union',
+                                  grl_cache_dir=grl_cache_dir)
+        except (SyntaxError, ValueError, OSError, IOError, ImportError,
+                IndexError), err:
+            # (a bad selection expression or plugin, a bad GRL or GRL mode)
+            raise ValueError("invalid output [%s] in [%s]: %s" %
+                             (section, fname, err))
+        if stream.sfo in [other.sfo for other in streams]:
+            raise ValueError("output [%s] in [%s]: [%s] is already the output"
+                             " file of another output" % (section, fname,
+                                                          stream.sfo))
+        streams.append(stream)
+    return streams
+
+def fan_out_trees(fnames, tree_name, streams, memory,
+                  keep_all_trees=False,
+                  apply_recursive_opt=True,
+                  ordered=False,
+                  jobs=1,
+                  dedup=None,
+                  cache_size=None,
+                  cache_learn=100,
+                  prefetch=0):
+    """filter the trees `tree_name` from the `fnames` input files into the
+    `streams` outputs (OutputStream instances), reading the inputs only once.
+    the input entry is read into the buffers of an in-memory 'address master'
+    tree (holding the union of the kept branches), which the output trees
+    all point at.
+    with `dedup` (an EventSet), the events already in the set are dropped
+    for all the outputs.
+    the read caches and prefetching are configured by `cache_size`,
+    `cache_learn` and `prefetch` (see `merge_all_trees`).
+    returns the number of processed entries.
+    """
+    root_open = ROOT.TFile.Open
+    memory *= 1024 # change to bytes
+
+    branch_sizes = collect_branch_sizes(fnames, tree_name, jobs=jobs)
+
+    orig_file = root_open(fnames[0], "read")
+    orig_tree = getattr(orig_file, tree_name)
+    other_names = []
+    if keep_all_trees:
+        print "::: capturing other trees to filter and merge..."
+        other_names = _payload_tree_names(orig_file, orig_tree, tree_name)
+        print "::: capturing other trees to filter and merge... [done]"
+
+    for stream in streams:
+        stream.setup(orig_file, orig_tree, other_names, branch_sizes, memory,
+                     apply_recursive_opt=apply_recursive_opt,
+                     ordered=ordered)
+
+    # the branches to read: the ones kept by any output and the ones needed
+    # by the selections (all of them if a selection does not declare them)
+    rd_names = set()
+    for stream in streams:
+        rd_names.update(stream.br_names)
+    all_names = [br.GetName() for br in orig_tree.GetListOfBranches()]
+    for stream in streams:
+        sel_names = stream.selection_branches()
+        if sel_names is None:
+            rd_names.update(all_names)
+        else:
+            rd_names.update(n for n in sel_names if n in all_names)
+    if dedup is not None:
+        rd_names.update(['RunNumber', 'EventNumber'])
+    rd_names = sorted(rd_names)
+
+    orig_tree.SetBranchStatus("*", 0)
+    for br_name in rd_names:
+        orig_tree.SetBranchStatus(br_name, 1)
+    master = orig_tree.CloneTree(0)
+    master.ResetBit(ROOT.kCanDelete)
+    master.SetDirectory(0)
+    orig_tree.ResetBranchAddresses()
+    master.ResetBranchAddresses()
+    other_masters = []
+    for n in other_names:
+        _old_tree = orig_file.Get(n)
+        _master = _old_tree.CloneTree(0)
+        _master.ResetBit(ROOT.kCanDelete)
+        _master.SetDirectory(0)
+        _old_tree.ResetBranchAddresses()
+        _master.ResetBranchAddresses()
+        other_masters.append(_master)
+        del _old_tree
+    for stream in streams:
+        master.CopyAddresses(stream.tree)
+        for _master, other_tree in zip(other_masters, stream.other_trees):
+            _master.CopyAddresses(other_tree)
+
+    n_tot = 0
+    prefetcher = Prefetcher(fnames, depth=prefetch)
+    print "::: processing [%i] trees into [%i] outputs..." % (len(fnames),
+                                                             len(streams))
+    # the payload-trees are read into the masters, once for all the outputs
+    payload = PayloadTrees(other_names, other_masters,
+                           cache_size=cache_size, cache_learn=cache_learn)
+    for idx, fname in enumerate(fnames):
+        f = prefetcher.open(idx)
+        tree = getattr(f, tree_name)
+        tree.SetBranchStatus("*", 0)
+        for br_name in rd_names:
+            tree.SetBranchStatus(br_name, 1)
+        master.CopyAddresses(tree)
+        sz = setup_read_cache(tree, rd_names, cache_size=cache_size)
+        print ":::   read cache: %8.3f Mb" % (sz / 1024. / 1024.,)
+        nentries = tree.GetEntries()
+        print ":::   entries:", nentries
+        payload.bind(f, nentries)
+        n_dup = 0
+        for i in xrange(nentries):
+            nb = tree.GetEntry(i)
+            if nb <= 0:
+                print "*** error loading entry [%i]. got (%i) bytes" % (i,nb)
+                raise RuntimeError
+            n_tot += 1
+
+            accepted = [stream for stream in streams if stream.accept(tree)]
+            if not accepted:
+                continue
+            if dedup is not None:
+                if not dedup.add(tree.RunNumber, tree.EventNumber):
+                    n_dup += 1
+                    continue
+            payload.read(i)
+            for stream in accepted:
+                stream.fill()
+            pass # loop over entries
+        if dedup is not None:
+            print ":::   dropped duplicates: %i" % (n_dup,)
+        payload.release()
+        del tree
+        f.Close()
+        del f
+        pass # loop over input trees
+    prefetcher.close()
+    print "::: processing [%i] trees into [%i] outputs... [done]" % (
+        len(fnames), len(streams))
+
+    for stream in streams:
+        eff = 0.
+        if n_tot != 0:
+            eff = float(stream.n_pass)/float(n_tot)
+        print "::: [%s] filter efficiency: %d/%d -> %s" % (
+            stream.name, stream.n_pass, n_tot, eff)
+        stream.close()
+    return n_tot
+
+def order(m, chain_name, fnames, workdir, jobs=1):
+    """re-order the baskets of all the trees of the `fnames` files (with
+    `jobs` processes).
+    returns the I/O volume (bytes read + written)
+    """
 
     # disabling the file-split as it may interfere badly with the re-ordering...
     # set it to 2Tb
     ROOT.TTree.SetMaxTreeSize(2 * 1024 * 1024 * 1024 * 1024)
 
     print "::: nbr of files:", len(fnames)
-    for i,fn in enumerate(fnames):
-
-        timer = ROOT.TStopwatch()
-        timer.Start()
-        print "::: optimizing   [%s]..." % (fn,)
-        #warm_up(fn)
-
-        timer.Start()
-        fin = ROOT.TFile.Open(fn, "read")
-        tmp_fname = "%s_temporary_%03i.root" % (
-            chain_name.replace("/","_").replace(" ","_"),
-            i)
-        fout = ROOT.TFile.Open(tmp_fname, "recreate", "", 6)
-
-        # perform the (re)ordering for all trees
-        _all_tree_names = list(
-            n.GetName()
-            for n in fin.GetListOfKeys()
-            if isinstance(getattr(fin, n.GetName()),
-                          ROOT.TTree))
-        for chain_name in _all_tree_names:
-            tc2 = fin.Get(chain_name)
-            opt = {
-                0: "SortBasketsByOffset",
-                1: "SortBasketsByBranch",
-                2: "SortBasketsByEntry",
-                }.get(m, "SortBasketsByBranch")
-            opt_tree = tc2.CloneTree(-1, opt + " fast")
-            opt_tree.Write("", ROOT.TObject.kOverwrite)
-        # -
-
-        timer.Stop()
-
-        print ":::   wallclock time:", timer.RealTime()
-        print ":::   CPU time:      ", timer.CpuTime()
-
+    args = [(m, chain_name, i, fn, workdir) for i,fn in enumerate(fnames)]
+    if jobs > 1 and len(fnames) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(fnames)))
         try:
-            # fout may have been invalidated if the file-size limit was hit
-            # and _1.root, _2.root,... files were created...
-            if fout:
-                fout.Close()
-        except Exception,err:
-            print "**error**:",err
-        fin.Close()
-
-        dst = os.path.join(workdir, os.path.basename(fn))
-        print "::: optimized as [%s]... [done]" % (dst,)
-        
-        # rename the temporary into the original
-        import shutil
-        shutil.move(src=tmp_fname,
-                    dst=dst)
-                                                    
-        #os.rename(tmp_fname, fn)
-    return
+            io_bytes = pool.map(_order_file, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        io_bytes = map(_order_file, args)
+    return sum(io_bytes)
+
+def _order_file(args):
+    """re-order the file `fn` into `workdir`.
+    returns the I/O volume (bytes read + written)
+    """
+    m, chain_name, i, fn, workdir = args
+
+    timer = ROOT.TStopwatch()
+    timer.Start()
+    print "::: optimizing   [%s]..." % (fn,)
+    #warm_up(fn)
+
+    timer.Start()
+    fin = ROOT.TFile.Open(fn, "read")
+    tmp_fname = "%s_temporary_%03i.root" % (
+        chain_name.replace("/","_").replace(" ","_"),
+        i)
+    fout = ROOT.TFile.Open(tmp_fname, "recreate", "", 6)
+
+    # perform the (re)ordering for all trees
+    # (including the ones of nested directories)
+    _all_tree_names = _tree_paths(fin)
+    for chain_name in _all_tree_names:
+        tc2 = fin.Get(chain_name)
+        opt = {
+            0: "SortBasketsByOffset",
+            1: "SortBasketsByBranch",
+            2: "SortBasketsByEntry",
+            }.get(m, "SortBasketsByBranch")
+        _output_dir(fout, chain_name).cd()
+        opt_tree = tc2.CloneTree(-1, opt + " fast")
+        opt_tree.Write("", ROOT.TObject.kOverwrite)
+    # -
+
+    timer.Stop()
+
+    print ":::   wallclock time:", timer.RealTime()
+    print ":::   CPU time:      ", timer.CpuTime()
+
+    try:
+        # fout may have been invalidated if the file-size limit was hit
+        # and _1.root, _2.root,... files were created...
+        if fout:
+            fout.Close()
+    except Exception,err:
+        print "**error**:",err
+    fin.Close()
+
+    dst = os.path.join(workdir, os.path.basename(fn))
+    print "::: optimized as [%s]... [done]" % (dst,)
+    
+    io_bytes = os.path.getsize(fn) + os.path.getsize(tmp_fname)
+
+    # rename the temporary into the original
+    import shutil
+    shutil.move(src=tmp_fname,
+                dst=dst)
+                                                
+    #os.rename(tmp_fname, fn)
+    return io_bytes
 
 def _load_filter_fct(selection):
     """
@@ -501,13 +2426,126 @@ def _load_filter_fct(selection):
         mod = imp.load_source(plugin.name[:-3], plugin.name, plugin)
         plugin.close()
         filter_fct = inspect.getmembers(mod, plugin_filter)[0][1]
+        # the plugin may declare the branches its filter_fct reads
+        filter_fct.branches = getattr(mod, 'filter_branches', None)
     else:
         fct_code = "filter_fct = lambda t: %s" % selection
         my_locals = dict(locals())
         exec fct_code in {}, my_locals
         filter_fct = my_locals['filter_fct']
+        filter_fct.branches = _expression_branches(selection)
     return filter_fct
 
+def _expression_branches(expr, name='t'):
+    """return the sorted names of the attributes of `name` (the branches of
+    the tree) read by the python expression `expr`, or None if `name` is also
+    used in another way (passed to a function, aliased, ...): the branches it
+    reads are then unknown.
+    """
+    import ast
+    attrs = set()
+    other_uses = []
+    class Visitor(ast.NodeVisitor):
+        def visit_Attribute(self, node):
+            if isinstance(node.value, ast.Name) and node.value.id == name:
+                attrs.add(node.attr)
+            else:
+                self.generic_visit(node)
+        def visit_Name(self, node):
+            if node.id == name:
+                other_uses.append(node)
+    try:
+        Visitor().visit(ast.parse(expr.strip(), mode='eval'))
+    except SyntaxError:
+        return None
+    if other_uses:
+        return None
+    return sorted(attrs)
+
+class _Chunk(dict):
+    """the arrays of a chunk of entries, indexed by branch name, also
+    accessible as attributes (so an expression can read `t.eg_px`)
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+def _load_chunk_filter(selection):
+    """
+    helper function to locate a vectorized filter function or compile one
+    from the source code snippet.
+    the filter function is given a chunk of entries as a dict of numpy
+    arrays (indexed by branch name) and returns the boolean mask of the
+    accepted entries.
+    if `selection` begins with 'file:' selection is then interpreted as a
+    string holding the location to a file where a 'filter_chunk' function and
+    the 'filter_branches' it reads are defined.
+    otherwise, `selection` is compiled into a lambda function (numpy
+    operators must be used: '&', '|', '~' instead of 'and', 'or', 'not')
+    """
+    import imp
+    import os.path as osp
+
+    if not selection:
+        return None
+
+    if selection.startswith('file:'):
+        fname = selection[len('file:'):]
+        fname = osp.expanduser(osp.expandvars(fname))
+        plugin = open(fname, 'r')
+        mod = imp.load_source(plugin.name[:-3], plugin.name, plugin)
+        plugin.close()
+        filter_chunk = getattr(mod, 'filter_chunk', None)
+        if filter_chunk is None:
+            raise RuntimeError("no 'filter_chunk' function in [%s]" % fname)
+        filter_chunk.branches = getattr(mod, 'filter_branches', None)
+        if filter_chunk.branches is None:
+            raise RuntimeError("no 'filter_branches' list in [%s]" % fname)
+    else:
+        fct_code = "filter_chunk = lambda t: %s" % selection
+        my_locals = {}
+        exec fct_code in {'np': np}, my_locals
+        filter_chunk = my_locals['filter_chunk']
+        filter_chunk.branches = _expression_branches(selection)
+        if filter_chunk.branches is None:
+            raise RuntimeError("the branches read by the selection cannot be"
+                               " derived (use 't.<branch>', or a 'file:'"
+                               " plugin declaring 'filter_branches')")
+    return filter_chunk
+
+def _read_chunk(tree, names, start, stop):
+    """read the branches `names` of the entries [start, stop) of `tree` into
+    a _Chunk of numpy arrays, with root_numpy.
+    variable-size branches (std::vector) end up in arrays of arrays.
+    root_numpy resets the addresses of the branches of `tree`: it must not be
+    a tree whose addresses are bound to another one.
+    """
+    chunk = _Chunk()
+    if not names:
+        return chunk
+    data = root_numpy.tree2array(tree, branches=names,
+                                 start=start, stop=stop)
+    for n in names:
+        chunk[n] = data[n]
+    return chunk
+
+def _selection_branches(filter_fct, do_grl_selection):
+    """return the names of the branches needed to evaluate the GRL and the
+    user selection, or None if they are not known.
+    """
+    names = []
+    if do_grl_selection:
+        names.extend(['RunNumber', 'lbn'])
+    if filter_fct:
+        fct_branches = getattr(filter_fct, 'branches', None)
+        if not fct_branches:
+            # unknown (or suspiciously none) for a user selection
+            return None
+        names.extend(fct_branches)
+    return sorted(set(names))
+
 class Options(object):
     """place holder for command line options values"""
     pass
@@ -523,6 +2561,26 @@ def main():
         "selection=",
         "keep-all-trees",
         "disable-recursive-opt",
+        "bench-grl",
+        "two-phase",
+        "batch=",
+        "jobs=",
+        "basket-memory=",
+        "inline-order",
+        "fan-out=",
+        "checkpoint",
+        "resume",
+        "progress=",
+        "stats-json=",
+        "grl-mode=",
+        "grl-cache=",
+        "dedup",
+        "dedup-memory=",
+        "dedup-spill=",
+        "cache-size=",
+        "cache-learn=",
+        "prefetch=",
+        "dry-run",
         "help"
         ]
     _error_msg = """\
@@ -534,8 +2592,14 @@ Accepted command line options:
                                            (except if you pass --keep-all-trees)
      --var=<VARSFNAME>                ...  path to file listing the branch names
                                            to be kept in the output file.
+                                           (+/- glob patterns, or regexes with a 're:'
+                                           prefix. the last matching pattern wins)
      --grl=<GRLFNAME>                 ...  path to a GRL XML file or a list of
                                            comma-separated GRL XML files
+     --grl-mode=<union|intersection>  ...  how several GRL files are combined (default: union)
+     --grl-cache=<DIR>                ...  directory where the compiled GRLs are persisted
+                                           (as json), keyed on the content hash of the GRL
+                                           files. (default: no cache)
  -m, --maxsize=<sz>                   ...  maximum zip size of the main tree (in Mb.)
      --fakeout                        ...  create fake output file if empty or
                                            non valid input tree is found (ease
@@ -552,10 +2616,88 @@ Accepted command line options:
                                             def filter_fct(t):
                                                 return t.eg_px[0] > 10000
                                            NOTE: the function must be named 'filter_fct' and take the tree as a parameter
+                                           foo.py may also declare the branches filter_fct reads:
+                                            filter_branches = ['eg_px']
+     --two-phase                      ...  read the branches needed by the GRL and the
+                                           selection first and the full entry only for
+                                           accepted events. (with a 'file:' selection,
+                                           'filter_branches' must be declared. full
+                                           entries are read when the branches cannot
+                                           be derived or are missing from a file.)
+     --batch=<N>                      ...  evaluate the GRL and the selection by chunks of
+                                           N entries, on numpy arrays of the branches they
+                                           need. (requires numpy and root_numpy.) the
+                                           selection is then vectorized:
+                                             (t.el_n > 0) & (t.RunNumber > 180000)
+                                           or:
+                                            file:foo.py
+                                            where foo.py contains:
+                                            filter_branches = ['el_n']
+                                            def filter_chunk(arrays):
+                                                return arrays['el_n'] > 0
+     --jobs=<N>                       ...  filter the input files with N worker processes
+                                           (each one writing a partial output) and merge
+                                           the partial outputs with a fast basket-level copy.
+                                           (with --fan-out, only the collection of the
+                                           branch sizes is parallelized)
+     --basket-memory=<MB>             ...  memory budget (> 0) for the baskets of the output tree
+                                           (default: 30 Mb)
+     --inline-order                   ...  write the output baskets sorted by entry (by
+                                           flushing clusters of entries) and skip the
+                                           re-ordering pass.
+     --fan-out=<CFGFNAME>             ...  read the inputs once and write several outputs,
+                                           each with its own branches, GRL and selection
+                                           (then -o, --var, --grl and -s are ignored,
+                                           and --batch, --two-phase and --stats-json
+                                           are not supported).
+                                           the config file holds one section per output:
+                                            [electrons]
+                                            out = electrons.root
+                                            var = el_vars.txt
+                                            grl = data11_7TeV.xml
+                                            selection = t.el_n > 0
+     --checkpoint                     ...  save the output trees and a checkpoint manifest
+                                           (<OUTFNAME>.manifest.json) after each input file
+                                           and each split of the output file, so an
+                                           interrupted job can be resumed. the
+                                           manifest is removed once the job completes.
+                                           (not with --jobs, --fan-out or --inline-order)
+     --resume                         ...  resume an interrupted job from its checkpoint
+                                           manifest: the completed input files are skipped
+                                           and the current output file is filled further
+                                           (if it still holds the entries of the checkpoint).
+                                           (implies --checkpoint)
+     --progress=<sec>                 ...  print the rolling throughput every <sec> seconds
+                                           (default: 10. 0 to disable)
+     --stats-json=<FNAME>             ...  save the throughput summary (per-file rates,
+                                           time spent reading, selecting, filling and
+                                           flushing, cache efficiencies) into FNAME.
+                                           with --jobs, the summaries of the workers are
+                                           merged (their phase times are summed)
+     --dedup                          ...  drop the accepted events whose (RunNumber,
+                                           EventNumber) was already written
+     --dedup-memory=<MB>              ...  memory budget of the --dedup event set
+                                           (default: 2048 Mb. only enforced with
+                                           --dedup-spill, a warning is printed otherwise)
+     --dedup-spill=<DIR>              ...  spill the --dedup event set to DIR when over
+                                           its memory budget
+     --cache-size=<MB>                ...  size of the read cache of the input trees
+                                           (default: one cluster of the read branches.
+                                           0 to disable)
+     --cache-learn=<N>                ...  number of entries over which the cached
+                                           branches of the other trees are learnt
+                                           (default: 100)
+     --prefetch=<N>                   ...  prefetch the next N input files in the
+                                           background (default: 0)
+     --dry-run                        ...  print the branches kept by --var (or by the
+                                           fan-out outputs) with their estimated size per
+                                           event, and the unmatched patterns, without
+                                           copying any event
      --keep-all-trees                 ...  keep, filter and merge all other trees.
      --disable-recursive-opt          ...  switch to disable a recursive (size)
                                            optimization. (The recursive optimization
                                            might be excessively SLOW on large n-tuples.)
+     --bench-grl                      ...  run a micro-benchmark of the GRL lookup and exit.
  """
 
     for arg in sys.argv[1:]:
@@ -570,6 +2712,25 @@ Accepted command line options:
     opts.selection = None
     opts.keep_all_trees = False
     opts.apply_recursive_opt = True
+    opts.two_phase = False
+    opts.batch_size = 0
+    opts.jobs = 1
+    opts.basket_memory = 30
+    opts.inline_order = False
+    opts.fan_out = None
+    opts.checkpoint = False
+    opts.resume = False
+    opts.progress = 10.
+    opts.stats_fname = None
+    opts.grl_mode = 'union'
+    opts.grl_cache_dir = None
+    opts.dedup = False
+    opts.dedup_memory = 2048
+    opts.dedup_spill = None
+    opts.cache_size = None
+    opts.cache_learn = 100
+    opts.prefetch = 0
+    opts.dry_run = False
     
     try:
         optlist, args = getopt.getopt(_opts, _useropts, _userlongopts)
@@ -609,21 +2770,110 @@ Accepted command line options:
         elif opt in ('--disable-recursive-opt',):
             opts.apply_recursive_opt = False
             
+        elif opt in ('--two-phase',):
+            opts.two_phase = True
+
+        elif opt in ('--batch',):
+            opts.batch_size = int(arg)
+
+        elif opt in ('--jobs',):
+            opts.jobs = int(arg)
+
+        elif opt in ('--basket-memory',):
+            opts.basket_memory = int(arg)
+
+        elif opt in ('--inline-order',):
+            opts.inline_order = True
+
+        elif opt in ('--fan-out',):
+            opts.fan_out = arg
+
+        elif opt in ('--checkpoint',):
+            opts.checkpoint = True
+
+        elif opt in ('--resume',):
+            opts.resume = True
+            opts.checkpoint = True
+
+        elif opt in ('--progress',):
+            opts.progress = float(arg)
+
+        elif opt in ('--stats-json',):
+            opts.stats_fname = arg
+
+        elif opt in ('--grl-mode',):
+            opts.grl_mode = arg
+
+        elif opt in ('--grl-cache',):
+            opts.grl_cache_dir = arg or None
+
+        elif opt in ('--dedup',):
+            opts.dedup = True
+
+        elif opt in ('--dedup-memory',):
+            opts.dedup_memory = int(arg)
+
+        elif opt in ('--dedup-spill',):
+            opts.dedup_spill = arg
+
+        elif opt in ('--cache-size',):
+            opts.cache_size = float(arg)
+
+        elif opt in ('--cache-learn',):
+            opts.cache_learn = int(arg)
+
+        elif opt in ('--prefetch',):
+            opts.prefetch = int(arg)
+
+        elif opt in ('--dry-run',):
+            opts.dry_run = True
+
+        elif opt in ('--bench-grl',):
+            return bench_grl()
+
         elif opt in ("-h", "--help"):
             print _error_msg
             sys.exit(0)
 
+    if opts.basket_memory <= 0:
+        print "*** invalid --basket-memory [%i] (must be > 0)" % (
+            opts.basket_memory,)
+        return 1
+
     print ":"*80
     print "::: filter'n'merge d3pds"
     print ":::"
     # for AttributeListLayout which uses CINT for its dict...
     #ROOT.gSystem.Load('liblcg_RootCollection')
     
-    workdir = os.path.dirname(opts.output_file)
-    if workdir == '':
-        workdir = '.'
-    if not os.path.exists(workdir):
-        os.makedirs(workdir)
+    streams = []
+    if opts.fan_out:
+        try:
+            streams = load_fan_out_config(opts.fan_out,
+                                          grl_cache_dir=opts.grl_cache_dir)
+        except (OSError, ValueError), err:
+            print "***error*** invalid --fan-out config: %s" % (err,)
+            return 1
+        out_fnames = [stream.sfo for stream in streams]
+        if opts.jobs > 1:
+            print "***warning*** with --fan-out, --jobs only parallelizes" \
+                  " the collection of the branch sizes (the inputs are" \
+                  " filtered by a single process)"
+        for opt, val in (('--batch', opts.batch_size),
+                         ('--two-phase', opts.two_phase),
+                         ('--stats-json', opts.stats_fname)):
+            if val:
+                print "*** %s is not supported with --fan-out" % (opt,)
+                return 1
+    else:
+        out_fnames = [opts.output_file]
+
+    for out_fname in out_fnames:
+        workdir = os.path.dirname(out_fname)
+        if workdir == '':
+            workdir = '.'
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
 
     if isinstance(opts.grl_fname, basestring):
         opts.grl_fname = opts.grl_fname.split(',')
@@ -638,12 +2888,34 @@ Accepted command line options:
     print "::: vars fname:    ",opts.vars_fname
     print "::: tree name:     ",opts.tree_name
     print "::: GRL file:      ",opts.grl_fname
+    print "::: GRL mode:      ",opts.grl_mode
+    print "::: GRL cache:     ",opts.grl_cache_dir
     print "::: max tree sz:   ",opts.maxsize, "Mb"
     if opts.fake_output:
         print "::: creation of fake-output (if needed) [ON]"
     print "::: user filter:   ",opts.selection
     print "::: keep all trees:", opts.keep_all_trees
     print "::: recursive opt: ", opts.apply_recursive_opt
+    print "::: two-phase read:", opts.two_phase
+    print "::: batch size:    ", opts.batch_size
+    print "::: jobs:          ", opts.jobs
+    print "::: basket memory: ", opts.basket_memory, "Mb"
+    print "::: inline order:  ", opts.inline_order
+    print "::: checkpoint:    ", opts.checkpoint
+    print "::: resume:        ", opts.resume
+    print "::: dedup:         ", opts.dedup
+    print "::: read cache:    ", ("auto" if opts.cache_size is None else
+                                  "%s Mb" % (opts.cache_size,))
+    print "::: prefetch:      ", opts.prefetch
+    print "::: dry-run:       ", opts.dry_run
+    if opts.fan_out:
+        print "::: fan-out:       ", opts.fan_out
+        for stream in streams:
+            print ":::   [%s] -> [%s]" % (stream.name, stream.sfo)
+
+    if opts.batch_size and (np is None or root_numpy is None):
+        print "*** --batch requires numpy and root_numpy"
+        return 1
     
     # slightly increase the max size (so that the manual ChangeFile at 0.9 of
     # the current MaxTreeSize will fall within the user-provided one...)
@@ -652,7 +2924,10 @@ Accepted command line options:
     ## try to compile the user filtering function
     filter_fct = None
     try:
-        filter_fct = _load_filter_fct(opts.selection)
+        if opts.batch_size:
+            filter_fct = _load_chunk_filter(opts.selection)
+        else:
+            filter_fct = _load_filter_fct(opts.selection)
     except Exception,err:
         print "*** problem loading filter-fct:"
         print err
@@ -699,7 +2974,8 @@ Accepted command line options:
         print "::: no valid tree left"
         if opts.fake_output:
             print "::: crafting an empty output file"
-            _make_fake_output(opts.output_file, opts.tree_name)
+            for out_fname in out_fnames:
+                _make_fake_output(out_fname, opts.tree_name)
             return 0
         return 0 # FIXME: should this become an error of some sort ?
     
@@ -711,19 +2987,118 @@ Accepted command line options:
         print "::: no input files found"
         return 2
 
+    if opts.dry_run:
+        if streams:
+            for stream in streams:
+                print "::: [%s] output: [%s]" % (stream.name, stream.sfo)
+                if plan_branches(_root_files, opts.tree_name,
+                                 stream.vars_fname) is None:
+                    return 1
+        elif plan_branches(_root_files, opts.tree_name,
+                           opts.vars_fname) is None:
+            return 1
+        print "::: bye."
+        print ":"*80
+        return 0
+
+    dedup = None
+    if opts.dedup:
+        if opts.jobs > 1 and not streams:
+            print "***warning*** --dedup runs over all inputs: --jobs is disabled"
+            opts.jobs = 1
+        dedup = EventSet(max_memory=opts.dedup_memory * 1024 * 1024,
+                         spill_dir=opts.dedup_spill)
+
+    manifest_fname = None
+    resume = None
+    if opts.checkpoint and opts.inline_order:
+        # the checkpoints flush the baskets in the middle of the clusters
+        print "*** --checkpoint is not supported with --inline-order"
+        return 1
+    if opts.checkpoint and not streams and opts.jobs <= 1:
+        manifest_fname = os.path.splitext(opts.output_file)[0] + '.manifest.json'
+        if opts.resume and os.path.exists(manifest_fname):
+            resume = load_manifest(manifest_fname)
+            done = resume['done']
+            current = resume['current']
+            if (done != _root_files[:len(done)] or
+                (current is not None and
+                 _root_files[len(done):len(done)+1] != [current])):
+                print "*** the input files do not match the ones of [%s]" % (
+                    manifest_fname,)
+                return 1
+            print "::: resuming: [%i/%i] input files already done" % (
+                len(done), nfiles)
+        elif opts.resume:
+            print "***warning*** no manifest [%s] to resume from" % (
+                manifest_fname,)
+    elif opts.checkpoint:
+        print "***warning*** --checkpoint and --resume are not supported" \
+              " with --jobs or --fan-out"
+
     timer = ROOT.TStopwatch()
     timer.Start()
-    merge_all_trees(fnames=_root_files,
-                    tree_name =opts.tree_name,
-                    memory=1024*30,
-                    sfo=opts.output_file,
-                    vars_fname=opts.vars_fname,
-                    grl_fname=opts.grl_fname,
-                    filter_fct=filter_fct,
-                    keep_all_trees=opts.keep_all_trees,
-                    apply_recursive_opt=opts.apply_recursive_opt)
+    merge_kwds = dict(memory=opts.basket_memory*1024,
+                      vars_fname=opts.vars_fname,
+                      grl_fname=opts.grl_fname,
+                      filter_fct=filter_fct,
+                      keep_all_trees=opts.keep_all_trees,
+                      apply_recursive_opt=opts.apply_recursive_opt,
+                      two_phase=opts.two_phase,
+                      batch_size=opts.batch_size,
+                      ordered=opts.inline_order,
+                      progress=opts.progress,
+                      grl_mode=opts.grl_mode,
+                      grl_cache_dir=opts.grl_cache_dir,
+                      cache_size=opts.cache_size,
+                      cache_learn=opts.cache_learn,
+                      prefetch=opts.prefetch)
+    if streams:
+        fan_out_trees(fnames=_root_files,
+                      tree_name=opts.tree_name,
+                      streams=streams,
+                      memory=opts.basket_memory*1024,
+                      keep_all_trees=opts.keep_all_trees,
+                      apply_recursive_opt=opts.apply_recursive_opt,
+                      ordered=opts.inline_order,
+                      jobs=opts.jobs,
+                      dedup=dedup,
+                      cache_size=opts.cache_size,
+                      cache_learn=opts.cache_learn,
+                      prefetch=opts.prefetch)
+    elif opts.jobs > 1 and nfiles > 1:
+        merge_all_trees_parallel(fnames=_root_files,
+                                 tree_name=opts.tree_name,
+                                 sfo=opts.output_file,
+                                 jobs=opts.jobs,
+                                 stats_fname=opts.stats_fname,
+                                 **merge_kwds)
+    elif resume is not None and (resume['complete'] or
+                                 len(resume['done']) == nfiles):
+        # (the output trees were saved at the last checkpoint)
+        print "::: nothing left to merge"
+        if not resume['complete']:
+            # the job stopped before closing its output file: close it now
+            fout = ROOT.TFile.Open(resume['output'], "UPDATE")
+            fout.Close()
+            del fout
+    else:
+        fnames = _root_files
+        if resume is not None:
+            fnames = _root_files[len(resume['done']):]
+        merge_all_trees(fnames=fnames,
+                        tree_name =opts.tree_name,
+                        sfo=opts.output_file,
+                        jobs=opts.jobs,
+                        manifest_fname=manifest_fname,
+                        resume=resume,
+                        stats_fname=opts.stats_fname,
+                        dedup=dedup,
+                        **merge_kwds)
 
     timer.Stop()
+    if dedup is not None:
+        dedup.clear()
 
     print "::: merging done in:"
     print ":::   wallclock:",timer.RealTime()
@@ -731,17 +3106,33 @@ Accepted command line options:
 
     # del _root_chains[:]
     
-    print "::: performing re-ordering..."
-    import glob
     import os.path as osp
-    fname_pattern = osp.splitext(opts.output_file)[0]
-    # re-order all output files (in case they were split off)
-    fnames= sorted(glob.glob(fname_pattern + "*.root"))
-    order(m=2,
-          chain_name=opts.tree_name,
-          fnames=fnames,
-          workdir=workdir)
-    print "::: performing re-ordering... [done]"
+    for out_fname in out_fnames:
+        workdir = osp.dirname(out_fname) or '.'
+        if not out_fname.endswith('.root'):
+            out_fname = out_fname + '.root'
+        # only the files of this output: foo.root, foo_1.root,... (and not
+        # the ones of another output named foo_mu.root)
+        fnames = _partial_fnames(out_fname)
+        if opts.inline_order:
+            # a re-ordering pass would have read and written all output files
+            io_bytes = 2 * sum(os.path.getsize(fn) for fn in fnames)
+            print "::: re-ordering skipped (output written sorted by entry)"
+            print ":::   I/O saved: %8.3f Mb" % (io_bytes / 1024. / 1024.,)
+        else:
+            print "::: performing re-ordering..."
+            # re-order all output files (in case they were split off)
+            io_bytes = order(m=2,
+                             chain_name=opts.tree_name,
+                             fnames=fnames,
+                             workdir=workdir,
+                             jobs=opts.jobs)
+            print ":::   I/O: %8.3f Mb" % (io_bytes / 1024. / 1024.,)
+            print "::: performing re-ordering... [done]"
+
+    if manifest_fname and os.path.exists(manifest_fname):
+        # the job is complete: nothing to resume
+        os.remove(manifest_fname)
 
     print "::: bye."
     print ":"*80
@@ -907,49 +3298,7 @@ def extract_data_from_xml(fname="GRL.xml"):
     """simple helper function to convert a GRL xml file into a list
     of tuples (run-nbr, lumi-block-start, lumi-block-stop)
     """
-    import sys
-    assert "xml.etree" in sys.modules, \
-           "no 'xml.etree' module were imported/available"
-    data =[]
-    dd=xml2dict(etree.ElementTree.parse(str(fname)).getroot())
-
-    lbks = dd['LumiRangeCollection']['NamedLumiRange']['LumiBlockCollection']
-    if not isinstance(lbks, (list, tuple)):
-        lbks = [lbks]
-    for lbk in lbks:
-        assert isinstance(lbk,dict), \
-               "expect a dict-like object (got type=%s - value=%r)" % (type(lbk), repr(lbk))
-        runnumber=lbk['Run']
-        run_ranges=lbk['LBRange']
-
-        #xml2dict return a dataset when only one lbn range per run
-        #and return a list when there are several lbn ranges per run
-        #==> need different piece of code
-        #The following lines 'convert' a dict into a list of 1 dict 
-        if isinstance(run_ranges,dict):
-            run_ranges=[run_ranges]
-            pass
-
-        #loop over run ranges
-        for lbrange in run_ranges: 
-            lbn_min=lbrange['Start']
-            lbn_max=lbrange['End']
-            # GRL schema changed from:
-            #  <LumiBlockCollection>
-            #     <Run>178044</Run>
-            #     <LBRange Start="42" End="666"/>
-            #    ...
-            # to:
-            #  <LumiBlockCollection>
-            #     <Run PrescaleRD0="8" PrescaleRD1="8">178044</Run>
-            #     <LBRange Start="42" End="666"/>
-            #    ...
-            if isinstance(runnumber, XmlDictObject):
-                runnumber = runnumber['_text']
-            #print runnumber,"  ", lbn_min,"  ", lbn_max
-            data.append((runnumber, lbn_min, lbn_max))
-            pass
-    return data
+    return list(iterparse_grl(fname))
 
 ### script entry point ###
 if __name__ == "__main__":
@@ -977,4 +3326,7 @@ def filter_fct(t):
     return t.el_verty.size() > 0 and t.el_verty[0]>=0.
 EOF
 filter-and-merge-d3pd -i input.txt -o merged.root -t egamma --var=vars.txt -s 'file:foo.py'
+filter-and-merge-d3pd -i input.txt -o merged.root -t egamma --var=vars.txt --batch=10000 -s 't.el_n > 0'
+echo '-re:el_vert[xy]' >> vars.txt
+filter-and-merge-d3pd -i input.txt -o merged.root -t egamma --var=vars.txt --dry-run
 """
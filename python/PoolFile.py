@@ -15,8 +15,13 @@ __all__ = [
     'PoolOpts',
     'extract_items',
     'PoolRecord',
+    'EventSizeProfile',
+    'CompressionRecord',
     'PoolFile',
     'DiffFiles',
+    'Counter',
+    'BreakDown',
+    'load_categories',
     
     'merge_pool_files',
     ]
@@ -404,6 +409,26 @@ class PoolOpts(object):
     META_DATA   = "MetaData"
     HDR_FORMAT  = "  %11s     %11s     %11s      %11s  %5s  %s"
     ROW_FORMAT  = "%12.3f kb %12.3f kb %12.3f kb %12.3f %8i  %s"
+    NA_ROW_FORMAT = "%12s    %12.3f kb %12.3f kb %12.3f %8i  %s"
+    EVT_HDR_FORMAT = "%12s %12s %12s %12s %12s  %s"
+    EVT_ROW_FORMAT = "%9.3f kb %9.3f kb %9.3f kb %9.3f kb %9.3f kb  %s"
+    WHAT_IF_CODECS = ('zlib:1', 'zlib:6', 'zlib:9', 'lzma:6', 'bz2:9')
+    # the default categories of PoolFile.printBreakDown (first match wins)
+    BREAKDOWN_CATEGORIES = (
+        ('DataHeader', [('DataHeader', None)]),
+        ('EventInfo',  [('EventInfo', None), ('EventStreamInfo', None),
+                        ('PileUpEventInfo', None)]),
+        ('Trigger',    [r'Trig.*', r'HLT.*', r'LVL1.*', r'CTP_.*',
+                        r'.*TrigDecision.*']),
+        ('Truth',      [r'.*Truth.*', r'McEventCollection.*']),
+        ('Tracking',   [r'Trk.*', r'InDet.*', r'.*Track.*', r'Vx.*']),
+        ('Calo',       [r'Calo.*', r'.*CaloCluster.*', r'LAr.*', r'Tile.*']),
+        ('egamma',     [r'egamma.*', r'Electron.*', r'Photon.*',
+                        r'.*egDetail.*']),
+        ('Muon',       [r'.*Muon.*', r'Mdt.*', r'Rpc.*', r'Tgc.*', r'Csc.*']),
+        ('Tau',        [r'.*Tau.*']),
+        ('Jet/MET',    [r'.*Jet.*', r'.*MissingET.*', r'MET.*']),
+        )
 
     @classmethod
     def isData(cls, name):
@@ -455,6 +480,113 @@ def retrieveBranchInfos( branch, poolRecord, ident = "" ):
         
     return poolRecord
 
+def _fill_entry_sizes (branch, memSizes, diskSizes):
+    """accumulate into `memSizes` and `diskSizes` (indexed by entry number)
+    the per-entry sizes (in kb) of `branch` and of all its sub-branches.
+    The on-disk size of a basket (GetBasketBytes) is shared among its entries
+    (GetBasketEntry), in proportion of their uncompressed size.
+    Entries of fixed-size branches all have the same uncompressed size: no
+    basket is read for them.
+    The entry-offset table of a variable-size branch is stored inside its
+    (compressed) basket record: those baskets are read and unzipped to get
+    it, but their payload is never streamed.
+    """
+    nentries = len(memSizes)
+    nbaskets = branch.GetWriteBasket()
+    if nbaskets > 0:
+        basketEntry = branch.GetBasketEntry()
+        basketBytes = branch.GetBasketBytes()
+        fixedSize = branch.GetEntryOffsetLen() <= 0
+        entrySize = 0.
+        if fixedSize and branch.GetEntries() > 0:
+            entrySize = branch.GetTotBytes() / float(branch.GetEntries())
+        for ibasket in xrange(nbaskets):
+            first = basketEntry[ibasket]
+            if fixedSize:
+                nev = basketEntry[ibasket+1] - first
+                if nev <= 0 or entrySize <= 0:
+                    # (no entry, or no size to share the basket among them)
+                    continue
+                sizes = [ entrySize ] * nev
+                zipRatio = basketBytes[ibasket] / (entrySize * nev)
+            else:
+                basket = branch.GetBasket(ibasket)
+                if not basket:
+                    continue
+                nev     = basket.GetNevBuf()
+                payload = basket.GetLast() - basket.GetKeylen()
+                if nev <= 0 or payload <= 0:
+                    continue
+                offsets = basket.GetEntryOffset()
+                sizes = [ offsets[i+1] - offsets[i] for i in xrange(nev-1) ]
+                sizes.append( basket.GetLast() - offsets[nev-1] )
+                zipRatio = basketBytes[ibasket] / float(payload)
+            for i,sz in enumerate(sizes):
+                ientry = first + i
+                if ientry >= nentries:
+                    break
+                memSizes [ientry] += sz / Units.kb
+                diskSizes[ientry] += sz * zipRatio / Units.kb
+            pass # loop over baskets
+        if not fixedSize:
+            branch.DropBaskets("all")
+
+    for b in branch.GetListOfBranches():
+        _fill_entry_sizes (b, memSizes, diskSizes)
+    return
+
+def _iter_branches (branches):
+    """yield all the `branches` and (recursively) all their sub-branches"""
+    for br in branches:
+        yield br
+        for sub in _iter_branches (br.GetListOfBranches()):
+            yield sub
+
+def _get_codec (spec):
+    """return the (compress, decompress) functions of a codec, given its
+    specification 'name:level' (ex: 'zlib:6', 'bz2:9', 'lzma:6')
+    """
+    name, _, level = spec.partition(':')
+    if name not in ('zlib', 'bz2', 'lzma'):
+        raise ValueError("unknown codec [%s] (allowed: zlib, bz2, lzma)" % spec)
+    if level:
+        lo = 1 if name == 'bz2' else 0
+        if not level.isdigit() or not lo <= int(level) <= 9:
+            raise ValueError("invalid level of codec [%s] (allowed: %i-9)" %
+                             (spec, lo))
+    if name == 'zlib':
+        import zlib
+        level = int(level or 6)
+        return (lambda s: zlib.compress(s, level)), zlib.decompress
+    if name == 'bz2':
+        import bz2
+        level = int(level or 9)
+        return (lambda s: bz2.compress(s, level)), bz2.decompress
+    if name == 'lzma':
+        try:
+            import lzma
+        except ImportError:
+            from backports import lzma
+        level = int(level or 6)
+        return (lambda s: lzma.compress(s, preset=level)), lzma.decompress
+
+def _recompress_payload (args):
+    """re-compress a basket payload with each of the codecs.
+    returns the index of the container, the size of the payload and the list
+    of (zipped size, decompression time) pairs, one per codec.
+    Note: this function is executed in a worker process
+    """
+    idx, payload, codecs = args
+    from timeit import default_timer as clock
+    results = []
+    for spec in codecs:
+        compress, decompress = _get_codec (spec)
+        zipped = compress (payload)
+        start = clock()
+        decompress (zipped)
+        results.append ((len(zipped), clock() - start))
+    return idx, len(payload), results
+
 def make_pool_record (branch, dirType):
     memSize = _get_total_size (branch) / Units.kb
     zipBytes = branch.GetZipBytes()
@@ -518,6 +650,109 @@ class PoolRecord(object):
         self.details       = detailedInfos
         return
 
+class EventSizeProfile(object):
+    """
+    The distribution of the per-event sizes (in kb) of a POOL container.
+    `kind` selects the uncompressed ('mem') or the compressed ('disk') sizes.
+    """
+    Kinds = ('mem', 'disk')
+
+    def __init__(self, name, memSizes, diskSizes, dirType):
+        object.__init__(self)
+        self.name      = name
+        self.memSizes  = memSizes
+        self.diskSizes = diskSizes
+        self.dirType   = dirType
+        self._sorted   = {}
+        return
+
+    @property
+    def nEntries(self):
+        return len(self.memSizes)
+
+    def sizes(self, kind='disk'):
+        if not kind in EventSizeProfile.Kinds:
+            raise ValueError("invalid kind [%s] (allowed values: %r)" %
+                             (kind, EventSizeProfile.Kinds))
+        return self.memSizes if kind == 'mem' else self.diskSizes
+
+    def sortedSizes(self, kind='disk'):
+        if not kind in self._sorted:
+            self._sorted[kind] = sorted(self.sizes(kind))
+        return self._sorted[kind]
+
+    def mean(self, kind='disk'):
+        if self.nEntries == 0:
+            return 0.
+        return sum(self.sizes(kind)) / float(self.nEntries)
+
+    def percentile(self, q, kind='disk'):
+        """return the `q`-th percentile (0 <= q <= 100) of the per-event sizes
+        (nearest-rank method: the smallest size such that at least `q` percent
+        of the events are not larger)
+        """
+        import math
+        data = self.sortedSizes(kind)
+        if len(data) == 0:
+            return 0.
+        rank = int(math.ceil(q * len(data) / 100.))
+        return data[max(0, min(rank-1, len(data)-1))]
+
+    def histogram(self, nbins=20, kind='disk'):
+        """return the bin edges and the contents of a `nbins` histogram of the
+        per-event sizes, spanning the [min,max] range
+        """
+        data = self.sortedSizes(kind)
+        counts = [0] * nbins
+        if len(data) == 0:
+            return [0.]*(nbins+1), counts
+        lo, hi = data[0], data[-1]
+        width = (hi - lo) / float(nbins) or 1.
+        edges = [ lo + i*width for i in xrange(nbins+1) ]
+        for sz in data:
+            counts[min(int((sz - lo) / width), nbins-1)] += 1
+        return edges, counts
+
+    def largest(self, n=5, kind='disk'):
+        """return the `n` largest events as a list of (entry, size) pairs"""
+        import heapq
+        import operator
+        return heapq.nlargest(n, enumerate(self.sizes(kind)),
+                              key=operator.itemgetter(1))
+
+    pass # class EventSizeProfile
+
+class CompressionRecord(object):
+    """
+    The outcome of a compression what-if analysis for a POOL container:
+    sizes of a sample of its baskets, once re-compressed with each codec, and
+    the time it took to decompress them.
+    """
+    def __init__(self, name, dirType, diskSize, codecs):
+        object.__init__(self)
+        self.name          = name
+        self.dirType       = dirType
+        self.diskSize      = diskSize # current on-disk size (kb)
+        self.sampleSize    = 0        # uncompressed size of the sample (bytes)
+        self.sampleZipSize = 0        # current on-disk size of the sample
+        self.zipSizes      = dict((c, 0)  for c in codecs)
+        self.unzipTimes    = dict((c, 0.) for c in codecs)
+        return
+
+    def projectedDiskSize(self, codec):
+        """projected on-disk size (kb) of the container with `codec`"""
+        if self.sampleZipSize <= 0:
+            return self.diskSize
+        return self.diskSize * self.zipSizes[codec] / float(self.sampleZipSize)
+
+    def unzipThroughput(self, codec):
+        """decompression throughput (Mb/s, uncompressed) with `codec`"""
+        if self.unzipTimes[codec] <= 0.:
+            return 0.
+        return self.sampleSize / Units.Mb / self.unzipTimes[codec]
+
+    pass # class CompressionRecord
+
 class PoolFile(object):
     """
     A simple class to retrieve informations about the content of a POOL file.
@@ -536,6 +771,8 @@ class PoolFile(object):
                                      nEntries = 0,
                                      dirType = "T")
         self.data       = []
+        self._index     = None
+        self._indexed   = None # the records of self._index
         self.verbose = verbose
 
         # get the "final" file name (handles all kind of protocols)
@@ -839,15 +1076,28 @@ class PoolFile(object):
             pass
         return
 
+    def index(self):
+        """
+        Return a dict of PoolRecords indexed by their (branch) name
+        (rebuilt whenever a record of `self.data` was added, removed or
+        replaced since the last call)
+        """
+        index = getattr(self, '_index', None)
+        if index is None or getattr(self, '_indexed', None) != self.data:
+            index = dict( (d.name, d) for d in self.data )
+            self._index = index
+            self._indexed = list(self.data)
+        return index
+
     def poolRecord(self, name):
         """
         Return a PoolRecord according to its (branch) name
         Raise KeyError if no match is found
         """
-        for data in self.data:
-            if data.name == name:
-                return data
-        raise KeyError, "No PoolRecord with name [%s]" % name
+        try:
+            return self.index()[name]
+        except KeyError:
+            raise KeyError, "No PoolRecord with name [%s]" % name
 
     def saveReport (self, fileName):
         """
@@ -906,45 +1156,274 @@ class PoolFile(object):
                for d in self.data ])
         return
 
-    def printBreakDown(self, categories=None):
+    def _eventContainers(self):
         """
-        Print out the sizes of containers broken-down by categories.
-        Categories is supposed to be a list of item-lists, an item list being
-        a list of pairs (class-name, storegate-key)
+        Yield the (name, dirType, branches, nEntries) tuples describing the
+        event data containers of the (opened) POOL file.
         """
+        for key in self.keys:
+            tree = key.ReadObj()
+            name = tree.GetName()
+            if not hasattr(tree, 'GetListOfBranches'):
+                continue
 
-        def parse( data, klass, key ):
-            import re
-            # pattern to match 'CppClassName_pX_MyKey'
-            # eg: EventInfo_p2_McEventInfo
-            #     TauDetailsContainer_tlp1
-            tp_pattern = re.compile(r'(?P<ClassName>.*?)_(?P<Vers>(tlp|p)[0-9])((?P<SgKey>_.*)|)')
+            if PoolOpts.isDataHeader(name):
+                if name == PoolOpts.POOL_HEADER:
+                    contName = "DataHeader"
+                else:
+                    contName = name.replace(PoolOpts.POOL_HEADER+"_", "")
+                yield contName, "T", list(tree.GetListOfBranches()), \
+                      int(tree.GetEntries())
+            elif PoolOpts.isData(name) and name != PoolOpts.META_DATA:
+                dirType = "T"
+                if name == PoolOpts.EVENT_DATA:
+                    dirType = "B"
+                for br in tree.GetListOfBranches():
+                    yield br.GetName(), dirType, [br], int(tree.GetEntries())
+            pass # loop over keys
+        return
 
-            hint_pattern = re.compile(
-                r'%s(_(tlp|p)[0-9]|)_%s' % ( klass, key )
+    def eventSizes(self, names=None):
+        """
+        Compute the per-event size distributions of the event data containers
+        (a list of EventSizeProfile).
+        Only the basket and entry-offset informations are used: the payload
+        of the containers is never streamed.
+        @param `names` restricts the analysis to the given container names
+        """
+        if self.poolFile == None or \
+           self.keys     == None:
+            print "Can't compute per-event sizes with a shelve file as input !"
+            return []
+
+        from array import array
+        profiles = []
+        for contName, dirType, branches, nEntries in self._eventContainers():
+            if names is not None and contName not in names:
+                continue
+            memSizes  = array('d', [0.]) * nEntries
+            diskSizes = array('d', [0.]) * nEntries
+            for br in branches:
+                _fill_entry_sizes (br, memSizes, diskSizes)
+            profiles.append (EventSizeProfile(contName,
+                                              memSizes, diskSizes,
+                                              dirType))
+        return profiles
+
+    def printEventSizes(self, profiles, kind='disk', ntop=3):
+        """
+        Print out the per-event size distributions of the containers.
+        """
+        import operator
+        profiles = sorted(profiles, key=operator.methodcaller('mean', kind))
+        print ""
+        print "="*80
+        print PoolOpts.EVT_HDR_FORMAT % ("Mean/Evt", "Median", "90%", "99%",
+                                         "Max", "(X) Container Name (X=Tree|Branch)")
+        print "="*80
+        for p in profiles:
+            print PoolOpts.EVT_ROW_FORMAT % (
+                p.mean(kind),
+                p.percentile(50, kind),
+                p.percentile(90, kind),
+                p.percentile(99, kind),
+                p.percentile(100, kind),
+                "("+p.dirType+") "+p.name
                 )
-            return re.match( hint_pattern, data )
-            
-            className = None
-            sgKey     = None
-            pat = re.match(tp_pattern, data)
-            if pat:
-                className = pat.group("ClassName")
-                sgKey     = pat.group("SgKey")
-                if sgKey == str(None): sgKey = '*'
-                if len(sgKey)>0 and sgKey[0] == '_': sgKey = sgKey[1:]
-                return (className, sgKey)
-            else:
-                return (data,'')
+            if ntop > 0:
+                print "%s largest: %s" % (" "*8, ", ".join(
+                    [ "#%i (%.3f kb)" % (ientry, sz)
+                      for ientry, sz in p.largest(ntop, kind) ]))
+        print "="*80
+        print "::: per-event sizes: [%s] (in kb)" % kind
+        return
 
-        for cat in categories:
-            for d in self.data:
-                item = parse( d.name, cat.className, cat.key )
-                #print ": [%s/%s]" % (className, sgKey),
-            #for cat in categories:
-                
+    def saveEventSizeReport(self, fileName, profiles, nbins=20, ntop=5):
+        """
+        Save the per-event size distributions into a (columnar) CSV file:
+        one row per container and kind of size ('mem' or 'disk').
+        The histogram contents and the largest events are stored as
+        ';'-separated lists (resp. of counts and of 'entry:size' pairs)
+        """
+        import csv, os
+        if os.path.exists (fileName):
+            os.unlink (fileName)
+        o = csv.writer (open (fileName, 'w'))
+        o.writerow (['container name', 'branch type', 'items', 'kind',
+                     'mean', 'p50', 'p90', 'p99', 'max',
+                     'hist min', 'hist max', 'hist counts', 'largest'])
+        for p in profiles:
+            for kind in EventSizeProfile.Kinds:
+                edges, counts = p.histogram(nbins, kind)
+                o.writerow ([
+                    p.name, p.dirType, p.nEntries, kind,
+                    "%.3f" % p.mean(kind),
+                    "%.3f" % p.percentile(50, kind),
+                    "%.3f" % p.percentile(90, kind),
+                    "%.3f" % p.percentile(99, kind),
+                    "%.3f" % p.percentile(100, kind),
+                    "%.3f" % edges[0], "%.3f" % edges[-1],
+                    ";".join(map(str, counts)),
+                    ";".join([ "%i:%.3f" % (ientry, sz)
+                               for ientry, sz in p.largest(ntop, kind) ]),
+                    ])
+        return
+
+    def compressionWhatIf(self, codecs=None, nbaskets=5, nprocs=None,
+                          names=None):
+        """
+        Estimate the on-disk size and the decompression throughput of each
+        event data container with other compression settings, without
+        rewriting the file.
+        `nbaskets` baskets per branch are sampled, unzipped and re-compressed
+        with each of the `codecs` (default: PoolOpts.WHAT_IF_CODECS) in
+        `nprocs` worker processes.
+        Returns a list of CompressionRecord.
+        """
+        if self.poolFile == None or \
+           self.keys     == None:
+            print "Can't perform a compression what-if with a shelve file as input !"
+            return []
+
+        if codecs is None:
+            codecs = PoolOpts.WHAT_IF_CODECS
+        _codecs = []
+        for c in codecs:
+            try:
+                _get_codec (c)
+                _codecs.append (c)
+            except ImportError, err:
+                print "## warning: discarding codec [%s] (%s)" % (c, err)
+        codecs = tuple(_codecs)
+
+        import multiprocessing
+        import PyUtils.RootUtils as ru
+
+        records = []
+        def process(samples):
+            for idx, sz, results in workers.imap_unordered(_recompress_payload,
+                                                           samples):
+                rec = records[idx]
+                rec.sampleSize += sz
+                for c, (zipSize, unzipTime) in zip(codecs, results):
+                    rec.zipSizes[c]   += zipSize
+                    rec.unzipTimes[c] += unzipTime
+            del samples[:]
+
+        # do not hold more than that many bytes of payloads in memory
+        maxSampleSize = 64 * Units.Mb
+
+        workers = multiprocessing.Pool(nprocs)
+        try:
+            samples = []
+            sampleSize = 0
+            for contName, dirType, branches, _ in self._eventContainers():
+                if names is not None and contName not in names:
+                    continue
+                rec = CompressionRecord(
+                    contName, dirType,
+                    sum(br.GetZipBytes("*") for br in branches) / Units.kb,
+                    codecs)
+                records.append (rec)
+                for br in _iter_branches (branches):
+                    n = br.GetWriteBasket()
+                    if n <= 0:
+                        continue
+                    k = min(n, nbaskets)
+                    basketBytes = br.GetBasketBytes()
+                    for ibasket in sorted(set(i*n//k for i in xrange(k))):
+                        payload = ru.basket_payload (br, ibasket)
+                        if not payload:
+                            continue
+                        rec.sampleZipSize += basketBytes[ibasket] - \
+                                             br.GetBasket(ibasket).GetKeylen()
+                        samples.append ((len(records)-1, payload, codecs))
+                        sampleSize += len(payload)
+                    br.DropBaskets("all")
+                    if sampleSize > maxSampleSize:
+                        process (samples)
+                        sampleSize = 0
+                pass # loop over containers
+            process (samples)
+        finally:
+            workers.close()
+            workers.join()
+        return records
+
+    def printCompressionWhatIf(self, records):
+        """
+        Print out the outcome of a compression what-if analysis.
+        """
+        if len(records) == 0:
+            return
+        codecs = sorted(records[0].zipSizes.keys())
+        import operator
+        records = sorted(records, key=operator.attrgetter('diskSize'))
+        print ""
+        print "="*80
+        print "%12s     %s" % ("Disk Size", "(X) Container Name (X=Tree|Branch)")
+        print "%12s     %-8s %12s     %8s   %10s" % (
+            "", "codec", "projected", "ratio", "unzip")
+        print "="*80
+        for r in records:
+            print "%12.3f kb  (%s) %s" % (r.diskSize, r.dirType, r.name)
+            for c in codecs:
+                print "%12s     %-8s %12.3f kb  %7.1f%%  %6.1f Mb/s" % (
+                    "", c,
+                    r.projectedDiskSize(c),
+                    100. * r.projectedDiskSize(c) / (r.diskSize or 1.),
+                    r.unzipThroughput(c))
+        print "="*80
+        totDiskSize = sum(r.diskSize for r in records)
+        print "%12.3f kb  TOTAL (POOL containers)" % (totDiskSize,)
+        for c in codecs:
+            projected = sum(r.projectedDiskSize(c) for r in records)
+            sampleSize = sum(r.sampleSize for r in records)
+            unzipTime = sum(r.unzipTimes[c] for r in records)
+            print "%12s     %-8s %12.3f kb  %7.1f%%  %6.1f Mb/s" % (
+                "", c, projected,
+                100. * projected / (totDiskSize or 1.),
+                sampleSize / Units.Mb / unzipTime if unzipTime > 0. else 0.)
+        print "="*80
+        return
+
+    def saveCompressionReport(self, fileName, records):
+        """
+        Save the outcome of a compression what-if analysis into a CSV file:
+        one row per container and codec.
+        """
+        import csv, os
+        if os.path.exists (fileName):
+            os.unlink (fileName)
+        o = csv.writer (open (fileName, 'w'))
+        o.writerow (['container name', 'branch type', 'codec',
+                     'disk size', 'projected disk size', 'unzip Mb/s',
+                     'sample size'])
+        for r in records:
+            for c in sorted(r.zipSizes.keys()):
+                o.writerow ([r.name, r.dirType, c,
+                             "%.3f" % r.diskSize,
+                             "%.3f" % r.projectedDiskSize(c),
+                             "%.3f" % r.unzipThroughput(c),
+                             r.sampleSize])
         return
 
+    def printBreakDown(self, categories=None):
+        """
+        Print out the sizes of containers broken-down by categories.
+        Categories is supposed to be a list of Counters (or of pairs
+        (category-name, item-list)), an item list being a list of pairs
+        (class-name, storegate-key) or of regular expressions.
+        (default: PoolOpts.BREAKDOWN_CATEGORIES)
+        Returns the filled BreakDown.
+        """
+        if categories is None:
+            categories = PoolOpts.BREAKDOWN_CATEGORIES
+        breakdown = BreakDown(categories)
+        breakdown.fill(self)
+        breakdown.printSummary()
+        return breakdown
+
     def __del__(self):
         if self.poolFile and hasattr(self.poolFile, 'Close'):
             try:
@@ -958,23 +1437,33 @@ class PoolFile(object):
 
 class DiffFiles(object):
     """
-    A helper class to compare 2 POOL files and check that they match, both in
-    terms of containers' content and containers' sizes
+    A helper class to compare POOL files and check that they match, both in
+    terms of containers' content and containers' sizes.
+    A reference file is compared to one or more files (`chkFileName` can be a
+    file name or a list of file names): the records of each file are indexed
+    by name once and presence and size-delta matrices (one column per
+    compared file) are computed over all the containers.
     """
 
     def __init__(self, refFileName, chkFileName, verbose = False, ignoreList = None):
         object.__init__(self)
 
         self.verbose = verbose
+        if isinstance(chkFileName, basestring):
+            chkFileNames = [chkFileName]
+        else:
+            chkFileNames = list(chkFileName)
         refFileName = os.path.expandvars( os.path.expanduser( refFileName ) )
-        chkFileName = os.path.expandvars( os.path.expanduser( chkFileName ) )
+        chkFileNames = [ os.path.expandvars( os.path.expanduser( f ) )
+                         for f in chkFileNames ]
 
         if ignoreList is None:
             ignoreList = []
             
         try:
             self.refFile = PoolFile( refFileName )
-            self.chkFile = PoolFile( chkFileName )
+            self.chkFiles = [ PoolFile( f ) for f in chkFileNames ]
+            self.chkFile = self.chkFiles[0]
             self.ignList = sorted( ignoreList )
         except Exception, err:
             print "## Caught exception [%s] !!" % str(err.__class__)
@@ -987,88 +1476,169 @@ class DiffFiles(object):
             print sys.exc_info()[0]
             print sys.exc_info()[1]
             err  = "Error while opening POOL files !"
-            err += " chk : %s%s" % ( chkFileName, os.linesep )
+            err += " chk : %s%s" % ( " ".join(chkFileNames), os.linesep )
             err += " ref : %s%s" % ( refFileName, os.linesep )
             raise Exception, err
         
         self.allGood = True
         self.summary = []
+
+        # name -> [ref, chk_0, ..., chk_n] (None if missing)
+        self.memSizes  = {}
+        self.diskSizes = {}
         
         self.__checkDiff()
         return
 
+    def __buildMatrices(self):
+        indices = [ f.index() for f in [self.refFile] + self.chkFiles ]
+        names = set()
+        for idx in indices:
+            names.update(idx.iterkeys())
+        for name in names:
+            records = [ idx.get(name) for idx in indices ]
+            self.memSizes[name]  = [ r.memSize if r else None
+                                     for r in records ]
+            self.diskSizes[name] = [ r.diskSize if r else None
+                                     for r in records ]
+        return
+
+    @staticmethod
+    def _deltas(sizes):
+        """
+        The [chk_0 - ref, ..., chk_n - ref] deltas of a row of the size
+        matrices (None if the container is missing from either file)
+        """
+        ref = sizes[0]
+        return [ chk - ref if ref is not None and chk is not None else None
+                 for chk in sizes[1:] ]
+
     def __checkDiff(self):
 
-        self.summary += [
-            "=" * 80,
-            "::: Comparing POOL files...",
-            " ref : %s" % self.refFile._fileInfos['name'],
-            " chk : %s" % self.chkFile._fileInfos['name'],
-            "-" * 80,
-            ]
+        self.__buildMatrices()
+        ignored = set(self.ignList)
+        names = sorted(self.memSizes.keys())
 
-        if self.chkFile.dataHeader.nEntries != \
-           self.refFile.dataHeader.nEntries :
+        for ichk, chkFile in enumerate(self.chkFiles):
+            col = ichk + 1
             self.summary += [
-                "## WARNING: files don't have the same number of entries !!",
-                "   ref : %r" % self.refFile.dataHeader.nEntries,
-                "   chk : %r" % self.chkFile.dataHeader.nEntries,
+                "=" * 80,
+                "::: Comparing POOL files...",
+                " ref : %s" % self.refFile._fileInfos['name'],
+                " chk : %s" % chkFile._fileInfos['name'],
+                "-" * 80,
                 ]
-        
-        refNames = sorted( [d.name for d in self.refFile.data] )
-        chkNames = sorted( [d.name for d in self.chkFile.data] )
 
-        if chkNames != refNames:
-            self.summary += [
-                "## ERROR: files don't have the same content !!",
-                ]
-            addNames = [ n for n in chkNames if n not in refNames ]
-            if len( addNames ) > 0:
-                self.summary += [ "## collections in 'chk' and not in 'ref'" ]
-                for n in addNames:
-                    self.summary += [ "  + %s" % n ]
-            subNames = [ n for n in refNames if n not in chkNames ]
-            if len( subNames ) > 0:
-                self.summary += [ "## collections in 'ref' and not in 'chk'" ]
-                for n in subNames:
-                    self.summary += [ "  - %s" % n ]
-            self.allGood = False
-            pass
+            if chkFile.dataHeader.nEntries != \
+               self.refFile.dataHeader.nEntries :
+                self.summary += [
+                    "## WARNING: files don't have the same number of entries !!",
+                    "   ref : %r" % self.refFile.dataHeader.nEntries,
+                    "   chk : %r" % chkFile.dataHeader.nEntries,
+                    ]
+
+            addNames = [ n for n in names
+                         if self.memSizes[n][0] is None and
+                            self.memSizes[n][col] is not None ]
+            subNames = [ n for n in names
+                         if self.memSizes[n][0] is not None and
+                            self.memSizes[n][col] is None ]
+            if addNames or subNames:
+                self.summary += [
+                    "## ERROR: files don't have the same content !!",
+                    ]
+                if len( addNames ) > 0:
+                    self.summary += [ "## collections in 'chk' and not in 'ref'" ]
+                    for n in addNames:
+                        self.summary += [ "  + %s" % n ]
+                if len( subNames ) > 0:
+                    self.summary += [ "## collections in 'ref' and not in 'chk'" ]
+                    for n in subNames:
+                        self.summary += [ "  - %s" % n ]
+                self.allGood = False
+                pass
 
-        if len(self.ignList) > 0:
-                self.summary += [ "## Ignoring the following:" ]
-                for n in self.ignList:
-                    self.summary += [ "  %s" % n ]
+            if len(self.ignList) > 0:
+                    self.summary += [ "## Ignoring the following:" ]
+                    for n in self.ignList:
+                        self.summary += [ "  %s" % n ]
 
-        commonContent = [ d for d in chkNames if (d in refNames and d not in self.ignList)]
+            if addNames or subNames:
+                self.summary += [ "=" * 80 ]
+            self.summary += [ "::: comparing common content (mem-size)..." ]
+
+            for name in names:
+                refMemSize = self.memSizes[name][0]
+                chkMemSize = self.memSizes[name][col]
+                if refMemSize is None or chkMemSize is None or \
+                   name in ignored:
+                    continue
+                if chkMemSize != refMemSize:
+                    self.summary += [
+                        "[ERR] %12.3f kb (ref) ==> %12.3f kb (chk) | %s" % \
+                        ( refMemSize, chkMemSize, name )
+                        ]
+                    self.allGood = False
+                elif self.verbose:
+                    self.summary += [
+                        " [OK] %12.3f kb                                 | %s" % \
+                        ( chkMemSize, name )
+                        ]
 
-        if not self.allGood:
             self.summary += [ "=" * 80 ]
-        self.summary += [ "::: comparing common content (mem-size)..." ]
+            pass # loop over chk files
 
-        for name in commonContent:
-            chkMemSize = self.chkFile.poolRecord(name).memSize
-            refMemSize = self.refFile.poolRecord(name).memSize
-            if chkMemSize != refMemSize:
-                self.summary += [
-                    "[ERR] %12.3f kb (ref) ==> %12.3f kb (chk) | %s" % \
-                    ( refMemSize, chkMemSize, name )
-                    ]
-                self.allGood = False
-            elif self.verbose:
-                self.summary += [
-                    " [OK] %12.3f kb                                 | %s" % \
-                    ( chkMemSize, name )
-                    ]
+        if len(self.chkFiles) > 1:
+            self.summary += self.__matrixSummary(names, ignored)
 
-        self.summary += [ "=" * 80 ]
-        
         ## final decision
         if self.allGood: self.summary += [ "## Comparison : [OK]"  ]
         else:            self.summary += [ "## Comparison : [ERR]" ]
 
         return self.allGood
 
+    def __matrixSummary(self, names, ignored):
+        """
+        A compact (containers x files) view of the mem-size deltas w.r.t. the
+        reference file: '=' same size, '-' missing container, otherwise the
+        delta in kb.
+        """
+        lines = [
+            "::: mem-size deltas w.r.t. ref (kb) ['-': missing, '=': same]",
+            " ref : %s" % self.refFile._fileInfos['name'],
+            ]
+        for ichk, chkFile in enumerate(self.chkFiles):
+            lines += [ " [%i] : %s" % (ichk, chkFile._fileInfos['name']) ]
+        lines += [ "-" * 80,
+                   "%12s  %s  %s" % ("ref (kb)",
+                                     " ".join("%10s" % ("[%i]" % i)
+                                              for i in xrange(len(self.chkFiles))),
+                                     "container") ]
+        for name in names:
+            if name in ignored:
+                continue
+            sizes = self.memSizes[name]
+            ref = sizes[0]
+            cells = []
+            for chk, delta in zip(sizes[1:], self._deltas(sizes)):
+                if chk is None:
+                    cells.append("%10s" % "-")
+                elif ref is None:
+                    cells.append("%10.3f" % chk)
+                elif delta == 0:
+                    cells.append("%10s" % "=")
+                else:
+                    cells.append("%+10.3f" % delta)
+            if not self.verbose and \
+               all(c.strip() == "=" for c in cells):
+                continue
+            lines += [ "%12s  %s  %s" % (
+                "%12.3f" % ref if ref is not None else "-",
+                " ".join(cells),
+                name) ]
+        lines += [ "=" * 80 ]
+        return lines
+
     def status(self):
         if self.allGood: return 0
         else:            return 1
@@ -1078,18 +1648,227 @@ class DiffFiles(object):
             out.writelines( i + os.linesep )
             pass
         return
+
+    def saveReport(self, fileName):
+        """
+        Save the comparison matrices into a JSON file:
+         {'ref': ref-file, 'chk': [chk-files], 'nentries': [...],
+          'status': 0|1,
+          'containers': {name: {'memSize': [ref, chk_0,...],
+                                'diskSize': [ref, chk_0,...],
+                                'memSizeDelta': [chk_0-ref,...],
+                                'diskSizeDelta': [chk_0-ref,...]}}}
+        (sizes in kb, null for missing containers; the deltas are the ones
+        of the printed summary, null when the container is missing from the
+        ref or the chk file)
+        """
+        try:
+            import simplejson as json
+        except ImportError:
+            import json
+        files = [self.refFile] + self.chkFiles
+        report = {
+            'ref'       : self.refFile._fileInfos['name'],
+            'chk'       : [ f._fileInfos['name'] for f in self.chkFiles ],
+            'nentries'  : [ f.dataHeader.nEntries for f in files ],
+            'status'    : self.status(),
+            'ignored'   : self.ignList,
+            'containers': dict(
+                (name, {'memSize'      : self.memSizes[name],
+                        'diskSize'     : self.diskSizes[name],
+                        'memSizeDelta' : self._deltas(self.memSizes[name]),
+                        'diskSizeDelta': self._deltas(self.diskSizes[name])})
+                for name in self.memSizes ),
+            }
+        with open(fileName, 'w') as fd:
+            json.dump(report, fd, indent=1, sort_keys=True)
+        return
     
 class Counter(object):
     """
-    A counter just contains an item list (pairs class-name/sg-key) and the size
+    A counter just contains an item list (pairs class-name/sg-key) and the
+    sizes of the containers matching any of these items.
+    An item can also be a string, then interpreted as a regular expression
+    the container name should (fully) match.
+    Class names and keys may contain '*' wildcards. A key which is None or
+    '*' matches any key.
+    The memory sizes which are not known (FAST_MODE) are not summed:
+    `memSizeKnown` is then False.
     """
-    size = 0
     def __init__(self, name, itemList):
         object.__init__(self)
         self.name = name
         self.itemList = itemList
+        self.memSize  = 0.
+        self.diskSize = 0.
+        self.items    = []
+        self.memSizeKnown = True
+        return
+
+    @property
+    def size(self):
+        return self.diskSize
+
+    def add(self, poolRecord):
+        if PoolOpts.FAST_MODE or poolRecord.memSize < 0.:
+            self.memSizeKnown = False
+        else:
+            self.memSize += poolRecord.memSize
+        self.diskSize += poolRecord.diskSize
+        self.items.append(poolRecord.name)
+        return
+
+    def pattern(self):
+        """return the regular expression matching any of the items"""
+        import re
+        def _glob(s):
+            return re.escape(s).replace(r'\*', '.*')
+        patterns = []
+        for item in self.itemList:
+            if isinstance(item, basestring):
+                patterns.append(item)
+                continue
+            klass, key = item
+            # T/P separated containers are named 'CppClassName_pX_MyKey'
+            # eg: EventInfo_p2_McEventInfo
+            #     TauDetailsContainer_tlp1
+            pat = _glob(klass) + r'(?:_(?:tlp|p)[0-9]+)?'
+            if key is None or key == '*':
+                pat += r'(?:_.*)?'
+            elif key != '':
+                pat += '_' + _glob(key)
+            patterns.append(pat)
+        return '|'.join('(?:%s)' % p for p in patterns)
+
     pass # Counter
 
+def load_categories(fileName):
+    """
+    Load the categories of a size breakdown from a text file, with one item
+    per line:
+      <category-name> <class-name> [<sg-key>]
+      <category-name> re:<regular-expression>
+    Empty lines and lines starting with '#' are ignored.
+    Returns a list of Counters.
+    """
+    counters = {}
+    names = []
+    for line in open(fileName, 'r'):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        fields = line.split()
+        name = fields[0]
+        if len(fields) == 2 and fields[1].startswith('re:'):
+            item = fields[1][len('re:'):]
+        elif len(fields) in (2, 3):
+            item = (fields[1], fields[2] if len(fields) == 3 else None)
+        else:
+            raise ValueError("invalid category definition: [%s]" % line)
+        if not name in counters:
+            counters[name] = []
+            names.append(name)
+        counters[name].append(item)
+    return [ Counter(n, counters[n]) for n in names ]
+
+class BreakDown(object):
+    """
+    Accumulate the sizes of the containers of one or more POOL files,
+    broken-down by categories (see Counter).
+    All the category patterns are compiled once into a single matcher and each
+    PoolRecord is assigned to the first category it matches (or to 'others').
+    """
+    # python's re module limits the number of groups in a pattern
+    _MAX_GROUPS = 90
+
+    def __init__(self, categories):
+        object.__init__(self)
+        import re
+        self.counters = []
+        for cat in categories:
+            if not isinstance(cat, Counter):
+                name, itemList = cat
+                cat = Counter(name, itemList)
+            self.counters.append(cat)
+        self.others = Counter('others', [])
+        self.nFiles  = 0
+        self.nEvents = 0
+
+        self._matchers = []
+        for i in xrange(0, len(self.counters), self._MAX_GROUPS):
+            pattern = '|'.join('(?P<c%i>%s)' % (i+j, c.pattern())
+                               for j, c in enumerate(
+                                   self.counters[i:i+self._MAX_GROUPS])
+                               if c.itemList)
+            if pattern:
+                self._matchers.append(re.compile('(?:%s)\Z' % pattern).match)
+        return
+
+    def category(self, name):
+        """return the Counter the container `name` belongs to"""
+        for match in self._matchers:
+            m = match(name)
+            if m:
+                return self.counters[int(m.lastgroup[1:])]
+        return self.others
+
+    def fill(self, poolFile):
+        """assign all the containers of `poolFile` to their category"""
+        self.nFiles  += 1
+        self.nEvents += poolFile.dataHeader.nEntries
+        for d in [poolFile.dataHeader] + poolFile.data:
+            self.category(d.name).add(d)
+        return self
+
+    def printSummary(self, out = sys.stdout):
+        def _safe_div(num,den):
+            if float(den) == 0.:
+                return 0.
+            return num/den
+        lines = [
+            "",
+            "=" * 80,
+            "::: size breakdown over [%i] file(s) - [%i] events" % (
+                self.nFiles, self.nEvents),
+            "=" * 80,
+            PoolOpts.HDR_FORMAT % ( "Mem Size", "Disk Size", "Size/Evt",
+                                    "Disk/Tot", "items", "Category" ),
+            "=" * 80,
+            ]
+        def _row(memSize, memSizeKnown, *values):
+            # unknown memory sizes are reported as N/A
+            if memSizeKnown:
+                return PoolOpts.ROW_FORMAT % ((memSize,) + values)
+            return PoolOpts.NA_ROW_FORMAT % (("N/A",) + values)
+        counters = self.counters + [self.others]
+        totMemSize  = sum(c.memSize  for c in counters)
+        totDiskSize = sum(c.diskSize for c in counters)
+        totMemSizeKnown = all(c.memSizeKnown for c in counters)
+        for c in counters:
+            lines.append(_row(
+                c.memSize, c.memSizeKnown,
+                c.diskSize,
+                _safe_div(c.diskSize, float(self.nEvents)),
+                _safe_div(c.diskSize, totDiskSize),
+                len(c.items),
+                c.name))
+        lines += [
+            "=" * 80,
+            _row(
+                totMemSize, totMemSizeKnown,
+                totDiskSize,
+                _safe_div(totDiskSize, float(self.nEvents)),
+                1.0,
+                sum(len(c.items) for c in counters),
+                "TOTAL"),
+            "=" * 80,
+            ]
+        for l in lines:
+            out.writelines( l + os.linesep )
+        return
+
+    pass # class BreakDown
+
 
 ### ---------------------------------------------------------------------------
 def merge_pool_files(input_files, output_file,
@@ -0,0 +1,249 @@
+# @file PyUtils/python/PoolReportDb.py
+# @purpose a sqlite-based store of POOL file size reports, to follow the
+#          containers' sizes release after release
+# @date October 2026
+
+from __future__ import with_statement
+
+__version__ = "$Revision$"
+__doc__ = """\
+a sqlite-based store of POOL file size reports (as gathered by chk-file),
+tagged by release, dataset and stream, to follow the containers' sizes
+release after release.
+releases are ordered chronologically, by the date of their first report
+(release names, like the rel_N nightly tags, do not sort meaningfully).
+a file has at most one report per (release, dataset, stream).
+the unknown (negative) memory sizes, as gathered in fast mode, are stored as
+NULL: so are the sums of memory sizes including an unknown one.
+"""
+
+__all__ = [
+    'PoolReportDb',
+    ]
+
+### imports -------------------------------------------------------------------
+import os
+import time
+import sqlite3
+
+### data ----------------------------------------------------------------------
+_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS reports (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    release   TEXT NOT NULL,
+    dataset   TEXT NOT NULL,
+    stream    TEXT NOT NULL,
+    file_name TEXT,
+    file_size INTEGER,
+    nentries  INTEGER,
+    date      REAL
+);
+CREATE INDEX IF NOT EXISTS reports_release ON reports (release);
+CREATE UNIQUE INDEX IF NOT EXISTS reports_file
+    ON reports (release, dataset, stream, file_name);
+
+CREATE TABLE IF NOT EXISTS containers (
+    report_id INTEGER NOT NULL REFERENCES reports (id),
+    name      TEXT NOT NULL,
+    dir_type  TEXT,
+    mem_size  REAL,
+    disk_size REAL,
+    mem_size_nozip REAL,
+    nentries  INTEGER
+);
+CREATE INDEX IF NOT EXISTS containers_name   ON containers (name);
+CREATE INDEX IF NOT EXISTS containers_report ON containers (report_id);
+
+-- sizes summed over all the files of a (release, stream), per container
+-- (mem_size is NULL if unknown for one of the files).
+-- 'date' is the date of the first report of that release.
+CREATE TABLE IF NOT EXISTS aggregates (
+    release   TEXT NOT NULL,
+    stream    TEXT NOT NULL,
+    name      TEXT NOT NULL,
+    nfiles    INTEGER,
+    nevents   INTEGER,
+    mem_size  REAL,
+    disk_size REAL,
+    date      REAL,
+    PRIMARY KEY (release, stream, name)
+);
+CREATE INDEX IF NOT EXISTS aggregates_name ON aggregates (name, stream, date);
+"""
+
+# the sum of the mem_size column, NULL if one of the summed sizes is NULL
+# (SUM skips them)
+_SUM_MEM_SIZE = "CASE WHEN COUNT(%(col)s) = COUNT(*) THEN SUM(%(col)s) END"
+
+### functions -----------------------------------------------------------------
+def _mem_size(size):
+    """the memory size `size` to store: None (NULL) if unknown (negative, as
+    in PoolOpts.FAST_MODE)
+    """
+    if size is None or size < 0:
+        return None
+    return size
+
+### classes -------------------------------------------------------------------
+class PoolReportDb(object):
+    """
+    A store of the size reports of POOL files.
+
+    >>> db = PoolReportDb('sizes.db')
+    >>> db.insert(PoolFile('aod.pool'), release='rel_3', stream='AOD')
+    >>> for r in db.trend('ElectronAODCollection', stream='AOD', last=20):
+    ...     print r
+    >>> db.regressions(stream='AOD', threshold=0.05)
+    """
+
+    def __init__(self, fileName):
+        object.__init__(self)
+        self.fileName = os.path.expandvars(os.path.expanduser(fileName))
+        self.conn = sqlite3.connect(self.fileName)
+        self.conn.text_factory = str
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+        return
+
+    def insert(self, poolFile, release, dataset='', stream='', replace=False):
+        """
+        Insert the report of a PoolFile, tagged with `release`, `dataset` and
+        `stream`, and update the per-release aggregates.
+        A file already reported for that (release, dataset, stream) raises a
+        ValueError, unless `replace` is True: its report is then replaced
+        (keeping its date, hence the position of the release).
+        Returns the id of the new report.
+        """
+        now = time.time()
+        file_name = poolFile._fileInfos['name']
+        nentries = poolFile.dataHeader.nEntries
+        records = [poolFile.dataHeader] + list(poolFile.data)
+        with self.conn:
+            old = self.conn.execute(
+                "SELECT id, date FROM reports WHERE release = ?"
+                " AND dataset = ? AND stream = ? AND file_name = ?",
+                (release, dataset, stream, file_name)).fetchone()
+            if old is not None:
+                if not replace:
+                    raise ValueError(
+                        "a report of [%s] is already stored for release=%r"
+                        " dataset=%r stream=%r" % (file_name, release,
+                                                   dataset, stream))
+                old_id, now = old
+                self.conn.execute(
+                    "DELETE FROM containers WHERE report_id = ?", (old_id,))
+                self.conn.execute(
+                    "DELETE FROM reports WHERE id = ?", (old_id,))
+            c = self.conn.execute(
+                "INSERT INTO reports (release, dataset, stream, file_name,"
+                " file_size, nentries, date) VALUES (?,?,?,?,?,?,?)",
+                (release, dataset, stream,
+                 file_name, poolFile._fileInfos['size'],
+                 nentries, now))
+            report_id = c.lastrowid
+            self.conn.executemany(
+                "INSERT INTO containers (report_id, name, dir_type, mem_size,"
+                " disk_size, mem_size_nozip, nentries) VALUES (?,?,?,?,?,?,?)",
+                [ (report_id, d.name, d.dirType, _mem_size(d.memSize),
+                   d.diskSize, _mem_size(d.memSizeNoZip), d.nEntries)
+                  for d in records ])
+            self._update_aggregates(release, stream)
+        return report_id
+
+    def _update_aggregates(self, release, stream):
+        """recompute the aggregates of (`release`, `stream`) from its reports"""
+        self.conn.execute(
+            "DELETE FROM aggregates WHERE release = ? AND stream = ?",
+            (release, stream))
+        self.conn.execute(
+            "INSERT INTO aggregates (release, stream, name, nfiles, nevents,"
+            " mem_size, disk_size, date)"
+            " SELECT r.release, r.stream, c.name, COUNT(*), SUM(r.nentries),"
+            " " + _SUM_MEM_SIZE % {'col': 'c.mem_size'} + ","
+            " SUM(c.disk_size), MIN(r.date)"
+            " FROM reports r JOIN containers c ON c.report_id = r.id"
+            " WHERE r.release = ? AND r.stream = ? GROUP BY c.name",
+            (release, stream))
+
+    def releases(self, stream=None, last=None):
+        """
+        Return the releases known to the store (optionally only those with
+        reports for `stream`), ordered from the oldest to the most recent
+        (by the date of their first report, not by name).
+        """
+        sql = "SELECT release, MIN(date) AS d FROM aggregates"
+        args = []
+        if stream is not None:
+            sql += " WHERE stream = ?"
+            args.append(stream)
+        sql += " GROUP BY release ORDER BY d DESC"
+        if last:
+            sql += " LIMIT %i" % int(last)
+        rows = self.conn.execute(sql, args).fetchall()
+        return [ r[0] for r in reversed(rows) ]
+
+    def containers(self, stream=None):
+        """Return the names of all the containers known to the store"""
+        sql = "SELECT DISTINCT name FROM aggregates"
+        args = []
+        if stream is not None:
+            sql += " WHERE stream = ?"
+            args.append(stream)
+        return sorted(r[0] for r in self.conn.execute(sql, args))
+
+    def trend(self, name, stream=None, last=20):
+        """
+        Return the sizes of the container `name` over the `last` releases, as
+        a list of (release, nfiles, nevents, mem-size/evt, disk-size/evt)
+        tuples (sizes in kb, mem-size/evt None if unknown), from the oldest to
+        the most recent release (by the date of their first report).
+        """
+        sql = ("SELECT release, SUM(nfiles), SUM(nevents), " +
+               _SUM_MEM_SIZE % {'col': 'mem_size'} + ","
+               " SUM(disk_size), MIN(date) AS d FROM aggregates WHERE name = ?")
+        args = [name]
+        if stream is not None:
+            sql += " AND stream = ?"
+            args.append(stream)
+        sql += " GROUP BY release ORDER BY d DESC"
+        if last:
+            sql += " LIMIT %i" % int(last)
+        trend = []
+        for release, nfiles, nevents, mem, disk, _ in \
+                reversed(self.conn.execute(sql, args).fetchall()):
+            nevents = nevents or 0
+            if mem is not None:
+                mem = mem / nevents if nevents else 0.
+            trend.append((release, nfiles, nevents, mem,
+                          disk / nevents if nevents else 0.))
+        return trend
+
+    def regressions(self, names=None, stream=None, last=20, threshold=0.05):
+        """
+        Flag the releases (among the `last` ones) where the disk size per event
+        of a container grew by more than `threshold` (relative) w.r.t. the
+        previous release.
+        Returns a list of (name, previous-release, release, previous-size,
+        size) tuples (sizes in kb per event).
+        """
+        if names is None:
+            names = self.containers(stream)
+        flags = []
+        for name in names:
+            trend = self.trend(name, stream=stream, last=last)
+            for prev, cur in zip(trend[:-1], trend[1:]):
+                prev_sz, cur_sz = prev[-1], cur[-1]
+                if prev_sz > 0. and (cur_sz - prev_sz) / prev_sz > threshold:
+                    flags.append((name, prev[0], cur[0], prev_sz, cur_sz))
+        return flags
+
+    def close(self):
+        if getattr(self, 'conn', None) is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    def __del__(self):
+        self.close()
+
+    pass # class PoolReportDb
@@ -12,6 +12,10 @@ __author__ = "Sebastien Binet"
 __all__ = [
     'import_root',
     'root_compile',
+    'basket_payload',
+    'branch_checksum',
+    'bulk_leaf_names',
+    'read_leaf_chunk',
     ]
 
 ### imports -------------------------------------------------------------------
@@ -22,6 +26,19 @@ from pprint import pprint
 
 from .Decorators import memoize
 
+### data ----------------------------------------------------------------------
+# the types of the leaves which can be read in bulk (see read_leaf_chunk)
+_BULK_BASIC_TYPES = (
+    'Char_t', 'UChar_t', 'Short_t', 'UShort_t', 'Int_t', 'UInt_t',
+    'Float_t', 'Double_t', 'Bool_t',
+    'char', 'unsigned char', 'short', 'unsigned short', 'int',
+    'unsigned int', 'float', 'double', 'bool',
+    )
+_BULK_TYPES = frozenset(list(_BULK_BASIC_TYPES) +
+                        ['vector<%s>' % t for t in _BULK_BASIC_TYPES])
+# (names which are plain TTreeFormula identifiers)
+_BULK_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
 ### functions -----------------------------------------------------------------
 def import_root(batch=True):
     """a helper method to wrap the 'import ROOT' statement to prevent ROOT
@@ -91,6 +108,125 @@ def root_compile(src=None, fname=None, batch=True):
         ROOT.gErrorIgnoreLevel = orig_root_lvl
     return
         
+def basket_payload(branch, ibasket):
+    """return the uncompressed content of the ``ibasket``-th basket of
+    ``branch`` (without its key header) as a string of bytes, or None if the
+    basket could not be read.
+    the basket is read and unzipped but its content is not streamed.
+    """
+    basket = branch.GetBasket(ibasket)
+    if not basket:
+        return None
+    keylen = basket.GetKeylen()
+    nbytes = basket.GetLast() - keylen
+    if nbytes <= 0:
+        return ''
+    from array import array
+    payload = array('b', [0]) * nbytes
+    buf = basket.GetBufferRef()
+    buf.SetReadMode()
+    buf.SetBufferOffset(keylen)
+    buf.ReadFastArray(payload, nbytes)
+    return payload.tostring()
+
+def branch_checksum(branch):
+    """return the sha1 (hex) digest of the uncompressed content of ``branch``
+    and of its sub-branches: the entries and entry offsets of their baskets
+    and their payloads (see ``basket_payload``), so the content is never
+    streamed.
+    returns None if a basket could not be read, or if some entries are not
+    in a written basket.
+    (the same content laid out in different baskets gives different
+    checksums)
+    """
+    import hashlib
+    from array import array
+    sha = hashlib.sha1()
+    def update(br):
+        nbaskets = br.GetWriteBasket()
+        nentries = br.GetEntries()
+        sha.update('%s:%i:%i\n' % (br.GetName(), nentries, nbaskets))
+        basketEntry = br.GetBasketEntry()
+        if basketEntry[nbaskets] != nentries:
+            # entries left in an unwritten basket (even with no basket
+            # written at all)
+            return False
+        has_offsets = br.GetEntryOffsetLen() > 0
+        for ibasket in xrange(nbaskets):
+            payload = basket_payload(br, ibasket)
+            if payload is None:
+                return False
+            basket = br.GetBasket(ibasket)
+            nev = basket.GetNevBuf()
+            sha.update('%i:%i\n' % (basketEntry[ibasket], nev))
+            if has_offsets and nev > 0:
+                keylen = basket.GetKeylen()
+                offsets = basket.GetEntryOffset()
+                sha.update(array('i', [offsets[i] - keylen
+                                       for i in xrange(nev)]).tostring())
+            sha.update(payload)
+        br.DropBaskets("all")
+        for sub in br.GetListOfBranches():
+            if not update(sub):
+                return False
+        return True
+    if not update(branch):
+        return None
+    return sha.hexdigest()
+
+def bulk_leaf_names(tree):
+    """return the names of the branches of ``tree`` holding a single leaf of
+    a basic type (or an array or vector of a basic type), which can be read
+    in bulk with ``read_leaf_chunk``.
+    (64b integers are left out: their values are read as doubles)
+    """
+    names = []
+    for br in tree.GetListOfBranches():
+        name = br.GetName().rstrip('\0')
+        if not _BULK_NAME.match(name):
+            continue
+        if br.GetListOfBranches().GetEntriesFast() > 0:
+            # split object
+            continue
+        leaves = br.GetListOfLeaves()
+        if leaves.GetEntriesFast() != 1:
+            continue
+        leaf = leaves.At(0)
+        if leaf.IsA().GetName() == 'TLeafC':
+            # a string
+            continue
+        if leaf.GetTypeName() in _BULK_TYPES:
+            names.append(name)
+    return names
+
+def read_leaf_chunk(tree, name, first, nentries):
+    """read the values of the ``name`` leaf (see ``bulk_leaf_names``) for the
+    ``nentries`` entries of ``tree`` starting at ``first``, in bulk: the
+    values are collected by TTree::Draw, no object is converted to python.
+    returns a pair of numpy arrays: the values (as float64) and the entry
+    number of each value (one value per entry, or one per element for arrays
+    and vectors, in entry order).
+    """
+    import numpy as np
+    expr = '%s:Entry$' % (name,)
+    while True:
+        n = tree.Draw(expr, '', 'goff', nentries, first)
+        if n < 0:
+            raise RuntimeError('could not read leaf [%s] of tree [%s]' %
+                               (name, tree.GetName()))
+        if n <= tree.GetEstimate():
+            break
+        # only the last values would have been kept
+        tree.SetEstimate(n + 1)
+    if n == 0:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+    def _array(buf):
+        buf.SetSize(n)
+        return np.frombuffer(buf, dtype=np.float64, count=n).copy()
+    values = _array(tree.GetV1())
+    entries = _array(tree.GetV2()).astype(np.int64)
+    return values, entries
+
 @memoize
 def _pythonize_tfile():
     import PyCintex; PyCintex.Cintex.Enable()
@@ -233,8 +369,9 @@ class RootFileDumper(object):
                 except ValueError:
                     print "** err ** invalid 'itr_entries' argument. will iterate over all entries."
                     itr_entries = xrange(nentries)
-        else:
+        elif isinstance(itr_entries, (int, long)):
             itr_entries = xrange(itr_entries)
+        # (otherwise, any iterable of entries)
                 
         for ientry in itr_entries:
             hdr = ":: entry [%05i]..." % (ientry,)
@@ -4,6 +4,7 @@
 import PyUtils.acmdlib as acmdlib
 acmdlib.register('chk-file', 'PyUtils.scripts.check_file:main')
 acmdlib.register('diff-pool', 'PyUtils.scripts.diff_pool_files:main')
+acmdlib.register('size-trend', 'PyUtils.scripts.size_trend:main')
 acmdlib.register('diff-root', 'PyUtils.scripts.diff_root_files:main')
 acmdlib.register('dump-root', 'PyUtils.scripts.dump_root_file:main')
 acmdlib.register('chk-sg', 'PyUtils.scripts.check_sg:main')
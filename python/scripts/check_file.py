@@ -36,6 +36,67 @@ import PyUtils.acmdlib as acmdlib
                   an ASCII/py file (depending on the extension:
                   .pkl,.dat -> shelve; everything else -> ASCII/py)
                   """)
+@acmdlib.argument('--per-event',
+                  action='store_true',
+                  default=False,
+                  help="""Switch to compute the per-event size distributions
+                  of each container (from the baskets' entry-offset tables)
+                  and save them into a columnar CSV file (<file>.evtsz.csv)""")
+@acmdlib.argument('--per-event-bins',
+                  type=int,
+                  default=20,
+                  help="number of bins of the per-event size histograms")
+@acmdlib.argument('--per-event-top',
+                  type=int,
+                  default=5,
+                  help="number of largest events to report per container")
+@acmdlib.argument('--what-if-zip',
+                  action='store_true',
+                  default=False,
+                  help="""Switch to estimate, from a sample of baskets, the
+                  on-disk size and decompression throughput of each container
+                  with other compression codecs. Results are saved into a CSV
+                  file (<file>.what-if-zip.csv)""")
+@acmdlib.argument('--codecs',
+                  nargs='+',
+                  default=None,
+                  help="""codecs (name:level) to consider for --what-if-zip
+                  [default: zlib:1 zlib:6 zlib:9 lzma:6 bz2:9]""")
+@acmdlib.argument('--sample-baskets',
+                  type=int,
+                  default=5,
+                  help="number of baskets to sample per branch for --what-if-zip")
+@acmdlib.argument('--nprocs',
+                  type=int,
+                  default=None,
+                  help="""number of worker processes for --what-if-zip
+                  [default: number of cores]""")
+@acmdlib.argument('--breakdown',
+                  default=None,
+                  help="""path to a file defining categories of containers
+                  (one '<category> <class-name> [<sg-key>]' or
+                  '<category> re:<regexp>' per line). The sizes of the
+                  containers, summed over all the input files, are then
+                  broken-down by category""")
+@acmdlib.argument('--db',
+                  default=None,
+                  help="""path to a sqlite size-report store where to insert
+                  the report of each file (see also 'acmd size-trend')""")
+@acmdlib.argument('--release',
+                  default=None,
+                  help="release (or nightly) tag of the reports inserted into --db")
+@acmdlib.argument('--dataset',
+                  default='',
+                  help="dataset tag of the reports inserted into --db")
+@acmdlib.argument('--stream',
+                  default='',
+                  help="stream tag (AOD, ESD,...) of the reports inserted into --db")
+@acmdlib.argument('--replace',
+                  action='store_true',
+                  default=False,
+                  help="""replace the reports already stored into --db for
+                  the same file, release, dataset and stream (otherwise such
+                  a file is an error)""")
 def main(args):
     """read a POOL file and dump its content.
     """
@@ -50,6 +111,32 @@ def main(args):
     for i,f in enumerate(files):
         files[i] = osp.expandvars(osp.expanduser(f))
 
+    breakdown = None
+    if args.breakdown:
+        import PyUtils.PoolFile as PF
+        breakdown = PF.BreakDown(PF.load_categories(
+            osp.expandvars(osp.expanduser(args.breakdown))))
+
+    if args.codecs:
+        import PyUtils.PoolFile as PF
+        for c in args.codecs:
+            try:
+                PF._get_codec(c)
+            except ValueError, err:
+                print "## invalid --codecs:", err
+                return 1
+            except ImportError:
+                # discarded (with a warning) by compressionWhatIf
+                pass
+
+    db = None
+    if args.db:
+        if not args.release:
+            print "## --release is required to insert reports into --db"
+            return 1
+        import PyUtils.PoolReportDb as PRD
+        db = PRD.PoolReportDb(args.db)
+
     exitcode = 0
     for fname in files:
         try:
@@ -57,10 +144,35 @@ def main(args):
             PF.PoolOpts.FAST_MODE = args.fast
             pool_file = PF.PoolFile(fname)
             pool_file.checkFile(sorting=args.sort_fct)
+            if breakdown:
+                breakdown.fill(pool_file)
+            if db:
+                print "## inserting report into [%s]..." % (args.db,)
+                db.insert(pool_file, release=args.release,
+                          dataset=args.dataset, stream=args.stream,
+                          replace=args.replace)
             if args.detailed_dump:
                 dump_file = osp.basename(fname) + '.txt'
                 print "## dumping details into [%s]" % (dump_file,)
                 pool_file.detailedDump(dump_file)
+            if args.per_event:
+                profiles = pool_file.eventSizes()
+                pool_file.printEventSizes(profiles,
+                                          ntop=min(3, args.per_event_top))
+                evtsz_file = osp.basename(fname) + '.evtsz.csv'
+                print "## saving per-event sizes into [%s]..." % (evtsz_file,)
+                pool_file.saveEventSizeReport(evtsz_file, profiles,
+                                              nbins=args.per_event_bins,
+                                              ntop=args.per_event_top)
+            if args.what_if_zip:
+                records = pool_file.compressionWhatIf(
+                    codecs=args.codecs,
+                    nbaskets=args.sample_baskets,
+                    nprocs=args.nprocs)
+                pool_file.printCompressionWhatIf(records)
+                zip_file = osp.basename(fname) + '.what-if-zip.csv'
+                print "## saving compression what-if into [%s]..." % (zip_file,)
+                pool_file.saveCompressionReport(zip_file, records)
             if args.output:
                 oname = args.output
                 print "## saving report into [%s]..." % (oname,)
@@ -82,7 +194,13 @@ def main(args):
         if len(files) > 1:
             print ""
         pass # loop over fileNames
-    
+
+    if breakdown:
+        breakdown.printSummary()
+
+    if db:
+        db.close()
+
     print "## Bye."
     return exitcode
 
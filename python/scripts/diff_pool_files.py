@@ -15,22 +15,31 @@ import PyUtils.acmdlib as acmdlib
 @acmdlib.argument('old',
                   help='path to the reference POOL file to analyze')
 @acmdlib.argument('new',
-                  help='path to the POOL file to compare to the reference')
+                  nargs='+',
+                  help='path to the POOL file(s) to compare to the reference')
 @acmdlib.argument('-v', '--verbose',
                   action='store_true',
                   default=False,
                   help="""Enable verbose printout""")
+@acmdlib.argument('-o', '--output',
+                  default=None,
+                  help="""name of a JSON file where to save the presence and
+                  size matrices of all the containers (one column per file)
+                  and their size deltas w.r.t. the reference file""")
 def main(args):
     """check that 2 POOL files have same content (containers and sizes)
     """
 
     import os.path as osp
     old = osp.expandvars(osp.expanduser(args.old))
-    new = osp.expandvars(osp.expanduser(args.new))
+    new = [osp.expandvars(osp.expanduser(f)) for f in args.new]
 
     import PyUtils.PoolFile as PF
     diff = PF.DiffFiles(refFileName = old,
                         chkFileName = new,
                         verbose = args.verbose)
     diff.printSummary()
+    if args.output:
+        print "## saving report into [%s]..." % (args.output,)
+        diff.saveReport(args.output)
     return diff.status()
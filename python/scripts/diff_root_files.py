@@ -8,6 +8,8 @@ __doc__ = "check that 2 ROOT files have same content (containers and sizes)."
 __author__ = "Sebastien Binet"
 
 ### imports -------------------------------------------------------------------
+import collections
+
 import PyUtils.acmdlib as acmdlib
 import PyUtils.RootUtils as ru
 ROOT = ru.import_root()
@@ -15,9 +17,81 @@ ROOT = ru.import_root()
 ### globals -------------------------------------------------------------------
 g_ALLOWED_MODES = ('summary', 'detailed')
 g_ALLOWED_ERROR_MODES = ('bailout', 'resilient')
+g_ALLOWED_ENGINES = ('auto', 'bulk', 'dump')
 g_args = None
+g_cancel = None   # set by a worker to stop the other ones (see --jobs)
+g_dumpers = None  # the RootFileDumpers of a worker process
+g_tolerances = {} # leaf name -> (atol, rtol, ulp) (see _leaf_tolerance)
+# bins of the histograms of relative differences: [10^i, 10^(i+1)) for i in
+# [-16,0), plus the underflow (<1e-16) and overflow (>=1) bins
+g_REL_HIST_LOW = -16
+g_REL_HIST_NBINS = 18
+# the 64b integer types, read as doubles by TTree::Draw (-> numpy dtype)
+g_INT64_TYPES = {
+    'Long64_t': 'int64', 'long': 'int64', 'long long': 'int64',
+    'ULong64_t': 'uint64', 'unsigned long': 'uint64',
+    'unsigned long long': 'uint64',
+    }
 
 ### classes -------------------------------------------------------------------
+class DiffResult(object):
+    """the outcome of the comparison of (a part of) the trees: the numbers of
+    identical and different values, the number of differences and the first
+    differing entry of each leaf, and the report lines (printed right away
+    if `lines` is None, collected otherwise)
+    """
+    def __init__(self, lines=None):
+        object.__init__(self)
+        self.n_good = 0
+        self.n_bad = 0
+        self.summary = collections.defaultdict(int)
+        self.first_diff = {}
+        self.stop = False    # bailed out or an enforced leaf differs
+        self.allgood = True  # no error (or out-of-sync entry) in the dump
+        self.lines = lines
+        self.n_tolerated = 0 # values which differ within the tolerances
+        self.rel_hists = {}  # leaf name -> histogram of relative differences
+
+    def report(self, line):
+        if self.lines is None:
+            print line
+        else:
+            self.lines.append(line)
+
+    def add_diff(self, name, ientry, n=1):
+        self.n_bad += n
+        self.summary[name] += n
+        first = self.first_diff.get(name)
+        if first is None or ientry < first:
+            self.first_diff[name] = ientry
+
+    def fill_rel_hist(self, name, counts):
+        hist = self.rel_hists.get(name)
+        if hist is None:
+            self.rel_hists[name] = list(counts)
+        else:
+            self.rel_hists[name] = [x + y for x, y in zip(hist, counts)]
+
+    def merge(self, other):
+        """merge the result of another part of the comparison"""
+        self.n_good += other.n_good
+        self.n_bad += other.n_bad
+        self.n_tolerated += other.n_tolerated
+        for name, counts in other.rel_hists.iteritems():
+            self.fill_rel_hist(name, counts)
+        for name, n in other.summary.iteritems():
+            self.summary[name] += n
+        for name, ientry in other.first_diff.iteritems():
+            first = self.first_diff.get(name)
+            if first is None or ientry < first:
+                self.first_diff[name] = ientry
+        self.stop = self.stop or other.stop
+        self.allgood = self.allgood and other.allgood
+        for line in other.lines or []:
+            self.report(line)
+        return self
+
+    pass # class DiffResult
 
 ### functions -----------------------------------------------------------------
 def _is_summary():
@@ -28,6 +102,571 @@ def _is_exit_early():
     global g_args
     return g_args.error_mode == 'bailout'
 
+def _entry_range(itr_entries, nentries):
+    """return the [first, last) range of entries described by `itr_entries`
+    (see RootFileDumper.dump), or None if these are not a contiguous range
+    """
+    if isinstance(itr_entries, basestring):
+        itr_entries = itr_entries.strip()
+        if itr_entries in ('', '-1'):
+            return 0, nentries
+        if ':' in itr_entries:
+            toks = itr_entries.split(':')
+            if len(toks) > 2 and toks[2] not in ('', '1'):
+                return None
+            try:
+                toks = [int(t) if t else None for t in toks[:2]]
+            except ValueError:
+                return None
+            first, last, _ = slice(*toks).indices(nentries)
+            return first, max(first, last)
+        try:
+            itr_entries = int(itr_entries)
+        except ValueError:
+            return None
+    if itr_entries < 0:
+        return 0, nentries
+    return 0, min(itr_entries, nentries)
+
+def _is_array_leaf(tree, name):
+    """return whether the (bulk) leaf `name` holds several values per entry"""
+    leaf = tree.GetBranch(name).GetListOfLeaves().At(0)
+    return (leaf.GetTypeName().startswith('vector<') or
+            leaf.GetLen() > 1 or
+            bool(leaf.GetLeafCount()))
+
+def _float_dtype(tree, name):
+    """return the numpy float type of the (bulk) leaf `name` (None if the
+    leaf is not a floating point one)
+    """
+    import numpy as np
+    leaf = tree.GetBranch(name).GetListOfLeaves().At(0)
+    type_name = leaf.GetTypeName()
+    if type_name.startswith('vector<'):
+        type_name = type_name[len('vector<'):-1]
+    if type_name in ('Float_t', 'float'):
+        return np.float32
+    if type_name in ('Double_t', 'double'):
+        return np.float64
+    return None
+
+def _parse_tolerance(spec, default):
+    """parse a 'key=val[,key=val...]' tolerance spec (keys: atol, rtol, ulp)
+    into an (atol, rtol, ulp) tuple, the missing keys taken from `default`
+    """
+    tol = dict(zip(('atol', 'rtol', 'ulp'), default))
+    for tok in spec.split(','):
+        if not tok.strip():
+            continue
+        k, v = [t.strip() for t in tok.split('=', 1)]
+        if k not in tol:
+            raise ValueError('invalid tolerance [%s] (allowed: atol, rtol,'
+                             ' ulp)' % (k,))
+        tol[k] = int(v) if k == 'ulp' else float(v)
+    return tol['atol'], tol['rtol'], tol['ulp']
+
+def _leaf_tolerance(name):
+    """return the (atol, rtol, ulp) tolerances of the leaf `name`: the ones
+    of the last --tolerance pattern matching it, or the global ones
+    """
+    tol = g_tolerances.get(name)
+    if tol is None:
+        from fnmatch import fnmatch
+        tol = (g_args.atol, g_args.rtol, g_args.ulp)
+        for spec in g_args.tolerance or ():
+            pattern, spec = spec.split(':', 1)
+            if fnmatch(name, pattern):
+                tol = _parse_tolerance(spec, (g_args.atol, g_args.rtol,
+                                              g_args.ulp))
+        g_tolerances[name] = tol
+    return tol
+
+def _ulp_distance(a, b, dtype):
+    """return the distance, in units in the last place of `dtype`, between
+    the values of the `a` and `b` arrays (as an array of uint64)
+    """
+    import numpy as np
+    itype = np.int32 if dtype == np.float32 else np.int64
+    def ordered(x):
+        # map the (sign-magnitude) float bits onto ordered integers, then
+        # onto ordered unsigned ones, so the distance is exact and can not
+        # overflow
+        i = x.astype(dtype).view(itype).astype(np.int64)
+        i = np.where(i < 0, np.iinfo(itype).min - i, i)
+        return i.view(np.uint64) ^ np.uint64(1 << 63)
+    ua, ub = ordered(a), ordered(b)
+    return np.where(ua >= ub, ua - ub, ub - ua)
+
+def _within_tolerance(a, b, tol, dtype):
+    """return the mask of the (differing) values of `a` and `b` which are
+    within the (atol, rtol, ulp) `tol` tolerances
+    """
+    import numpy as np
+    atol, rtol, ulp = tol
+    diff = np.abs(a - b)
+    ok = diff <= atol
+    if rtol > 0:
+        ok |= diff <= rtol * np.maximum(np.abs(a), np.abs(b))
+    if ulp > 0 and dtype is not None:
+        ok |= _ulp_distance(a, b, dtype) <= np.uint64(ulp)
+    return ok
+
+def _rel_hist(a, b):
+    """return the histogram (see g_REL_HIST_NBINS) of the relative
+    differences |a-b|/max(|a|,|b|) of the (differing) values `a` and `b`
+    """
+    import numpy as np
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel = np.abs(a - b) / np.maximum(np.abs(a), np.abs(b))
+        ibin = np.floor(np.log10(rel)) - g_REL_HIST_LOW + 1
+    ibin = np.where(np.isnan(ibin), g_REL_HIST_NBINS - 1, ibin)
+    ibin = np.clip(ibin, 0, g_REL_HIST_NBINS - 1).astype(np.int64)
+    return np.bincount(ibin, minlength=g_REL_HIST_NBINS).tolist()
+
+def _rel_hist_lines(res):
+    """return the lines displaying the histograms of relative differences
+    of the `res` DiffResult
+    """
+    def label(i):
+        if i == 0:
+            return '< 1e%i' % (g_REL_HIST_LOW,)
+        if i == g_REL_HIST_NBINS - 1:
+            return '>= 1'
+        lo = g_REL_HIST_LOW + i - 1
+        return '[1e%i, 1e%i)' % (lo, lo + 1)
+    lines = []
+    for name in sorted(res.rel_hists.keys()):
+        lines.append(' [%s]: relative differences' % (name,))
+        for i, n in enumerate(res.rel_hists[name]):
+            if n:
+                lines.append('   %-16s %i' % (label(i), n))
+    return lines
+
+def _diff_value(iold, inew):
+    diff_value = 'N/A'
+    try:
+        # (python floats: a zero sum raises instead of giving nan/inf)
+        iold, inew = float(iold), float(inew)
+        diff_value = 50.*(iold-inew)/(iold+inew)
+        diff_value = '%.8f%%' % (diff_value,)
+    except Exception:
+        pass
+    return diff_value
+
+def _same_value(iold, inew):
+    """whether the dumped values `iold` and `inew` are equal: two NaNs are
+    equal, as in the bulk comparison (see `_compare_values`)
+    """
+    return iold == inew or (iold != iold and inew != inew)
+
+def _is_cancelled():
+    """whether another worker asked to stop the comparison (see --jobs)"""
+    return g_cancel is not None and g_cancel.is_set()
+
+def _compare_values(name, is_array, a, b, entries, counts, unsync, res,
+                    dtype=None):
+    """compare the values `a` and `b` of the leaf `name`, the ones of the
+    old `entries` (with `counts` values each) which have the same number of
+    values on both sides, and report the `unsync` (old entry, old count, new
+    count) entries, whose values all differ.
+    the values which differ within the tolerances of the leaf (see
+    `_leaf_tolerance`, `dtype` being its float type) are counted as equal.
+    the differences are accumulated into the `res` DiffResult.
+    returns whether the comparison has to stop.
+    """
+    import numpy as np
+    neq = (a != b) & ~(np.isnan(a) & np.isnan(b))
+    idx = np.flatnonzero(neq)
+    if len(idx):
+        if _is_summary():
+            res.fill_rel_hist(name, _rel_hist(a[idx], b[idx]))
+        tol = _leaf_tolerance(name)
+        if tol != (0., 0., 0):
+            ok = _within_tolerance(a[idx], b[idx], tol, dtype)
+            res.n_tolerated += int(ok.sum())
+            idx = idx[~ok]
+    res.n_good += len(a) - len(idx)
+    if not len(idx) and not unsync:
+        return False
+    ea = np.repeat(entries, counts)
+    if len(idx):
+        # (the aligned values are in the order of the keys, not the entries)
+        res.add_diff(name, int(ea[idx].min()), len(idx))
+    if unsync:
+        res.add_diff(name, min(e for e, _, _ in unsync),
+                     sum(max(co, cn) for _, co, cn in unsync))
+
+    if not _is_summary():
+        # the index of each value within its entry
+        it = np.arange(len(a)) - np.repeat(np.cumsum(counts) - counts, counts)
+        for i in idx:
+            n_ = '%03i.%s' % (ea[i], name)
+            if is_array:
+                n_ += '.%i' % (it[i],)
+            res.report('%s %r -> %r => diff= [%s]' % (
+                n_, a[i], b[i], _diff_value(a[i], b[i])))
+        for ientry, co, cn in unsync:
+            res.report('::sync-old %03i.%s (%i elements)' % (ientry, name, co))
+            res.report('::sync-new %03i.%s (%i elements)' % (ientry, name, cn))
+
+    if unsync:
+        res.allgood = False
+        if _is_exit_early():
+            res.report("*** exit on first error ***")
+            res.stop = True
+            return True
+    if name in g_args.enforce_leaves:
+        res.report("*** [%s] differs: don't compare further ***" % (name,))
+        res.stop = True
+        return True
+    return False
+
+def _diff_bulk(told, tnew, names, first, last, res):
+    """compare the `names` leaves (see RootUtils.bulk_leaf_names) of the
+    `told` and `tnew` trees over the [first, last) entries, reading each leaf
+    by chunks of entries into arrays, compared vectorized.
+    the differences are accumulated into the `res` DiffResult.
+    """
+    import numpy as np
+    chunk_size = g_args.chunk_size
+    for name in names:
+        is_array = _is_array_leaf(told, name)
+        dtype = _float_dtype(told, name)
+        for start in xrange(first, last, chunk_size):
+            if _is_cancelled():
+                return res
+            n = min(chunk_size, last - start)
+            vo, eo = ru.read_leaf_chunk(told, name, start, n)
+            vn, en = ru.read_leaf_chunk(tnew, name, start, n)
+            # the values of the entries with the same number of elements on
+            # both sides are compared one to one, the other ones all differ
+            co = np.bincount(eo - start, minlength=n)
+            cn = np.bincount(en - start, minlength=n)
+            same = co == cn
+            unsync = [(start + int(i), co[i], cn[i])
+                      for i in np.flatnonzero(~same)]
+            if _compare_values(name, is_array,
+                               vo[same[eo - start]], vn[same[en - start]],
+                               start + np.flatnonzero(same), co[same],
+                               unsync, res, dtype):
+                return res
+        pass # loop over leaves
+    return res
+
+def _read_leaf(tree, name, nentries):
+    """read the whole leaf `name` of the `nentries` first entries of `tree`.
+    returns its values, the number of values of each entry and the offset of
+    the first value of each entry.
+    """
+    import numpy as np
+    chunk_size = g_args.chunk_size
+    values = []
+    entries = []
+    for start in xrange(0, nentries, chunk_size):
+        v, e = ru.read_leaf_chunk(tree, name, start,
+                                  min(chunk_size, nentries - start))
+        values.append(v)
+        entries.append(e)
+    values = np.concatenate(values or [np.empty(0)])
+    entries = np.concatenate(entries or [np.empty(0, dtype=np.int64)])
+    counts = np.bincount(entries, minlength=nentries)
+    offsets = np.cumsum(counts) - counts
+    return values, counts, offsets
+
+def _diff_bulk_aligned(told, tnew, names, pairs, res):
+    """compare the `names` leaves of the `told` and `tnew` trees over the
+    `pairs` of (old, new) entries holding the same event (see
+    `_event_index`), vectorized.
+    the differences are accumulated into the `res` DiffResult.
+    """
+    import numpy as np
+    if not pairs:
+        return res
+    io = np.array([p[0] for p in pairs], dtype=np.int64)
+    inew = np.array([p[1] for p in pairs], dtype=np.int64)
+    chunk_size = g_args.chunk_size
+    for name in names:
+        is_array = _is_array_leaf(told, name)
+        dtype = _float_dtype(told, name)
+        vo, co_all, oo_all = _read_leaf(told, name, told.GetEntries())
+        vn, cn_all, on_all = _read_leaf(tnew, name, tnew.GetEntries())
+        for start in xrange(0, len(io), chunk_size):
+            jo = io[start:start+chunk_size]
+            jn = inew[start:start+chunk_size]
+            co, cn = co_all[jo], cn_all[jn]
+            same = co == cn
+            unsync = [(int(jo[i]), co[i], cn[i])
+                      for i in np.flatnonzero(~same)]
+            counts = co[same]
+            # gather the values of the pairs, in the order of the pairs
+            it = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                     counts)
+            a = vo[np.repeat(oo_all[jo[same]], counts) + it]
+            b = vn[np.repeat(on_all[jn[same]], counts) + it]
+            if _compare_values(name, is_array, a, b, jo[same], counts,
+                               unsync, res, dtype):
+                return res
+        pass # loop over leaves
+    return res
+
+def _read_key_leaf(tree, name, nentries):
+    """return the values of the key leaf `name` of the `nentries` entries of
+    `tree`, as a numpy array: the leaves of 64b integers are read entry by
+    entry, at their native precision (TTree::Draw would round the values
+    over 2^53), the other ones in bulk (see RootUtils.read_leaf_chunk).
+    """
+    import numpy as np
+    br = tree.GetBranch(name)
+    leaves = br.GetListOfLeaves() if br else None
+    if leaves and leaves.GetEntriesFast() == 1:
+        leaf = leaves.At(0)
+        dtype = g_INT64_TYPES.get(leaf.GetTypeName())
+        if dtype is not None:
+            if leaf.GetLen() != 1:
+                raise ValueError('key leaf [%s] does not hold one value per'
+                                 ' entry' % (name,))
+            values = np.empty(nentries, dtype=dtype)
+            for i in xrange(nentries):
+                br.GetEntry(i)
+                values[i] = long(getattr(tree, name))
+            return values
+    v, e = ru.read_leaf_chunk(tree, name, 0, nentries)
+    if len(e) != nentries:
+        raise ValueError('key leaf [%s] does not hold one value per entry'
+                         % (name,))
+    return v
+
+def _event_index(tree, keys):
+    """return the (key, entry) pairs of all the entries of `tree`, sorted by
+    key: the tuple of the values of the `keys` leaves (see `_read_key_leaf`),
+    plus the rank of the entry among the ones with the same values, so the
+    keys are unique.
+    returns the index and the number of duplicated keys.
+    """
+    import numpy as np
+    nentries = tree.GetEntries()
+    cols = [_read_key_leaf(tree, k, nentries) for k in keys]
+    order = np.lexsort(cols[::-1]) if cols else np.arange(nentries)
+    cols = [c.tolist() if c.dtype.kind in 'iu' else
+            [int(x) if x.is_integer() else x for x in c.tolist()]
+            for c in cols]
+    index = []
+    ndups = 0
+    prev = None
+    rank = 0
+    for i in order.tolist():
+        key = tuple(c[i] for c in cols)
+        if key == prev:
+            rank += 1
+            ndups += 1
+        else:
+            rank = 0
+            prev = key
+        index.append((key + (rank,), i))
+    return index, ndups
+
+def _align_events(told, tnew, keys, res):
+    """align the entries of `told` and `tnew` holding the same event,
+    identified by the values of the `keys` leaves, with a merge-join of the
+    two (sorted) event indices.
+    the events present in only one tree are reported (and counted as
+    differences into `res`).
+    returns the list of (old, new) entries of the common events and the
+    numbers of events only in the old and only in the new tree.
+    """
+    from PyUtils.merge_join import merge_join
+    idx_old, dups_old = _event_index(told, keys)
+    idx_new, dups_new = _event_index(tnew, keys)
+    if dups_old or dups_new:
+        res.report('::: duplicated keys: old=[%i] new=[%i]' % (dups_old,
+                                                               dups_new))
+    pairs = []
+    only = {'old': 0, 'new': 0}
+    for key, iold, inew in merge_join(idx_old, idx_new):
+        if iold is not None and inew is not None:
+            pairs.append((iold, inew))
+            continue
+        side, ientry = ('old', iold) if inew is None else ('new', inew)
+        only[side] += 1
+        res.n_bad += 1
+        if not _is_summary():
+            res.report('::only-%s %03i %s' % (side, ientry, key[:-1]))
+    return pairs, only['old'], only['new']
+
+def _diff_dump(fold, fnew, itr_entries, leaves, dump_names, res,
+               pairs=None):
+    """compare the `dump_names` branches (all of them if None) of the
+    `fold` and `fnew` RootFileDumpers, value by value, over `itr_entries`
+    (or over the `pairs` of (old, new) entries holding the same event, see
+    `_align_events`).
+    only the `leaves` are compared.
+    the differences are accumulated into the `res` DiffResult.
+    """
+    from itertools import izip
+    new_entries = itr_entries
+    entry_map = None
+    if pairs is not None:
+        itr_entries = [p[0] for p in pairs]
+        new_entries = [p[1] for p in pairs]
+        entry_map = dict(pairs)
+    cur_entry = None
+    for d in izip(fold.dump(g_args.tree_name, itr_entries, leaves=dump_names),
+                  fnew.dump(g_args.tree_name, new_entries, leaves=dump_names)):
+        tree_name, ientry, name, iold = d[0]
+        _,         inentry,   _, inew = d[1]
+        if ientry != cur_entry:
+            cur_entry = ientry
+            if _is_cancelled():
+                break
+        name[0] = name[0].rstrip('\0')
+        if ((not (name[0] in leaves)) or
+            # FIXME: that's a plain (temporary?) hack
+            name[-1] in g_args.known_hacks):
+            continue
+
+        if entry_map is None:
+            in_synch = d[0][:-1] == d[1][:-1]
+        else:
+            in_synch = (d[0][2] == d[1][2] and
+                        entry_map.get(ientry) == inentry)
+        if in_synch and _same_value(iold, inew):
+            res.n_good += 1
+            continue
+
+        if not in_synch:
+            if not _is_summary():
+                res.report('::sync-old %s' %
+                           '.'.join(["%03i"%ientry]+map(str, d[0][2])))
+                res.report('::sync-new %s' %
+                           '.'.join(["%03i"%ientry]+map(str, d[1][2])))
+                pass
+            res.add_diff(name[0], ientry)
+            # remember for later
+            fold.allgood = False
+            fnew.allgood = False
+
+            if _is_exit_early():
+                res.report("*** exit on first error ***")
+                res.stop = True
+                break
+            continue
+
+        n = '.'.join(map(str, ["%03i"%ientry]+name))
+        diff_value = _diff_value(iold, inew)
+        if not _is_summary():
+            res.report('%s %r -> %r => diff= [%s]' %(n, iold, inew, diff_value))
+            pass
+        res.add_diff(name[0], ientry)
+
+        if name[0] in g_args.enforce_leaves:
+            res.report("*** [%s] differs: don't compare further ***" % (
+                name[0],))
+            res.stop = True
+            break
+        pass # loop over events/branches
+    res.allgood = res.allgood and fold.allgood and fnew.allgood
+    return res
+
+def _identical_branches(told, tnew, names):
+    """return the set of the `names` branches whose content has the same
+    checksum (see RootUtils.branch_checksum) in the `told` and `tnew` trees.
+    """
+    same = set()
+    for name in names:
+        bo = told.GetBranch(name)
+        bn = tnew.GetBranch(name)
+        if not bo or not bn:
+            continue
+        co = ru.branch_checksum(bo)
+        if co is not None and co == ru.branch_checksum(bn):
+            same.add(name)
+    return same
+
+def _diff_tasks(bulk_names, dump_names, first, last, leaves, jobs):
+    """partition the comparison of the [first, last) entries into tasks for
+    `jobs` workers: the bulk leaves by groups of leaves (and by ranges of
+    entries when there are fewer leaves than workers), the dumped branches
+    by ranges of entries.
+    """
+    def ranges(n):
+        n = max(1, min(n, last - first))
+        return [(first + i*(last-first)//n, first + (i+1)*(last-first)//n)
+                for i in xrange(n)]
+    tasks = []
+    if bulk_names:
+        ngroups = min(jobs, len(bulk_names))
+        for igroup in xrange(ngroups):
+            group = bulk_names[igroup::ngroups]
+            for r in ranges(jobs // ngroups):
+                tasks.append(('bulk', group, r[0], r[1], leaves))
+    if dump_names != []:
+        for r in ranges(jobs):
+            tasks.append(('dump', dump_names, r[0], r[1], leaves))
+    return tasks
+
+def _init_worker(args, cancel):
+    global g_args, g_cancel
+    import signal
+    # ctrl-c is handled by the parent process (see _diff_parallel)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    g_args = args
+    g_cancel = cancel
+
+def _worker_dumpers():
+    """the RootFileDumpers of the current worker process"""
+    global g_dumpers
+    if g_dumpers is None:
+        import PyUtils.Helpers as H
+        with H.ShutUp():
+            g_dumpers = (ru.RootFileDumper(g_args.old, g_args.tree_name),
+                         ru.RootFileDumper(g_args.new, g_args.tree_name))
+    return g_dumpers
+
+def _diff_task(task):
+    """run a task of `_diff_tasks` in a worker process"""
+    engine, names, first, last, leaves = task
+    res = DiffResult(lines=[])
+    if first >= last or _is_cancelled():
+        return res
+    fold, fnew = _worker_dumpers()
+    if engine == 'bulk':
+        _diff_bulk(fold.tree, fnew.tree, names, first, last, res)
+    else:
+        _diff_dump(fold, fnew, '%i:%i' % (first, last), leaves, names, res)
+    if res.stop:
+        # bail out: cancel the other workers
+        g_cancel.set()
+    return res
+
+_POOL_TIMEOUT = 365 * 24 * 3600. # seconds
+
+def _diff_parallel(tasks, jobs, res):
+    """run the `tasks` with `jobs` worker processes and merge their results
+    into `res`, in the order of the tasks.
+    if a worker fails (or on ctrl-c), the other ones are cancelled and the
+    pool is terminated.
+    """
+    import multiprocessing
+    cancel = multiprocessing.Event()
+    pool = multiprocessing.Pool(min(jobs, len(tasks)),
+                                initializer=_init_worker,
+                                initargs=(g_args, cancel))
+    done = False
+    try:
+        results = pool.imap(_diff_task, tasks)
+        for _ in xrange(len(tasks)):
+            # (a wait without timeout can not be interrupted by ctrl-c)
+            res.merge(results.next(timeout=_POOL_TIMEOUT))
+        done = True
+    finally:
+        if done:
+            pool.close()
+        else:
+            cancel.set()
+            pool.terminate()
+        pool.join()
+    return res
+
 @acmdlib.command(name='diff-root')
 @acmdlib.argument('old',
                   help='path to the reference ROOT file to analyze')
@@ -51,6 +690,54 @@ def _is_exit_early():
 @acmdlib.argument('--entries',
                   default='',
                   help='a list of entries (indices, not event numbers) or an expression (like range(3) or 0,2,1 or 0:3) leading to such a list, to compare.')
+@acmdlib.argument('--engine',
+                  choices=g_ALLOWED_ENGINES,
+                  default='auto',
+                  help="""\
+Select the comparison engine.
+  'bulk': the leaves of basic types (and vectors of those) are read by
+          chunks of entries into arrays, compared vectorized.
+          (the other leaves go through the 'dump' engine)
+          in detailed mode, its differences are reported leaf by leaf
+          (for each chunk of entries), not entry by entry.
+  'dump': all the leaves are converted to python values, entry by entry.
+  'auto': 'bulk' if numpy is available, 'dump' otherwise.
+default='%(default)s'.
+allowed: %(choices)s
+"""
+                  )
+@acmdlib.argument('--chunk-size',
+                  type=int,
+                  default=50000,
+                  help='number of entries read at once by the bulk engine [default: %(default)s]')
+@acmdlib.argument('--align-keys',
+                  nargs='*',
+                  default=None,
+                  help='compare the entries holding the same event, identified by the values of these leaves (RunNumber EventNumber if none is given), instead of entry i with entry i. the events present in only one file are reported.')
+@acmdlib.argument('-j', '--jobs',
+                  type=int,
+                  default=1,
+                  help='number of worker processes, each comparing a group of leaves or a range of entries [default: %(default)s]')
+@acmdlib.argument('--atol',
+                  type=float,
+                  default=0.,
+                  help='absolute tolerance: values of bulk leaves differing by at most this are considered equal [default: %(default)s]')
+@acmdlib.argument('--rtol',
+                  type=float,
+                  default=0.,
+                  help='relative tolerance: values of bulk leaves whose difference is at most this times the largest of their absolute values are considered equal [default: %(default)s]')
+@acmdlib.argument('--ulp',
+                  type=int,
+                  default=0,
+                  help='values of floating point bulk leaves at most this number of units in the last place (of their float or double type) apart are considered equal [default: %(default)s]')
+@acmdlib.argument('--tolerance',
+                  nargs='*',
+                  default=None,
+                  help="per-leaf tolerances, as 'PATTERN:key=val[,key=val...]' (keys: atol, rtol, ulp; the others taken from --atol, --rtol, --ulp), like 'el_*:rtol=1e-6,ulp=4'. the last pattern matching a leaf name wins.")
+@acmdlib.argument('--no-precheck',
+                  action='store_true',
+                  default=False,
+                  help='do not first compare the checksums of the uncompressed baskets of each branch (identical files are then reported right away, and only the branches whose checksums differ are compared in detail)')
 @acmdlib.argument('-v', '--verbose',
                   action='store_true',
                   default=False,
@@ -102,6 +789,19 @@ def main(args):
     msg.info('entries:        %s', args.entries)
     msg.info('mode:           %s', args.mode)
     msg.info('error mode:     %s', args.error_mode)
+    msg.info('engine:         %s', args.engine)
+    msg.info('jobs:           %s', args.jobs)
+    msg.info('align keys:     %s', args.align_keys)
+    msg.info('precheck:       %s', not args.no_precheck)
+    msg.info('tolerances:     atol=%s rtol=%s ulp=%s %s', args.atol,
+             args.rtol, args.ulp, args.tolerance or '')
+
+    for spec in args.tolerance or ():
+        try:
+            _parse_tolerance(spec.split(':', 1)[1], (0., 0., 0))
+        except (IndexError, ValueError), err:
+            msg.error('invalid --tolerance [%s]: %s', spec, err)
+            return 1
 
     import PyUtils.Helpers as H
     with H.ShutUp() :
@@ -147,82 +847,134 @@ def main(args):
             for l in diff_leaves:
                 msg.info(' - [%s]', l)
         leaves = leaves - set(args.ignore_leaves)
-        
+
+        # the branches whose content is identical in both files
+        aligned = args.align_keys is not None
+        same = set()
+        if not args.no_precheck:
+            names = [b.GetName().rstrip('\0')
+                     for b in fold.tree.GetListOfBranches()]
+            names = [n for n in names if n in leaves]
+            msg.info('prechecking the checksums of [%s] branches...',
+                     len(names))
+            same = _identical_branches(fold.tree, fnew.tree, names)
+            if (len(same) == len(names) and
+                infos['old']['leaves'] == infos['new']['leaves'] and
+                infos['old']['entries'] == infos['new']['entries']):
+                msg.info('files are identical (same checksums for all the '
+                         '[%s] branches)', len(names))
+                return 0
+            msg.info('[%s] branches have identical checksums', len(same))
+            if aligned:
+                # entries are paired by event: identical branches may differ
+                same = set()
+            leaves = leaves - same
+
         msg.info('comparing [%s] leaves over entries...', len(leaves))
-        all_good = True
-        n_good = 0
-        n_bad = 0
-        import collections
-        from itertools import izip
-        summary = collections.defaultdict(int)
-        for d in izip(fold.dump(args.tree_name, itr_entries),
-                      fnew.dump(args.tree_name, itr_entries)):
-            tree_name, ientry, name, iold = d[0]
-            _,              _,    _, inew = d[1]
-            name[0] = name[0].rstrip('\0')
-            if ((not (name[0] in leaves)) or
-                # FIXME: that's a plain (temporary?) hack
-                name[-1] in args.known_hacks):
-                continue
-            
-            if d[0] == d[1]:
-                diff = False
-                n_good += 1
-                continue
-            n_bad += 1
-            diff = True
 
-            in_synch = d[0][:-1] == d[1][:-1]
-            if not in_synch:
-                if not _is_summary():
-                    print '::sync-old %s' % \
-                          '.'.join(["%03i"%ientry]+map(str, d[0][2]))
-                    print '::sync-new %s' % \
-                          '.'.join(["%03i"%ientry]+map(str, d[1][2]))
-                    pass
-                summary[name[0]] += 1
-                # remember for later
-                fold.allgood = False
-                fnew.allgood = False
-
-                if _is_exit_early():
-                    print "*** exit on first error ***"
-                    break
-                continue
-            
-            n = '.'.join(map(str, ["%03i"%ientry]+name))
-            diff_value = 'N/A'
+        # the leaves compared in bulk, and the branches left to the dump
+        bulk_names = []
+        dump_names = None
+        entry_range = _entry_range(itr_entries, nentries)
+        use_bulk = args.engine != 'dump' and (entry_range is not None or
+                                              aligned)
+        if args.engine != 'dump':
             try:
-                diff_value = 50.*(iold-inew)/(iold+inew)
-                diff_value = '%.8f%%' % (diff_value,)
-            except Exception:
-                pass
-            if not _is_summary():
-                print '%s %r -> %r => diff= [%s]' %(n, iold, inew, diff_value)
-                pass
-            summary[name[0]] += 1
+                import numpy
+            except ImportError:
+                msg.info('numpy is not available: using the dump engine')
+                use_bulk = False
+            if not use_bulk and args.engine == 'bulk':
+                msg.warning('bulk engine not usable for entries [%s]: '
+                            'using the dump engine', itr_entries)
+        if use_bulk:
+            bulk_names = sorted((set(ru.bulk_leaf_names(fold.tree)) &
+                                 set(ru.bulk_leaf_names(fnew.tree)) &
+                                 leaves) - set(args.known_hacks))
+            dump_names = sorted(
+                set(b.GetName().rstrip('\0')
+                    for b in fold.tree.GetListOfBranches()) -
+                set(bulk_names))
+            msg.info('comparing [%s] leaves in bulk...', len(bulk_names))
+        elif (args.atol, args.rtol, args.ulp) != (0., 0., 0) or \
+                args.tolerance:
+            msg.warning('tolerances only apply to the bulk engine: '
+                        'comparing exactly')
+        if same:
+            if dump_names is None:
+                dump_names = [b.GetName().rstrip('\0')
+                              for b in fold.tree.GetListOfBranches()]
+            dump_names = sorted(set(dump_names) - same)
+
+        res = DiffResult()
+        if aligned:
+            keys = args.align_keys or ['RunNumber', 'EventNumber']
+            if args.entries not in (-1, '', '-1'):
+                msg.warning('--entries is ignored when aligning events')
+            if args.jobs > 1:
+                msg.warning('events are aligned serially (no --jobs)')
+            msg.info('aligning events on %s...', keys)
+            try:
+                pairs, n_old, n_new = _align_events(fold.tree, fnew.tree,
+                                                    keys, res)
+            except ImportError:
+                msg.error('aligning events requires numpy')
+                return 1
+            except (RuntimeError, ValueError), err:
+                # (a missing key leaf, or one without a value per entry)
+                msg.error('could not align events on %s: %s', keys, err)
+                return 1
+            msg.info('events in both trees: [%s]', len(pairs))
+            msg.info('events only in old:   [%s]', n_old)
+            msg.info('events only in new:   [%s]', n_new)
+            if bulk_names:
+                _diff_bulk_aligned(fold.tree, fnew.tree, bulk_names, pairs,
+                                   res)
+            if not res.stop and dump_names != []:
+                _diff_dump(fold, fnew, None, leaves, dump_names, res,
+                           pairs=pairs)
+        elif args.jobs > 1 and entry_range is not None:
+            first, last = entry_range
+            tasks = _diff_tasks(bulk_names, dump_names, first, last, leaves,
+                                args.jobs)
+            msg.info('running [%s] tasks over [%s] workers...',
+                     len(tasks), args.jobs)
+            _diff_parallel(tasks, args.jobs, res)
+        else:
+            if args.jobs > 1:
+                msg.warning('entries [%s] are not a range: running serially',
+                            itr_entries)
+            if bulk_names:
+                first, last = entry_range
+                _diff_bulk(fold.tree, fnew.tree, bulk_names, first, last, res)
+            if not res.stop and dump_names != []:
+                _diff_dump(fold, fnew, itr_entries, leaves, dump_names, res)
+        n_good = res.n_good
+        n_bad = res.n_bad
 
-            if name[0] in args.enforce_leaves:
-                msg.info("don't compare further")
-                all_good = False
-                break
-            pass # loop over events/branches
-        
         msg.info('Found [%s] identical leaves', n_good)
         msg.info('Found [%s] different leaves', n_bad)
+        if res.n_tolerated:
+            msg.info('(of which [%s] identical within tolerances)',
+                     res.n_tolerated)
+
+        if _is_summary():
+            for l in _rel_hist_lines(res):
+                msg.info(l)
 
         if not _is_summary():
-            keys = sorted(summary.keys())
+            keys = sorted(res.summary.keys())
             for n in keys:
-                v = summary[n]
-                msg.info(' [%s]: %i leaves differ', n, v)
+                v = res.summary[n]
+                msg.info(' [%s]: %i leaves differ (first at entry [%i])',
+                         n, v, res.first_diff[n])
                 pass
             pass
         
-        if (not fold.allgood) or (not fnew.allgood):
+        if not res.allgood:
             msg.info('NOTE: there were errors during the dump')
-            msg.info('fold.allgood: %s' % fold.allgood)
-            msg.info('fnew.allgood: %s' % fnew.allgood)
+            # (the dumpers of the workers, with --jobs, are merged into res)
+            msg.info('allgood: %s' % res.allgood)
             n_bad += 0.5
         return n_bad
     
@@ -0,0 +1,67 @@
+# @file PyUtils.scripts.size_trend
+# @purpose show the sizes of POOL containers over the last releases, from a
+#          size-report store filled by 'chk-file --db'
+# @date October 2026
+
+__version__ = "$Revision$"
+__doc__ = "show the sizes of POOL containers over the last releases."
+
+
+### imports -------------------------------------------------------------------
+import PyUtils.acmdlib as acmdlib
+
+@acmdlib.command(name='size-trend')
+@acmdlib.argument('db',
+                  help='path to the size-report store (see chk-file --db)')
+@acmdlib.argument('containers',
+                  nargs='*',
+                  help='names of the containers to show (default: all)')
+@acmdlib.argument('--stream',
+                  default=None,
+                  help='only consider the reports of that stream')
+@acmdlib.argument('--last',
+                  type=int,
+                  default=20,
+                  help='number of releases to consider [default: %(default)s]')
+@acmdlib.argument('--threshold',
+                  type=float,
+                  default=0.05,
+                  help="""relative growth of the disk size per event above
+                  which a release is flagged [default: %(default)s]""")
+@acmdlib.argument('--regressions-only',
+                  action='store_true',
+                  default=False,
+                  help='only print the flagged regressions')
+def main(args):
+    """show the sizes of POOL containers over the last releases.
+    """
+    import PyUtils.PoolReportDb as PRD
+    db = PRD.PoolReportDb(args.db)
+
+    names = args.containers or db.containers(stream=args.stream)
+    if not args.regressions_only:
+        for name in names:
+            trend = db.trend(name, stream=args.stream, last=args.last)
+            print "=" * 80
+            print "::: [%s]" % (name,)
+            print "%-24s %6s %10s %12s %12s" % (
+                "release", "files", "events", "Mem/Evt", "Disk/Evt")
+            print "-" * 80
+            for release, nfiles, nevents, mem, disk in trend:
+                # (no memory size in the reports gathered in fast mode)
+                mem = "%9.3f kb" % mem if mem is not None else "%12s" % "N/A"
+                print "%-24s %6i %10i %s %9.3f kb" % (
+                    release, nfiles, nevents, mem, disk)
+        print "=" * 80
+
+    flags = db.regressions(names=names, stream=args.stream,
+                           last=args.last, threshold=args.threshold)
+    print "::: found [%i] regression(s) (disk size/evt > +%.1f%%)" % (
+        len(flags), 100. * args.threshold)
+    for name, prev_rel, rel, prev_sz, sz in flags:
+        print "[ERR] %9.3f kb (%s) ==> %9.3f kb (%s) %+7.1f%% | %s" % (
+            prev_sz, prev_rel, sz, rel, 100. * (sz - prev_sz) / prev_sz, name)
+    db.close()
+    if flags:
+        return 1
+    return 0
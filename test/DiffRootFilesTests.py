@@ -0,0 +1,622 @@
+# @file PyUtils/test/DiffRootFilesTests.py
+# @purpose unit tests of the pure-python parts of PyUtils.scripts.diff_root_files
+# @date October 2026
+from __future__ import with_statement
+
+import unittest, sys
+
+import PyUtils.scripts.diff_root_files as D
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class DiffValueTest(unittest.TestCase):
+
+    def test_values(self):
+        self.assertEqual(D._diff_value(3, 1), '25.00000000%')
+        self.assertEqual(D._diff_value(1., 1.), '0.00000000%')
+        self.assertEqual(D._diff_value(1, -1), 'N/A')
+        self.assertEqual(D._diff_value('a', 'b'), 'N/A')
+
+    def test_numpy_scalars(self):
+        if np is None:
+            return
+        import warnings
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.assertEqual(D._diff_value(np.float32(3), np.float32(1)),
+                             '25.00000000%')
+            # a zero sum: no nan%/inf%, nor RuntimeWarning
+            self.assertEqual(D._diff_value(np.float64(0.), np.float64(0.)),
+                             'N/A')
+            self.assertEqual(D._diff_value(np.int32(1), np.int32(-1)),
+                             'N/A')
+        self.assertEqual(w, [])
+
+    pass # class DiffValueTest
+
+def _ulps_away(x, n, dtype='float64'):
+    """the value `n` units in the last place above `x` (of the same sign)"""
+    itype = 'int32' if dtype == 'float32' else 'int64'
+    return (np.array([x], dtype=dtype).view(itype) + n).view(dtype)[0]
+
+class ToleranceTest(unittest.TestCase):
+
+    def test_parse_tolerance(self):
+        pt = D._parse_tolerance
+        self.assertEqual(pt('', (0., 0., 0)), (0., 0., 0))
+        self.assertEqual(pt('atol=1e-3', (0., 0.5, 2)), (1e-3, 0.5, 2))
+        self.assertEqual(pt('rtol=0.1, ulp=4', (1., 0., 0)), (1., 0.1, 4))
+        self.assertEqual(pt('ulp=3,', (0., 0., 0)), (0., 0., 3))
+        self.assertTrue(isinstance(pt('ulp=3', (0., 0., 0))[2], int))
+        self.assertRaises(ValueError, pt, 'btol=1', (0., 0., 0))
+        self.assertRaises(ValueError, pt, 'ulp=1.5', (0., 0., 0))
+        self.assertRaises(ValueError, pt, 'atol', (0., 0., 0))
+
+    def test_ulp_distance(self):
+        if np is None:
+            return
+        for x in (1., 1e-300, 1e300, -3.5, 5e-324):
+            for n in (1, 4, 1000):
+                a = np.array([x, _ulps_away(x, n)])
+                b = np.array([_ulps_away(x, n), x])
+                self.assertEqual(
+                    D._ulp_distance(a, b, np.float64).tolist(), [n, n],
+                    (x, n))
+        # across zero
+        tiny = np.array([5e-324, 0., -0.])
+        self.assertEqual(D._ulp_distance(tiny, -tiny, np.float64).tolist(),
+                         [2, 0, 0])
+        # far apart values: no overflow
+        big = np.finfo(np.float64).max
+        self.assertEqual(
+            D._ulp_distance(np.array([big]), np.array([-big]),
+                            np.float64).tolist(),
+            [2 * 0x7fefffffffffffff])
+        # single precision values
+        x = np.float32(1.5)
+        a = np.array([x, x, -x], dtype=np.float32)
+        b = np.array([_ulps_away(x, 1, 'float32'),
+                      _ulps_away(x, 1000, 'float32'),
+                      -_ulps_away(x, 4, 'float32')], dtype=np.float32)
+        self.assertEqual(D._ulp_distance(a, b, np.float32).tolist(),
+                         [1, 1000, 4])
+
+    def test_within_tolerance(self):
+        if np is None:
+            return
+        a = np.array([1., 100., 1e300, 1e300, 0.])
+        b = np.array([1.001, 101., _ulps_away(1e300, 4),
+                      _ulps_away(1e300, 5), 1e-3])
+        wt = D._within_tolerance
+        self.assertEqual(wt(a, b, (0., 0., 0), None).tolist(),
+                         [False] * 5)
+        self.assertEqual(wt(a, b, (1e-3, 0., 0), None).tolist(),
+                         [True, False, False, False, True])
+        self.assertEqual(wt(a, b, (0., 0.01, 0), None).tolist(),
+                         [True, True, True, True, False])
+        self.assertEqual(wt(a, b, (0., 0., 4), np.float64).tolist(),
+                         [False, False, True, False, False])
+        # no ulp tolerance without a float type
+        self.assertEqual(wt(a, b, (0., 0., 4), None).tolist(), [False] * 5)
+
+    pass # class ToleranceTest
+
+class _FakeLeaf(object):
+    def __init__(self, type_name):
+        self.type_name = type_name
+    def GetTypeName(self):
+        return self.type_name
+    def GetLen(self):
+        return 1
+    def GetLeafCount(self):
+        return None
+
+class _FakeLeaves(list):
+    def GetEntriesFast(self):
+        return len(self)
+    def At(self, i):
+        return self[i]
+
+class _FakeBranch(object):
+    def __init__(self, tree, name, type_name):
+        self.tree = tree
+        self.name = name
+        self.leaves = _FakeLeaves([_FakeLeaf(type_name)])
+    def GetListOfLeaves(self):
+        return self.leaves
+    def GetEntry(self, i):
+        setattr(self.tree, self.name, self.tree.columns[self.name][1][i])
+        return 8
+
+class _FakeTree(object):
+    """a tree of `columns`: leaf name -> (type name, values)"""
+    def __init__(self, **columns):
+        self.columns = columns
+    def GetEntries(self):
+        return len(self.columns.values()[0][1])
+    def GetBranch(self, name):
+        if name not in self.columns:
+            return None
+        return _FakeBranch(self, name, self.columns[name][0])
+
+def _fake_read_leaf_chunk(tree, name, first, nentries):
+    # (TTree::Draw: the values as doubles, the ones of a vector flattened)
+    values, entries = [], []
+    for i, v in enumerate(tree.columns[name][1][first:first+nentries]):
+        v = v if isinstance(v, list) else [v]
+        values.extend(v)
+        entries.extend([first + i] * len(v))
+    return (np.array(values, dtype=np.float64),
+            np.array(entries, dtype=np.int64))
+
+class _FakeArgs(object):
+    """the command line options the bulk comparison depends on"""
+    def __init__(self, **kw):
+        self.chunk_size = 2
+        self.mode = 'detailed'
+        self.error_mode = 'resilient'
+        self.enforce_leaves = ()
+        self.atol = 0.
+        self.rtol = 0.
+        self.ulp = 0
+        self.tolerance = None
+        self.tree_name = 'CollectionTree'
+        self.known_hacks = ()
+        self.__dict__.update(kw)
+
+class _BulkTestCase(unittest.TestCase):
+    """runs the bulk comparison over fake trees (see _FakeTree)"""
+
+    def setUp(self):
+        self._read_leaf_chunk = D.ru.read_leaf_chunk
+        self._args = D.g_args
+        D.ru.read_leaf_chunk = _fake_read_leaf_chunk
+        D.g_args = _FakeArgs()
+        D.g_tolerances.clear()
+
+    def tearDown(self):
+        D.ru.read_leaf_chunk = self._read_leaf_chunk
+        D.g_args = self._args
+        D.g_tolerances.clear()
+
+    pass # class _BulkTestCase
+
+class EventIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self._read_leaf_chunk = D.ru.read_leaf_chunk
+        D.ru.read_leaf_chunk = _fake_read_leaf_chunk
+
+    def tearDown(self):
+        D.ru.read_leaf_chunk = self._read_leaf_chunk
+
+    def test_index(self):
+        if np is None:
+            return
+        tree = _FakeTree(RunNumber=('UInt_t', [2, 1, 2, 1, 1]),
+                         EventNumber=('UInt_t', [5, 7, 3, 7, 1]))
+        index, ndups = D._event_index(tree, ['RunNumber', 'EventNumber'])
+        self.assertEqual(index, [((1, 1, 0), 4), ((1, 7, 0), 1),
+                                 ((1, 7, 1), 3), ((2, 3, 0), 2),
+                                 ((2, 5, 0), 0)])
+        self.assertEqual(ndups, 1)
+        for key, _ in index:
+            for v in key:
+                self.assertTrue(isinstance(v, (int, long)))
+
+    def test_64bit_keys(self):
+        if np is None:
+            return
+        big = 2**60
+        evts = [big + 3, big + 1, 2**64 - 1, big + 2, 2**64 - 2]
+        tree = _FakeTree(RunNumber=('UInt_t', [1] * 5),
+                         EventNumber=('ULong64_t', evts))
+        index, ndups = D._event_index(tree, ['RunNumber', 'EventNumber'])
+        # (as doubles, the event numbers would collide)
+        self.assertEqual(ndups, 0)
+        self.assertEqual([k[1] for k, _ in index], sorted(evts))
+        self.assertEqual([i for _, i in index], [1, 3, 0, 4, 2])
+        tree = _FakeTree(EventNumber=('Long64_t', [-2**62 - 1, 2**62 + 1,
+                                                    -2**62]))
+        index, ndups = D._event_index(tree, ['EventNumber'])
+        self.assertEqual([k[0] for k, _ in index],
+                         [-2**62 - 1, -2**62, 2**62 + 1])
+
+    def test_not_one_value_per_entry(self):
+        if np is None:
+            return
+        def _read_leaf_chunk(tree, name, first, nentries):
+            return np.zeros(3), np.array([0, 0, 1])
+        D.ru.read_leaf_chunk = _read_leaf_chunk
+        tree = _FakeTree(el_n=('vector<int>', [[1, 2], [3]]))
+        self.assertRaises(ValueError, D._event_index, tree, ['el_n'])
+
+    pass # class EventIndexTest
+
+class AlignTest(_BulkTestCase):
+
+    def test_align(self):
+        if np is None:
+            return
+        told = _FakeTree(RunNumber=('UInt_t', [1, 1, 1, 2]),
+                         EventNumber=('UInt_t', [1, 2, 3, 1]))
+        tnew = _FakeTree(RunNumber=('UInt_t', [2, 1, 1, 3]),
+                         EventNumber=('UInt_t', [1, 3, 1, 1]))
+        res = D.DiffResult(lines=[])
+        pairs, n_old, n_new = D._align_events(told, tnew,
+                                              ['RunNumber', 'EventNumber'],
+                                              res)
+        self.assertEqual(pairs, [(0, 2), (2, 1), (3, 0)])
+        self.assertEqual((n_old, n_new), (1, 1))
+        self.assertEqual(res.n_bad, 2)
+        self.assertEqual(res.lines, ['::only-old 001 (1, 2)',
+                                     '::only-new 003 (3, 1)'])
+
+    def test_missing_key(self):
+        if np is None:
+            return
+        def _read_leaf_chunk(tree, name, first, nentries):
+            raise RuntimeError('no leaf [%s]' % (name,))
+        D.ru.read_leaf_chunk = _read_leaf_chunk
+        told = _FakeTree(EventNumber=('UInt_t', [1, 2]))
+        self.assertRaises(RuntimeError, D._align_events, told, told,
+                          ['EvtNumber'], D.DiffResult(lines=[]))
+
+    def test_diff_aligned(self):
+        if np is None:
+            return
+        told = _FakeTree(x=('Float_t', [1., 2., 3., 4.]),
+                         v=('vector<float>', [[1.], [2., 3.], [], [4.]]))
+        tnew = _FakeTree(x=('Float_t', [4., 1.5, 2., 3.]),
+                         v=('vector<float>', [[4.], [1.], [2., 3.5], []]))
+        # (the pairs are in the order of the keys, not of the entries)
+        pairs = [(3, 0), (0, 1), (1, 2), (2, 3)]
+        res = D.DiffResult(lines=[])
+        D._diff_bulk_aligned(told, tnew, ['x', 'v'], pairs, res)
+        self.assertEqual(res.first_diff, {'x': 0, 'v': 1})
+        self.assertEqual(dict(res.summary), {'x': 1, 'v': 1})
+        self.assertEqual(res.n_good, 3 + 3)
+        self.assertEqual(res.lines, ['000.x 1.0 -> 1.5 => diff= [%s]' %
+                                     D._diff_value(1., 1.5),
+                                     '001.v.1 3.0 -> 3.5 => diff= [%s]' %
+                                     D._diff_value(3., 3.5)])
+
+    def test_diff_aligned_first_diff(self):
+        if np is None:
+            return
+        told = _FakeTree(x=('Int_t', [0, 1, 2, 3]))
+        tnew = _FakeTree(x=('Int_t', [9, 1, 2, 8]))
+        res = D.DiffResult(lines=[])
+        D.g_args.chunk_size = 10
+        D._diff_bulk_aligned(told, tnew, ['x'], [(3, 3), (0, 0), (1, 1)],
+                             res)
+        self.assertEqual(res.first_diff, {'x': 0})
+        self.assertEqual(res.summary['x'], 2)
+
+    def test_diff_aligned_unsync(self):
+        if np is None:
+            return
+        told = _FakeTree(v=('vector<int>', [[1, 2], [3]]))
+        tnew = _FakeTree(v=('vector<int>', [[3], [1, 2, 4]]))
+        res = D.DiffResult(lines=[])
+        D._diff_bulk_aligned(told, tnew, ['v'], [(1, 0), (0, 1)], res)
+        self.assertEqual(res.n_good, 1)
+        self.assertEqual(res.first_diff, {'v': 0})
+        self.assertEqual(res.summary['v'], 3)
+        self.assertFalse(res.allgood)
+        self.assertEqual(res.lines, ['::sync-old 000.v (2 elements)',
+                                     '::sync-new 000.v (3 elements)'])
+
+    pass # class AlignTest
+
+class _FakeDumper(object):
+    """dumps the (tree name, entry, [leaf name, index...], value) tuples of
+    the entries of a _FakeTree, as RootFileDumper.dump"""
+    def __init__(self, tree):
+        self.tree = tree
+        self.allgood = True
+    def dump(self, tree_name, itr_entries, leaves=None):
+        for i in itr_entries:
+            for name in sorted(leaves or self.tree.columns):
+                v = self.tree.columns[name][1][i]
+                if isinstance(v, list):
+                    for j, x in enumerate(v):
+                        yield tree_name, i, [name, j], x
+                else:
+                    yield tree_name, i, [name], v
+
+class BulkTest(_BulkTestCase):
+
+    def test_entry_range(self):
+        self.assertEqual(D._entry_range(-1, 10), (0, 10))
+        self.assertEqual(D._entry_range('', 10), (0, 10))
+        self.assertEqual(D._entry_range('-1', 10), (0, 10))
+        self.assertEqual(D._entry_range(4, 10), (0, 4))
+        self.assertEqual(D._entry_range('4', 10), (0, 4))
+        self.assertEqual(D._entry_range(20, 10), (0, 10))
+        self.assertEqual(D._entry_range('2:5', 10), (2, 5))
+        self.assertEqual(D._entry_range('2:', 10), (2, 10))
+        self.assertEqual(D._entry_range(':-2', 10), (0, 8))
+        self.assertEqual(D._entry_range('2:5:1', 10), (2, 5))
+        self.assertEqual(D._entry_range('5:2', 10), (5, 5))
+        # not a contiguous range
+        self.assertEqual(D._entry_range('2:8:2', 10), None)
+        self.assertEqual(D._entry_range('a:b', 10), None)
+        self.assertEqual(D._entry_range('[1,2]', 10), None)
+
+    def test_chunks(self):
+        if np is None:
+            return
+        told = _FakeTree(x=('Float_t', [0., 1., 2., 3., 4., 5., 6.]))
+        tnew = _FakeTree(x=('Float_t', [9., 1., 2., 8., 4., 7., 6.]))
+        # [1, 6) by chunks of 2 entries: [1, 3), [3, 5), [5, 6)
+        res = D._diff_bulk(told, tnew, ['x'], 1, 6, D.DiffResult(lines=[]))
+        self.assertEqual(res.n_good, 3)
+        self.assertEqual(res.summary['x'], 2)
+        self.assertEqual(res.first_diff, {'x': 3})
+        self.assertEqual(len(res.lines), 2)
+        self.assertTrue(res.lines[0].startswith('003.x 3.0 -> 8.0 '))
+        self.assertTrue(res.lines[1].startswith('005.x 5.0 -> 7.0 '))
+        for chunk_size in (1, 3, 100):
+            D.g_args.chunk_size = chunk_size
+            other = D._diff_bulk(told, tnew, ['x'], 1, 6,
+                                 D.DiffResult(lines=[]))
+            self.assertEqual((other.n_good, other.n_bad, other.first_diff,
+                              other.lines),
+                             (res.n_good, res.n_bad, res.first_diff,
+                              res.lines))
+
+    def test_vectors(self):
+        if np is None:
+            return
+        told = _FakeTree(v=('vector<float>', [[1., 2.], [3.], [], [4., 5.]]))
+        tnew = _FakeTree(v=('vector<float>', [[1., 2.], [3., 0.], [],
+                                              [4., 6.]]))
+        res = D._diff_bulk(told, tnew, ['v'], 0, 4, D.DiffResult(lines=[]))
+        # entry 1 is out of sync: all its values differ
+        self.assertEqual(res.n_good, 3)
+        self.assertEqual(res.summary['v'], 2 + 1)
+        self.assertEqual(res.first_diff, {'v': 1})
+        self.assertFalse(res.allgood)
+        self.assertFalse(res.stop)
+        self.assertEqual(res.lines[:2], ['::sync-old 001.v (1 elements)',
+                                         '::sync-new 001.v (2 elements)'])
+        self.assertTrue(res.lines[2].startswith('003.v.1 5.0 -> 6.0 '))
+
+    def test_summary(self):
+        if np is None:
+            return
+        D.g_args.mode = 'summary'
+        told = _FakeTree(x=('Double_t', [1., 2., 3.]))
+        tnew = _FakeTree(x=('Double_t', [1., 2.5, 3.5]))
+        res = D._diff_bulk(told, tnew, ['x'], 0, 3, D.DiffResult(lines=[]))
+        self.assertEqual(res.lines, [])
+        self.assertEqual(res.first_diff, {'x': 1})
+        self.assertEqual(sum(res.rel_hists['x']), 2)
+
+    def test_bailout(self):
+        if np is None:
+            return
+        D.g_args.error_mode = 'bailout'
+        told = _FakeTree(v=('vector<int>', [[1], [2], [3, 4], [5]]),
+                         w=('vector<int>', [[1], [2], [3], [4]]))
+        tnew = _FakeTree(v=('vector<int>', [[1], [0], [3], [5]]),
+                         w=('vector<int>', [[1], [2], [], [4]]))
+        res = D._diff_bulk(told, tnew, ['v', 'w'], 0, 4,
+                           D.DiffResult(lines=[]))
+        # (a value difference goes on, an out-of-sync entry stops)
+        self.assertTrue(res.stop)
+        self.assertEqual(res.lines[-1], '*** exit on first error ***')
+        self.assertEqual(res.first_diff, {'v': 1})
+        self.assertEqual(res.n_bad, 1 + 2)
+        # the rest of the chunk is compared, not the following leaves
+        self.assertEqual(res.n_good, 2)
+        self.assertFalse('w' in res.summary)
+
+    def test_enforce_leaves(self):
+        if np is None:
+            return
+        D.g_args.enforce_leaves = ('x',)
+        told = _FakeTree(x=('Int_t', [1, 2, 3, 4]), y=('Int_t', [1, 2, 3, 4]))
+        tnew = _FakeTree(x=('Int_t', [1, 2, 3, 0]), y=('Int_t', [0, 2, 3, 4]))
+        res = D._diff_bulk(told, tnew, ['y', 'x'], 0, 4,
+                           D.DiffResult(lines=[]))
+        self.assertTrue(res.stop)
+        self.assertEqual(dict(res.summary), {'y': 1, 'x': 1})
+        self.assertEqual(res.lines[-1],
+                         "*** [x] differs: don't compare further ***")
+        # an enforced leaf which does not differ goes on
+        res = D._diff_bulk(told, told, ['x', 'y'], 0, 4,
+                           D.DiffResult(lines=[]))
+        self.assertFalse(res.stop)
+        self.assertEqual(res.n_good, 8)
+
+    def test_nan(self):
+        if np is None:
+            return
+        nan = float('nan')
+        told = _FakeTree(x=('Float_t', [nan, nan, 1.]))
+        tnew = _FakeTree(x=('Float_t', [nan, 1., nan]))
+        res = D._diff_bulk(told, tnew, ['x'], 0, 3, D.DiffResult(lines=[]))
+        self.assertEqual((res.n_good, res.n_bad), (1, 2))
+        # the dump engine agrees
+        dres = D.DiffResult(lines=[])
+        D._diff_dump(_FakeDumper(told), _FakeDumper(tnew), xrange(3), ['x'],
+                     None, dres)
+        self.assertEqual((dres.n_good, dres.n_bad), (1, 2))
+        self.assertEqual(dres.first_diff, res.first_diff)
+        self.assertTrue(D._same_value(nan, nan))
+        self.assertFalse(D._same_value(nan, 1.))
+        self.assertTrue(D._same_value('a', 'a'))
+
+    pass # class BulkTest
+
+class _FakeBuffer(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+    def SetReadMode(self):
+        pass
+    def SetBufferOffset(self, offset):
+        self.offset = offset
+    def ReadFastArray(self, payload, nbytes):
+        for i, c in enumerate(self.data[self.offset:self.offset+nbytes]):
+            payload[i] = ord(c) - 256 if ord(c) > 127 else ord(c)
+
+class _FakeBasket(object):
+    KEYLEN = 4
+    def __init__(self, payload, nev):
+        self.buf = 'k' * self.KEYLEN + payload
+        self.nev = nev
+    def GetKeylen(self):
+        return self.KEYLEN
+    def GetLast(self):
+        return len(self.buf)
+    def GetBufferRef(self):
+        return _FakeBuffer(self.buf)
+    def GetNevBuf(self):
+        return self.nev
+
+class _FakeBasketBranch(object):
+    """a (fixed-size) branch of written `baskets`: (payload, nentries)
+    pairs, plus `unwritten` entries in the basket being filled
+    """
+    def __init__(self, name, baskets, unwritten=0, readable=True):
+        self.name = name
+        self.baskets = [_FakeBasket(p, n) for p, n in baskets]
+        self.unwritten = unwritten
+        self.readable = readable
+    def GetName(self):
+        return self.name
+    def GetWriteBasket(self):
+        return len(self.baskets)
+    def GetEntries(self):
+        return sum(b.nev for b in self.baskets) + self.unwritten
+    def GetBasketEntry(self):
+        entries = [0]
+        for b in self.baskets:
+            entries.append(entries[-1] + b.nev)
+        return entries
+    def GetEntryOffsetLen(self):
+        return 0
+    def GetBasket(self, i):
+        if not self.readable:
+            return None
+        return self.baskets[i]
+    def DropBaskets(self, option):
+        pass
+    def GetListOfBranches(self):
+        return []
+
+class _FakeBranchTree(object):
+    def __init__(self, *branches):
+        self.branches = dict((b.GetName(), b) for b in branches)
+    def GetBranch(self, name):
+        return self.branches.get(name)
+
+class ChecksumTest(unittest.TestCase):
+
+    def test_branch_checksum(self):
+        a = _FakeBasketBranch('el_n', [('\x01\x02', 2), ('\x03', 1)])
+        b = _FakeBasketBranch('el_n', [('\x01\x02', 2), ('\x03', 1)])
+        c = _FakeBasketBranch('el_n', [('\x01\x02', 2), ('\x04', 1)])
+        self.assertEqual(D.ru.basket_payload(a, 0), '\x01\x02')
+        self.assertTrue(D.ru.branch_checksum(a) is not None)
+        self.assertEqual(D.ru.branch_checksum(a), D.ru.branch_checksum(b))
+        self.assertNotEqual(D.ru.branch_checksum(a), D.ru.branch_checksum(c))
+        # the same content in other baskets
+        d = _FakeBasketBranch('el_n', [('\x01', 1), ('\x02\x03', 2)])
+        self.assertNotEqual(D.ru.branch_checksum(a), D.ru.branch_checksum(d))
+
+    def test_unwritten_entries(self):
+        # some, or all, of the entries are not in a written basket
+        for baskets in ([('\x01', 1)], []):
+            br = _FakeBasketBranch('el_n', baskets, unwritten=3)
+            self.assertEqual(D.ru.branch_checksum(br), None)
+        self.assertEqual(D.ru.branch_checksum(
+            _FakeBasketBranch('el_n', [('\x01', 1)], readable=False)), None)
+        # no entries at all
+        self.assertTrue(
+            D.ru.branch_checksum(_FakeBasketBranch('el_n', [])) is not None)
+
+    def test_identical_branches(self):
+        told = _FakeBranchTree(
+            _FakeBasketBranch('a', [('\x01', 1)]),
+            _FakeBasketBranch('b', [('\x02', 1)]))
+        tnew = _FakeBranchTree(
+            _FakeBasketBranch('a', [('\x01', 1)]),
+            _FakeBasketBranch('b', [('\x02', 1)]))
+        # the fast path: all the branches are identical
+        self.assertEqual(D._identical_branches(told, tnew, ['a', 'b']),
+                         set(['a', 'b']))
+
+    def test_fallback_per_branch(self):
+        told = _FakeBranchTree(
+            _FakeBasketBranch('same', [('\x01', 1)]),
+            _FakeBasketBranch('differ', [('\x02', 1)]),
+            _FakeBasketBranch('unwritten', [], unwritten=1),
+            _FakeBasketBranch('old_only', [('\x03', 1)]))
+        tnew = _FakeBranchTree(
+            _FakeBasketBranch('same', [('\x01', 1)]),
+            _FakeBasketBranch('differ', [('\x05', 1)]),
+            _FakeBasketBranch('unwritten', [], unwritten=1))
+        # only 'same' is skipped, the other ones are compared entry-wise
+        self.assertEqual(
+            D._identical_branches(told, tnew, ['same', 'differ', 'unwritten',
+                                               'old_only']),
+            set(['same']))
+
+    pass # class ChecksumTest
+
+def _fake_task(task):
+    import time
+    if task == 'fail':
+        raise ValueError('worker failure')
+    if task == 'slow':
+        time.sleep(60)
+    res = D.DiffResult(lines=[])
+    res.n_good = task
+    res.report('task %i' % task)
+    return res
+_fake_task.__name__ = '_diff_task'
+_fake_task.__module__ = D.__name__
+
+class DiffParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self._diff_task, D._diff_task = D._diff_task, _fake_task
+
+    def tearDown(self):
+        D._diff_task = self._diff_task
+
+    def test_merge_in_order(self):
+        res = D._diff_parallel([1, 2, 3, 4], 2, D.DiffResult(lines=[]))
+        self.assertEqual(res.n_good, 10)
+        self.assertEqual(res.lines, ['task 1', 'task 2', 'task 3', 'task 4'])
+
+    def test_worker_failure(self):
+        import time
+        start = time.time()
+        self.assertRaises(ValueError, D._diff_parallel,
+                          ['fail', 'slow', 'slow'], 3, D.DiffResult(lines=[]))
+        # the slow workers were terminated, not waited for
+        self.assertTrue(time.time() - start < 30)
+
+    pass # class DiffParallelTest
+
+### tests ---------------------------------------------------------------------
+def main():
+    loader = unittest.TestLoader()
+    testSuite = loader.loadTestsFromModule( sys.modules[ __name__ ] )
+
+    runner = unittest.TextTestRunner( verbosity = 2 )
+    if not runner.run( testSuite ).wasSuccessful():
+        return 1
+    print "OK"
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
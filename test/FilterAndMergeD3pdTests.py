@@ -0,0 +1,874 @@
+# @file PyUtils/test/FilterAndMergeD3pdTests.py
+# @purpose unit tests of the pure-python parts of filter-and-merge-d3pd.py
+# @date October 2026
+from __future__ import with_statement
+
+import unittest, sys, os
+import imp
+import shutil
+import tempfile
+
+def _load_script():
+    fname = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, 'bin', 'filter-and-merge-d3pd.py')
+    return imp.load_source('filter_and_merge_d3pd', fname)
+fm = _load_script()
+
+class _TmpDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='fm_d3pd_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def write(self, name, content):
+        fname = os.path.join(self.tmpdir, name)
+        with open(fname, 'w') as f:
+            f.write(content)
+        return fname
+
+def _grl(*ranges):
+    return fm.GoodRunsList([fm.LBRange(*r) for r in ranges])
+
+def _ranges(grl):
+    return [(r.run, r.lbmin, r.lbmax) for r in grl]
+
+class GoodRunsListTest(unittest.TestCase):
+
+    def test_merge_ranges(self):
+        grl = _grl((1, 5, 10), (1, 1, 3), (1, 4, 4), (1, 8, 12), (1, 20, 20),
+                   (2, 1, 1))
+        self.assertEqual(_ranges(grl), [(1, 1, 12), (1, 20, 20), (2, 1, 1)])
+        self.assertEqual(len(grl), 3)
+        self.assertEqual(grl.runs(), [1, 2])
+
+    def test_contains(self):
+        grl = _grl((1, 1, 3), (1, 10, 20), (2, 5, 5))
+        expected = {
+            (1, 0): False, (1, 1): True, (1, 2): True, (1, 3): True,
+            (1, 4): False, (1, 9): False, (1, 10): True, (1, 15): True,
+            (1, 20): True, (1, 21): False, (2, 4): False, (2, 5): True,
+            (3, 1): False,
+            }
+        # in order, out of order and with repeated runs (exercising the cache)
+        queries = sorted(expected) + sorted(expected, reverse=True)
+        queries += [(1, 15), (1, 2), (2, 5), (1, 15), (1, 21)]
+        for run, lb in queries:
+            self.assertEqual(grl.contains(run, lb), expected[(run, lb)],
+                             (run, lb))
+
+    def test_mask(self):
+        if fm.np is None:
+            return
+        grl = _grl((1, 1, 3), (1, 10, 20), (2, 5, 5))
+        runs = [1, 1, 1, 1, 2, 2, 3]
+        lbs  = [0, 2, 5, 20, 5, 6, 1]
+        self.assertEqual(list(grl.mask(runs, lbs)),
+                         [grl.contains(r, l) for r, l in zip(runs, lbs)])
+
+    def test_union(self):
+        a = _grl((1, 1, 5), (2, 1, 1))
+        b = _grl((1, 6, 8), (3, 2, 2))
+        self.assertEqual(_ranges(a.union(b)),
+                         [(1, 1, 8), (2, 1, 1), (3, 2, 2)])
+        # the operands are left untouched
+        self.assertEqual(_ranges(a), [(1, 1, 5), (2, 1, 1)])
+
+    def test_intersection(self):
+        a = _grl((1, 1, 10), (1, 20, 30), (2, 1, 5))
+        b = _grl((1, 5, 25), (2, 6, 9), (3, 1, 1))
+        self.assertEqual(_ranges(a.intersection(b)),
+                         [(1, 5, 10), (1, 20, 25)])
+        self.assertEqual(_ranges(b.intersection(a)),
+                         [(1, 5, 10), (1, 20, 25)])
+
+    pass # class GoodRunsListTest
+
+_GRL_XML = """\
+<?xml version="1.0" ?>
+<LumiRangeCollection>
+   <NamedLumiRange>
+      <Name>test</Name>
+      <LumiBlockCollection>
+         <Run PrescaleRD0="8">%i</Run>
+         <LBRange Start="%i" End="%i"/>
+         <LBRange Start="%i" End="%i"/>
+      </LumiBlockCollection>
+   </NamedLumiRange>
+</LumiRangeCollection>
+"""
+
+class InterpretGrlTest(_TmpDirTest):
+
+    def test_dat_and_xml(self):
+        dat = self.write('a.dat', '1 1 10\n2 3 4\n')
+        xml = self.write('b.xml', _GRL_XML % (1, 5, 20, 30, 31))
+        self.assertEqual(_ranges(fm.interpret_grl(dat)),
+                         [(1, 1, 10), (2, 3, 4)])
+        self.assertEqual(_ranges(fm.interpret_grl(xml)),
+                         [(1, 5, 20), (1, 30, 31)])
+        self.assertEqual(_ranges(fm.interpret_grl([dat, xml])),
+                         [(1, 1, 20), (1, 30, 31), (2, 3, 4)])
+        self.assertEqual(
+            _ranges(fm.interpret_grl([dat, xml], mode='intersection')),
+            [(1, 5, 10)])
+
+    def test_errors(self):
+        self.assertRaises(OSError, fm.interpret_grl,
+                          os.path.join(self.tmpdir, 'missing.dat'))
+        dat = self.write('a.dat', '1 1 10\n')
+        self.assertRaises(ValueError, fm.interpret_grl, dat, mode='xor')
+        self.assertRaises(RuntimeError, fm.interpret_grl,
+                          self.write('a.txt', '1 1 10\n'))
+
+    def test_cache(self):
+        dat = self.write('a.dat', '1 1 10\n2 3 4\n1 12 20\n')
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        grl = fm.interpret_grl(dat, cache_dir=cache_dir)
+        cached = os.listdir(cache_dir)
+        self.assertEqual(len(cached), 1)
+        self.assertTrue(cached[0].endswith('.json'))
+        # re-loaded from the (json) cache
+        with open(dat, 'w') as f:
+            f.write('1 1 10\n2 3 4\n1 12 20\n')
+        cached_grl = fm.interpret_grl(dat, cache_dir=cache_dir)
+        self.assertEqual(_ranges(cached_grl), _ranges(grl))
+        self.assertEqual(cached_grl.runs(), [1, 2])
+        self.assertTrue(cached_grl.contains(1, 15))
+        # a corrupted cache is ignored
+        with open(os.path.join(cache_dir, cached[0]), 'w') as f:
+            f.write('garbage')
+        self.assertEqual(_ranges(fm.interpret_grl(dat, cache_dir=cache_dir)),
+                         _ranges(grl))
+
+    def test_extract_data_from_xml(self):
+        xml = self.write('b.xml', _GRL_XML % (1, 5, 20, 30, 31))
+        self.assertEqual(fm.extract_data_from_xml(xml),
+                         [(1, 5, 20), (1, 30, 31)])
+
+    pass # class InterpretGrlTest
+
+class SelectionBranchesTest(unittest.TestCase):
+
+    def test_expression_branches(self):
+        eb = fm._expression_branches
+        self.assertEqual(eb('t.el_n > 1 and t.el_pt[0] > 20e3'),
+                         ['el_n', 'el_pt'])
+        self.assertEqual(eb('any(pt > 1 for pt in t.mu_pt)'), ['mu_pt'])
+        self.assertEqual(eb('t.jet_n >= 2 or t.jet_n == 0'), ['jet_n'])
+        self.assertEqual(eb('True'), [])
+        # the tree is used another way: the branches are unknown
+        self.assertEqual(eb("getattr(t, 'el_n') > 1"), None)
+        self.assertEqual(eb('my_cut(t)'), None)
+        self.assertEqual(eb('t.el_n > 1 and (lambda x: x.mu_n)(t)'), None)
+        self.assertEqual(eb('t.el_n >'), None)
+
+    def test_load_filter_fct(self):
+        fct = fm._load_filter_fct('t.el_n > 1')
+        self.assertEqual(fct.branches, ['el_n'])
+        self.assertEqual(fm._load_filter_fct("getattr(t, 'el_n')").branches,
+                         None)
+
+    def test_selection_branches(self):
+        class Fct(object):
+            def __init__(self, branches):
+                self.branches = branches
+        sb = fm._selection_branches
+        self.assertEqual(sb(None, False), [])
+        self.assertEqual(sb(None, True), ['RunNumber', 'lbn'])
+        self.assertEqual(sb(Fct(['el_n', 'lbn']), True),
+                         ['RunNumber', 'el_n', 'lbn'])
+        self.assertEqual(sb(Fct(None), True), None)
+        # a selection reading no branch is not trusted
+        self.assertEqual(sb(Fct([]), False), None)
+
+    def test_load_chunk_filter(self):
+        if fm.np is None:
+            return
+        np = fm.np
+        fct = fm._load_chunk_filter('(t.el_n > 0) & (t.RunNumber > 100)')
+        self.assertEqual(fct.branches, ['RunNumber', 'el_n'])
+        chunk = fm._Chunk(el_n=np.array([0, 1, 2]),
+                          RunNumber=np.array([200, 50, 200]))
+        self.assertEqual(list(fct(chunk)), [False, False, True])
+        # a chunk holds the declared branches only: refuse the others
+        self.assertRaises(RuntimeError, fm._load_chunk_filter,
+                          "getattr(t, 'el_n') > 0")
+
+    pass # class SelectionBranchesTest
+
+class EventSetTest(_TmpDirTest):
+
+    def test_add(self):
+        evts = fm.EventSet()
+        self.assertTrue(evts.add(1, 10))
+        self.assertTrue(evts.add(1, 11))
+        self.assertTrue(evts.add(2, 10))
+        self.assertFalse(evts.add(1, 10))
+        self.assertTrue((1, 11) in evts)
+        self.assertFalse((1, 12) in evts)
+        self.assertFalse((3, 10) in evts)
+        self.assertEqual(len(evts), 3)
+
+    def test_merged_events(self):
+        # enough events to merge the insertion buffer into the sorted array
+        evts = fm.EventSet()
+        n = 10000
+        for evt in xrange(n - 1, -1, -1):
+            self.assertTrue(evts.add(1, 2 * evt))
+        self.assertEqual(len(evts), n)
+        for evt in (0, 2, 2 * (n - 1)):
+            self.assertFalse(evts.add(1, evt))
+        self.assertFalse((1, 3) in evts)
+        self.assertTrue(evts.memory() > 0)
+
+    def test_64bit_event_numbers(self):
+        evts = fm.EventSet()
+        big = [2**32, 2**32 + 1, 2**40 + 7, 2**63 + 1, 2**64 - 1]
+        for i in xrange(5000):
+            self.assertTrue(evts.add(1, i))
+        for evt in big:
+            self.assertTrue(evts.add(1, evt))
+        for evt in big:
+            self.assertFalse(evts.add(1, evt))
+            self.assertTrue((1, evt) in evts)
+        self.assertFalse((1, 2**40 + 8) in evts)
+
+    def test_spill(self):
+        evts = fm.EventSet(max_memory=200000, spill_dir=self.tmpdir)
+        for run in xrange(10):
+            for evt in xrange(5000):
+                evts.add(run, evt)
+        self.assertTrue(evts.nspills > 0)
+        self.assertTrue(evts.memory() <= 200000)
+        self.assertTrue(os.listdir(self.tmpdir))
+        # the spilled runs are re-loaded
+        for run in xrange(10):
+            self.assertFalse(evts.add(run, 4999))
+            self.assertTrue(evts.add(run, 5000))
+        self.assertEqual(len(evts), 10 * 5001)
+        evts.clear()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertEqual(len(evts), 0)
+
+    def test_budget_warning(self):
+        import StringIO
+        evts = fm.EventSet(max_memory=1000)
+        out = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            for evt in xrange(100):
+                evts.add(1, evt)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(out.getvalue().count('***warning***'), 1)
+        self.assertEqual(len(evts), 100)
+
+    pass # class EventSetTest
+
+class PrefetcherTest(_TmpDirTest):
+
+    def _wait_idle(self, prefetcher):
+        # until the read-ahead threads stop reading
+        import time
+        nbytes = -1
+        for _ in xrange(200):
+            time.sleep(0.01)
+            if prefetcher.bytes_prefetched == nbytes:
+                break
+            nbytes = prefetcher.bytes_prefetched
+        return nbytes
+
+    def test_read_ahead_bounded(self):
+        fnames = [self.write('f%i.root' % i, 'x' * 10000) for i in xrange(4)]
+        prefetcher = fm.Prefetcher(fnames, depth=3, max_bytes=4096)
+        prefetcher.BLOCK_SIZE = 1024
+        try:
+            prefetcher.open(0)
+            self._wait_idle(prefetcher)
+            # (each thread may read one block past the bound)
+            self.assertTrue(4096 <= prefetcher.bytes_in_flight()
+                            <= 4096 + 3 * 1024)
+            self.assertEqual(prefetcher.bytes_in_flight(),
+                             prefetcher.bytes_prefetched)
+            # opening a prefetched file lets the others proceed
+            nbytes = prefetcher.bytes_prefetched
+            prefetcher.open(1)
+            self._wait_idle(prefetcher)
+            self.assertTrue(prefetcher.bytes_prefetched > nbytes)
+            self.assertTrue(prefetcher.bytes_in_flight() <= 4096 + 3 * 1024)
+            self.assertEqual(prefetcher.nprefetched, 1)
+        finally:
+            prefetcher.close()
+        self.assertEqual(prefetcher.bytes_in_flight(), 0)
+
+    def test_whole_files(self):
+        fnames = [self.write('f%i.root' % i, 'x' * 10000) for i in xrange(3)]
+        prefetcher = fm.Prefetcher(fnames, depth=2)
+        prefetcher.BLOCK_SIZE = 1024
+        try:
+            prefetcher.open(0)
+            self.assertEqual(self._wait_idle(prefetcher), 20000)
+            prefetcher.open(1)
+            prefetcher.open(2)
+            self.assertEqual(prefetcher.nprefetched, 2)
+        finally:
+            prefetcher.close()
+
+    pass # class PrefetcherTest
+
+def _reference_apply_filters(branches, patterns):
+    """the original (fnmatch-based) branch selection"""
+    from fnmatch import fnmatch
+    from collections import defaultdict
+    filtered = defaultdict(list)
+    for br in branches:
+        for p in patterns:
+            if p == '':
+                continue
+            op = '-'
+            if p.startswith('+') or not p.startswith('-'):
+                if p[0] == '+':
+                    p = p[1:]
+                op = '+'
+            if p.startswith('-'):
+                op = '-'
+                p = p[1:]
+            if fnmatch(br, p):
+                filtered[br].append(op)
+    filtered = dict(filtered)
+    return sorted([k for k,v in filtered.iteritems() if v[-1] == '+'])
+
+_BRANCHES = ['RunNumber', 'EventNumber', 'lbn', 'el_n', 'el_pt', 'el_eta',
+             'el_px', 'el_py', 'el_pz', 'mu_n', 'mu_pt', 'mu_staco_pt',
+             'jet_AntiKt4_pt', 'jet_AntiKt4_n', 'trig_EF_el_n', 'MET_RefFinal']
+
+class BranchMatcherTest(unittest.TestCase):
+
+    def check(self, patterns, expected=None):
+        ref = _reference_apply_filters(_BRANCHES, patterns)
+        self.assertEqual(fm.BranchMatcher(patterns).select(_BRANCHES), ref,
+                         patterns)
+        if expected is not None:
+            self.assertEqual(ref, sorted(expected), patterns)
+
+    def test_add_remove(self):
+        self.check(['el_n', '+mu_n'], ['el_n', 'mu_n'])
+        self.check(['+el_n', '-el_n'], [])
+        self.check(['-el_n', '+el_n'], ['el_n'])
+        self.check(['-el_n'], [])
+        self.check([''], [])
+        self.check([], [])
+
+    def test_globs(self):
+        self.check(['el_*'],
+                   ['el_n', 'el_pt', 'el_eta', 'el_px', 'el_py', 'el_pz'])
+        self.check(['*', '-el_p?'])
+        self.check(['*_pt', '-mu_*'], ['el_pt', 'jet_AntiKt4_pt'])
+        self.check(['-*', '+*Number'], ['RunNumber', 'EventNumber'])
+        self.check(['el_p[xy]', 'jet_*_[np]*'])
+        self.check(['*n', '-*_n', '+el_n'])
+
+    def test_last_wins(self):
+        self.check(['*', '-el_*', '+el_pt', '-*_pt'])
+        self.check(['el_pt', '-*', 'el_*', '-el_eta'])
+        self.check(['-*pt', '*', '-mu_*', '+mu_staco_*'])
+
+    def test_regex(self):
+        # the 're:' patterns select the same branches as the equivalent globs
+        for rx_patterns, glob_patterns in (
+            (['*', '-re:el_(px|py)'], ['*', '-el_px', '-el_py']),
+            (['re:el_p.'], ['el_p?']),
+            (['re:(el|mu)_n'], ['el_n', 'mu_n']),
+            (['re:.*_pt', '-re:mu_.*'], ['*_pt', '-mu_*']),
+            # the regex matches the whole name
+            (['re:el'], []),
+            ):
+            self.assertEqual(
+                fm.BranchMatcher(rx_patterns).select(_BRANCHES),
+                _reference_apply_filters(_BRANCHES, glob_patterns),
+                rx_patterns)
+
+    def test_random_patterns(self):
+        import random
+        import StringIO
+        rnd = random.Random(42)
+        vocabulary = ['*', 'el_*', 'mu_*', '*_pt', '*_n', 'el_p?', '*Number',
+                      'jet_*', 'el_n', 'lbn', 'mu_staco_pt', 'nothing*',
+                      'el_p[xz]', '']
+        for _ in xrange(500):
+            patterns = [rnd.choice(['', '+', '-']) + rnd.choice(vocabulary)
+                        for _ in xrange(rnd.randint(1, 6))]
+            self.check(patterns)
+            # (apply_filters warns about the unmatched patterns)
+            stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+            try:
+                selected = fm.apply_filters(_BRANCHES, patterns)
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(selected,
+                             _reference_apply_filters(_BRANCHES, patterns))
+
+    def test_unmatched(self):
+        matcher = fm.BranchMatcher(['el_*', '-nothing*', 'foo', 're:bar.*'])
+        self.assertEqual(matcher.unmatched(_BRANCHES),
+                         ['-nothing*', 'foo', 're:bar.*'])
+
+    pass # class BranchMatcherTest
+
+def _reference_optimize_baskets(tot_sz, memory):
+    """the original (linear scan) basket optimization"""
+    nleaves = len(tot_sz)
+    basket_sz = tot_sz[:]
+    baskets = [1]*nleaves
+    while nleaves and sum(basket_sz) >= memory:
+        max_spare = -1
+        max_spare_idx = None
+        for i in xrange(nleaves):
+            spare = tot_sz[i]/baskets[i] - tot_sz[i]/(baskets[i]+1)
+            if max_spare < spare:
+                max_spare = spare
+                max_spare_idx = i
+        baskets[max_spare_idx] += 1
+        basket_sz[max_spare_idx] = tot_sz[max_spare_idx]/baskets[max_spare_idx]
+    return basket_sz, baskets
+
+class OptimizeBasketsTest(unittest.TestCase):
+
+    def test_same_as_linear_scan(self):
+        import random
+        rnd = random.Random(1234)
+        for nleaves in (1, 2, 10, 50):
+            tot_sz = [rnd.randint(0, 1000000) for _ in xrange(nleaves)]
+            for memory in (sum(tot_sz) // 200, sum(tot_sz) // 3,
+                           sum(tot_sz) + 1):
+                self.assertEqual(fm.optimize_baskets(tot_sz, memory),
+                                 _reference_optimize_baskets(tot_sz, memory),
+                                 (nleaves, memory))
+
+    def test_fits_in_memory(self):
+        tot_sz = [1000000, 10, 500000, 0, 250000]
+        basket_sz, baskets = fm.optimize_baskets(tot_sz, 100000)
+        self.assertTrue(sum(basket_sz) < 100000)
+        self.assertEqual(basket_sz, [t // n for t, n in zip(tot_sz, baskets)])
+        # nothing to split
+        self.assertEqual(fm.optimize_baskets(tot_sz, sum(tot_sz) + 1),
+                         (tot_sz, [1]*len(tot_sz)))
+        self.assertEqual(fm.optimize_baskets([], 1024), ([], []))
+        # (the sum of the basket sizes would never fit)
+        self.assertRaises(ValueError, fm.optimize_baskets, tot_sz, 0)
+        self.assertRaises(ValueError, fm.optimize_baskets, tot_sz, -1024)
+
+    def test_cluster_baskets(self):
+        tot_sz = [4000000, 1000000, 0]
+        nentries = 10000
+        memory = 100000
+        basket_sz, baskets, cluster_sz = fm.cluster_baskets(tot_sz, nentries,
+                                                            memory)
+        # clusters of entries whose baskets fit in memory
+        self.assertTrue(1 <= cluster_sz <= nentries)
+        self.assertTrue(sum(basket_sz) <= memory)
+        nclusters = (nentries + cluster_sz - 1) // cluster_sz
+        self.assertEqual(baskets, [nclusters] * len(tot_sz))
+        self.assertTrue(cluster_sz * sum(tot_sz) / float(nentries) <= memory)
+        # no entries
+        self.assertEqual(fm.cluster_baskets(tot_sz, 0, memory)[1:],
+                         ([1, 1, 1], 1))
+
+    pass # class OptimizeBasketsTest
+
+def _summary(n_tot, phases, files):
+    return dict(time=10., n_tot=n_tot, n_pass=n_tot // 2,
+                evts_per_sec=n_tot / 10., bytes_read=1024 * 1024,
+                read_calls=10, bytes_written=2 * 1024 * 1024,
+                mb_per_sec_read=0.1, mb_per_sec_written=0.2,
+                phases=phases, files=files)
+
+class ThroughputSummariesTest(unittest.TestCase):
+
+    def test_merge(self):
+        a = _summary(100, dict(read=1., select=2., fill=3., flush=0.),
+                     [dict(name='a.root')])
+        b = _summary(300, dict(read=4., select=1., fill=1., flush=1.),
+                     [dict(name='b.root'), dict(name='c.root')])
+        summary = fm.merge_throughput_summaries([a, b], 4.)
+        self.assertEqual(summary['jobs'], 2)
+        self.assertEqual(summary['time'], 4.)
+        self.assertEqual((summary['n_tot'], summary['n_pass']), (400, 200))
+        self.assertEqual(summary['evts_per_sec'], 100.)
+        self.assertEqual(summary['read_calls'], 20)
+        self.assertEqual(summary['mb_per_sec_read'], 0.5)
+        self.assertEqual(summary['mb_per_sec_written'], 1.)
+        self.assertEqual(summary['phases'],
+                         dict(read=5., select=3., fill=4., flush=1.))
+        self.assertEqual([r['name'] for r in summary['files']],
+                         ['a.root', 'b.root', 'c.root'])
+
+    pass # class ThroughputSummariesTest
+
+class ManifestTest(_TmpDirTest):
+
+    def test_round_trip(self):
+        fname = os.path.join(self.tmpdir, 'out.manifest.json')
+        manifest = dict(tree='t', other_trees=['meta/t2'], done=['a.root'],
+                        current='b.root', first_entry=42, output='out_1.root',
+                        file_number=1, entries=0, tree_entries=0, n_pass=10,
+                        n_tot=50, complete=False)
+        fm.save_manifest(fname, manifest)
+        loaded = fm.load_manifest(fname)
+        self.assertEqual(loaded, manifest)
+        for k in ('tree', 'current', 'output'):
+            self.assertTrue(type(loaded[k]) is str, k)
+        self.assertEqual(os.listdir(self.tmpdir), ['out.manifest.json'])
+
+    def test_checkpoint_after_input_file(self):
+        # (and the manifests written before the splits were checkpointed)
+        fname = os.path.join(self.tmpdir, 'out.manifest.json')
+        fm.save_manifest(fname, dict(tree='t', other_trees=[], done=['a.root'],
+                                     output='out.root', file_number=0,
+                                     entries=5, n_pass=5, n_tot=9,
+                                     complete=False))
+        loaded = fm.load_manifest(fname)
+        self.assertEqual((loaded['current'], loaded['first_entry']), (None, 0))
+        # no entry count to check the output file against: no resume
+        self.assertEqual(loaded.get('tree_entries'), None)
+
+    pass # class ManifestTest
+
+class PartialFnamesTest(_TmpDirTest):
+
+    def test_split_outputs(self):
+        for n in ('out.root', 'out_1.root', 'out_2.root', 'out_10.root',
+                  'out_mu.root', 'out_mu_1.root', 'out.manifest.json'):
+            self.write(n, '')
+        self.assertEqual(
+            [os.path.basename(f) for f in
+             fm._partial_fnames(os.path.join(self.tmpdir, 'out.root'))],
+            ['out.root', 'out_1.root', 'out_2.root', 'out_10.root'])
+        self.assertEqual(
+            [os.path.basename(f) for f in
+             fm._partial_fnames(os.path.join(self.tmpdir, 'out_mu.root'))],
+            ['out_mu.root', 'out_mu_1.root'])
+
+    pass # class PartialFnamesTest
+
+class _FakeOutputFile(object):
+    """a TFile whose size grows by the zipped size of the entries filled"""
+    def __init__(self):
+        self.size = 300 # (the header)
+        self.nflushes = 0
+    def Flush(self):
+        self.nflushes += 1
+    def GetSize(self):
+        return self.size
+
+class _FakeOutputTree(object):
+    def __init__(self):
+        self.tot_bytes = 0
+        self.nentries = 0
+    def GetTotBytes(self):
+        return self.tot_bytes
+    def GetEntries(self):
+        return self.nentries
+
+class SizePredictorTest(unittest.TestCase):
+
+    def _fill(self, entry_sizes, threshold, zip_ratio=0.5):
+        """fill entries of `entry_sizes` (uncompressed) bytes, changing the
+        output file when told to.
+        returns the sizes of the output files and the number of checkpoints.
+        """
+        predictor = fm._SizePredictor(threshold)
+        fout, tree = _FakeOutputFile(), _FakeOutputTree()
+        fsizes = []
+        for sz in entry_sizes:
+            if predictor.need_change(fout, [tree]):
+                fsizes.append(fout.size)
+                fout, tree = _FakeOutputFile(), _FakeOutputTree()
+                predictor.reset()
+            fout.size += zip_ratio * sz
+            tree.tot_bytes += sz
+            tree.nentries += 1
+            predictor.fill()
+        fsizes.append(fout.size)
+        return fsizes, predictor.nchecks
+
+    def test_steady(self):
+        fsizes, nchecks = self._fill([1000] * 9000, 1e6)
+        self.assertEqual(len(fsizes), 5)
+        for fsz in fsizes:
+            self.assertTrue(fsz <= 1e6)
+        for fsz in fsizes[:-1]:
+            self.assertTrue(fsz > 0.99e6)
+        # the checkpoints are few: not one per entry
+        self.assertTrue(nchecks < 200)
+
+    def test_sudden_growth(self):
+        # the entries become 3 times bigger, at any point of a file
+        for n in xrange(1, 2000, 7):
+            fsizes, _ = self._fill([1000] * n + [3000] * 2000, 1e6)
+            self.assertTrue(max(fsizes) <= 1e6, (n, max(fsizes)))
+
+    def test_first_entries(self):
+        # entries of 60% of the threshold once zipped: one per file
+        fsizes, _ = self._fill([1200000] * 10, 1e6)
+        self.assertEqual(len(fsizes), 10)
+        for fsz in fsizes:
+            self.assertTrue(fsz <= 1e6)
+        # (the first checkpoint is right after the first entry)
+        fsizes, _ = self._fill([300000] * 30, 1e6)
+        self.assertTrue(len(fsizes) > 1)
+        for fsz in fsizes:
+            self.assertTrue(fsz <= 1e6)
+
+    def test_reset(self):
+        predictor = fm._SizePredictor(1e6)
+        fout, tree = _FakeOutputFile(), _FakeOutputTree()
+        self.assertFalse(predictor.need_change(fout, [tree]))
+        self.assertEqual(fout.nflushes, 0)
+        for i in xrange(100):
+            tree.tot_bytes += 1000
+            tree.nentries += 1
+            fout.size += 500
+            predictor.fill()
+            predictor.need_change(fout, [tree])
+        self.assertTrue(predictor.next_check > 100)
+        predictor.reset()
+        self.assertEqual(predictor.nentries, 0)
+        # a new file is checked after its first entry
+        fout = _FakeOutputFile()
+        self.assertFalse(predictor.need_change(fout, [tree]))
+        predictor.fill()
+        fout.size += 500
+        nflushes = fout.nflushes
+        self.assertFalse(predictor.need_change(fout, [tree]))
+        self.assertEqual(fout.nflushes, nflushes + 1)
+
+    pass # class SizePredictorTest
+
+class _FakeClass(object):
+    def __init__(self, *bases):
+        self.bases = bases
+    def InheritsFrom(self, base):
+        return base in self.bases
+
+class _FakeROOT(object):
+    """the ROOT classes used by _tree_paths"""
+    classes = {'TDirectoryFile': _FakeClass('TDirectory'),
+               'TTree': _FakeClass('TTree'),
+               'TNtuple': _FakeClass('TTree'),
+               'TH1F': _FakeClass('TH1')}
+    class TClass(object):
+        @staticmethod
+        def GetClass(name):
+            return _FakeROOT.classes.get(name)
+    class TDirectory(object):
+        @staticmethod
+        def Class():
+            return 'TDirectory'
+    class TTree(object):
+        @staticmethod
+        def Class():
+            return 'TTree'
+    class TObject(object):
+        kOverwrite = 2
+
+class _FakeKey(object):
+    def __init__(self, name, class_name):
+        self.name = name
+        self.class_name = class_name
+    def GetName(self):
+        return self.name
+    def GetClassName(self):
+        return self.class_name
+
+class _FakeDir(object):
+    """a directory of (name, class name, object) keys"""
+    def __init__(self, name='', keys=()):
+        self.name = name
+        self.keys = list(keys)
+    def GetName(self):
+        return self.name
+    def GetListOfKeys(self):
+        return [_FakeKey(name, cls) for name, cls, _ in self.keys]
+    def Get(self, path):
+        obj = self
+        for name in path.split('/'):
+            # (the highest cycle: the first key)
+            obj = ([o for n, _, o in obj.keys if n == name] or [None])[0]
+        return obj
+    def GetDirectory(self, name):
+        obj = self.Get(name)
+        return obj if isinstance(obj, _FakeDir) else None
+    def mkdir(self, name):
+        d = _FakeDir(name)
+        self.keys.append((name, 'TDirectoryFile', d))
+        return d
+
+class _FakePayloadTree(object):
+    def __init__(self, name, nentries, bad_entries=()):
+        self.name = name
+        self.nentries = nentries
+        self.bad_entries = bad_entries
+        self.read_entries = []
+        self.directory = None
+        self.writes = 0
+    def GetName(self):
+        return self.name
+    def GetEntries(self):
+        return self.nentries
+    def GetEntry(self, i):
+        self.read_entries.append(i)
+        return 0 if i in self.bad_entries else 10
+    def SetCacheSize(self, sz):
+        pass
+    def CopyAddresses(self, tree):
+        self.addresses = tree
+    def Write(self, name, opt):
+        self.writes += 1
+    def Reset(self):
+        pass
+    def SetDirectory(self, d):
+        self.directory = d
+    def ChangeFile(self, fout):
+        return _FakeDir('out_1.root')
+
+class NestedTreesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._ROOT = fm.ROOT
+        fm.ROOT = _FakeROOT
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        fm.ROOT = self._ROOT
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+    def _input_file(self, nentries=10):
+        sub = _FakeDir('sub', [
+            ('t2', 'TTree', _FakePayloadTree('t2', nentries)),
+            ('h', 'TH1F', None)])
+        top = _FakeDir('top', [
+            ('sub', 'TDirectoryFile', sub),
+            ('t1', 'TNtuple', _FakePayloadTree('t1', nentries))])
+        return _FakeDir('in.root', [
+            ('physics', 'TTree', _FakePayloadTree('physics', nentries)),
+            ('meta', 'TTree', _FakePayloadTree('meta', 1)),
+            # (the other cycle of the same tree)
+            ('meta', 'TTree', None),
+            ('top', 'TDirectoryFile', top),
+            ('unknown', 'MyClass', None)])
+
+    def test_tree_paths(self):
+        f = self._input_file()
+        self.assertEqual(fm._tree_paths(f),
+                         ['physics', 'meta', 'top/sub/t2', 'top/t1'])
+        self.assertEqual(fm._tree_paths(_FakeDir()), [])
+        self.assertEqual(
+            fm._payload_tree_names(f, f.Get('physics'), 'physics'),
+            ['top/sub/t2', 'top/t1'])
+
+    def test_output_dir(self):
+        fout = _FakeDir('out.root')
+        self.assertTrue(fm._output_dir(fout, 'physics') is fout)
+        d = fm._output_dir(fout, 'top/sub/t2')
+        self.assertEqual(d.GetName(), 'sub')
+        self.assertTrue(fout.Get('top/sub') is d)
+        # the existing directories are reused
+        self.assertTrue(fm._output_dir(fout, 'top/sub/t3') is d)
+        self.assertEqual(fm._output_dir(fout, 'top/t1').GetName(), 'top')
+        self.assertEqual([n for n, _, _ in fout.Get('top').keys], ['sub'])
+
+    def test_change_file(self):
+        tree = _FakePayloadTree('physics', 0)
+        nested = [('top/sub/t2', _FakePayloadTree('t2', 0)),
+                  ('top/t1', _FakePayloadTree('t1', 0))]
+        fout = fm._change_file(tree, _FakeDir('out.root'), nested)
+        self.assertEqual(fout.GetName(), 'out_1.root')
+        for path, t in nested:
+            self.assertEqual(t.writes, 1)
+            self.assertTrue(t.directory is fout.Get(path.rsplit('/', 1)[0]))
+
+    def test_payload_trees(self):
+        names = ['top/sub/t2', 'top/t1', 'meta2']
+        out_trees = [_FakePayloadTree(n, 0) for n in names]
+        payload = fm.PayloadTrees(names, out_trees, cache_size=0)
+        self.assertEqual(payload.nested(), list(zip(names, out_trees))[:2])
+        f = self._input_file()
+        f.keys.append(('meta2', 'TTree', _FakePayloadTree('meta2', 10,
+                                                          bad_entries=(3,))))
+        payload.bind(f, 10)
+        for name, out_tree in zip(names, out_trees):
+            self.assertTrue(out_tree.addresses is f.Get(name))
+        # only the selected entries of the main tree are read, in lock-step
+        for i in (0, 3, 7):
+            read = payload.read(i)
+            if i == 3:
+                self.assertEqual(read, out_trees[:2])
+            else:
+                self.assertEqual(read, out_trees)
+        for name in names:
+            self.assertEqual(f.Get(name).read_entries, [0, 3, 7])
+        payload.release()
+        self.assertEqual(payload.trees, [])
+
+    def test_payload_trees_mismatch(self):
+        f = self._input_file()
+        payload = fm.PayloadTrees(['top/t1'], [_FakePayloadTree('t1', 0)],
+                                  cache_size=0)
+        self.assertRaises(RuntimeError, payload.bind, f, 11)
+        payload = fm.PayloadTrees(['top/t3'], [_FakePayloadTree('t3', 0)],
+                                  cache_size=0)
+        self.assertRaises(RuntimeError, payload.bind, f, 10)
+
+    pass # class NestedTreesTest
+
+class FanOutConfigTest(_TmpDirTest):
+
+    def test_load(self):
+        fname = self.write('fan.cfg', """
+[electrons]
+out = electrons
+var = el_vars.txt
+selection = t.el_n > 0
+[muons]
+out = muons.root
+""")
+        streams = fm.load_fan_out_config(fname)
+        self.assertEqual([(s.name, s.sfo, s.vars_fname) for s in streams],
+                         [('electrons', 'electrons.root', 'el_vars.txt'),
+                          ('muons', 'muons.root', None)])
+        self.assertEqual(streams[0].selection_branches(), ['el_n'])
+        self.assertEqual(streams[1].filter_fct, None)
+
+    def test_invalid(self):
+        for content in ("out = a.root\n",                     # no section
+                        "",                                     # no output
+                        "[a]\nout = a.root\nsel = t.x > 0\n",  # unknown
+                        "[a]\nvar = a.txt\n",                   # no out
+                        "[a]\nout =\n",
+                        "[a]\nout = a.root\nselection = t.x >\n",
+                        "[a]\nout = a.root\n[b]\nout = a\n",   # same out
+                        "[a]\nout = a.root\nselection = file:nope.py\n"):
+            fname = self.write('fan.cfg', content)
+            self.assertRaises(ValueError, fm.load_fan_out_config, fname)
+        self.assertRaises(OSError, fm.load_fan_out_config,
+                          os.path.join(self.tmpdir, 'nope.cfg'))
+
+    pass # class FanOutConfigTest
+
+### tests ---------------------------------------------------------------------
+def main():
+    loader = unittest.TestLoader()
+    testSuite = loader.loadTestsFromModule( sys.modules[ __name__ ] )
+
+    runner = unittest.TextTestRunner( verbosity = 2 )
+    if not runner.run( testSuite ).wasSuccessful():
+        return 1
+    print "OK"
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
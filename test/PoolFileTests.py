@@ -0,0 +1,494 @@
+# @file PyUtils/test/PoolFileTests.py
+# @purpose unit tests of the pure-python parts of PyUtils.PoolFile
+# @date October 2026
+from __future__ import with_statement
+
+import unittest, sys
+import StringIO
+
+import PyUtils.PoolFile as PF
+
+def _record(name, memSize=1., diskSize=1., nEntries=10):
+    return PF.PoolRecord(name, memSize, diskSize, memSize, nEntries,
+                         dirType='B')
+
+class _FakePoolFile(object):
+    """the subset of PoolFile used by BreakDown and DiffFiles"""
+    def __init__(self, records, nEntries=10, name='fake.pool'):
+        self.dataHeader = _record('DataHeader', nEntries=nEntries)
+        self.data = list(records)
+        self._fileInfos = {'name': name}
+    index = PF.PoolFile.index.im_func
+
+class BreakDownTest(unittest.TestCase):
+
+    def tearDown(self):
+        PF.PoolOpts.FAST_MODE = False
+
+    def test_first_match_wins(self):
+        bd = PF.BreakDown([
+            ('Trigger', [r'Trig.*']),
+            ('Muons',   [('*Muon*', None)]),
+            ])
+        self.assertEqual(bd.category('TrigMuonEFInfoContainer_tlp1').name,
+                         'Trigger')
+        self.assertEqual(bd.category('MuonContainer_p4_StacoMuons').name,
+                         'Muons')
+        self.assertEqual(bd.category('CaloClusterContainer_p5').name,
+                         'others')
+
+    def test_class_and_key_items(self):
+        bd = PF.BreakDown([
+            ('Staco', [('Analysis::MuonContainer', 'StacoMuonCollection')]),
+            ('Muons', [('Analysis::MuonContainer', None)]),
+            ])
+        self.assertEqual(
+            bd.category('Analysis::MuonContainer_p4_StacoMuonCollection').name,
+            'Staco')
+        self.assertEqual(
+            bd.category('Analysis::MuonContainer_p4_MuidMuonCollection').name,
+            'Muons')
+
+    def test_many_categories(self):
+        # more categories than the groups allowed in a single pattern
+        n = 3 * PF.BreakDown._MAX_GROUPS + 7
+        bd = PF.BreakDown([ ('c%i' % i, [('Cont%i' % i, None)])
+                            for i in xrange(n) ])
+        for i in (0, PF.BreakDown._MAX_GROUPS, n-1):
+            self.assertEqual(bd.category('Cont%i_p1' % i).name, 'c%i' % i)
+
+    def test_fill_sums_sizes(self):
+        bd = PF.BreakDown([('Jets', [r'.*Jet.*'])])
+        pf = _FakePoolFile([_record('JetCollection_p5_A', 2., 1.),
+                            _record('JetCollection_p5_B', 3., 2.),
+                            _record('Other', 5., 4.)])
+        bd.fill(pf)
+        bd.fill(pf)
+        jets = bd.counters[0]
+        self.assertEqual(bd.nFiles, 2)
+        self.assertEqual(bd.nEvents, 20)
+        self.assertEqual(jets.memSize, 10.)
+        self.assertEqual(jets.diskSize, 6.)
+        self.assertEqual(len(jets.items), 4)
+        # the data header goes to 'others' too
+        self.assertEqual(bd.others.diskSize, 10.)
+
+    def test_fast_mode_sizes_not_summed(self):
+        PF.PoolOpts.FAST_MODE = True
+        bd = PF.BreakDown([('Jets', [r'.*Jet.*'])])
+        bd.fill(_FakePoolFile([_record('JetCollection_p5', -1., 3.)]))
+        jets = bd.counters[0]
+        self.assertFalse(jets.memSizeKnown)
+        self.assertEqual(jets.memSize, 0.)
+        self.assertEqual(jets.diskSize, 3.)
+        out = StringIO.StringIO()
+        bd.printSummary(out)
+        rows = [l for l in out.getvalue().splitlines()
+                if l.endswith('Jets') or l.endswith('TOTAL')]
+        self.assertEqual(len(rows), 2)
+        for l in rows:
+            self.assertEqual(l.split()[0], 'N/A')
+
+    def test_default_categories(self):
+        out = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            bd = PF.PoolFile.printBreakDown.im_func(
+                _FakePoolFile([_record('TrigDecision_p5')]))
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(
+            [c.name for c in bd.counters],
+            [name for name, _ in PF.PoolOpts.BREAKDOWN_CATEGORIES])
+        self.assertEqual(bd.category('TrigDecision_p5').name, 'Trigger')
+        self.assertEqual(bd.category('DataHeader').name, 'DataHeader')
+
+    pass # class BreakDownTest
+
+class IndexTest(unittest.TestCase):
+
+    def test_index_follows_data(self):
+        pf = _FakePoolFile([_record('A'), _record('B')])
+        self.assertEqual(sorted(pf.index().keys()), ['A', 'B'])
+        self.assertTrue(pf.index() is pf.index())
+        # a record replaced (same number of records)
+        pf.data[1] = _record('C')
+        self.assertEqual(sorted(pf.index().keys()), ['A', 'C'])
+        pf.data.append(_record('D'))
+        self.assertTrue(pf.index()['D'] is pf.data[-1])
+        pf.data = [_record('E'), _record('F'), _record('G')]
+        self.assertEqual(sorted(pf.index().keys()), ['E', 'F', 'G'])
+
+    pass # class IndexTest
+
+class DiffFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._PoolFile = PF.PoolFile
+        self.files = {
+            'ref.pool' : [_record('A', 1., 1.), _record('B', 2., 2.),
+                          _record('C', 3., 3.)],
+            # B bigger, C missing, D extra
+            'chk0.pool': [_record('A', 1., 1.), _record('B', 2.5, 1.5),
+                          _record('D', 4., 4.)],
+            'chk1.pool': [_record('A', 1., 1.), _record('B', 2., 2.),
+                          _record('C', 3., 2.)],
+            }
+        def _open(name):
+            return _FakePoolFile(self.files[name], name=name)
+        PF.PoolFile = _open
+
+    def tearDown(self):
+        PF.PoolFile = self._PoolFile
+
+    def _diff(self, chk, **kw):
+        out = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            return PF.DiffFiles('ref.pool', chk, **kw)
+        finally:
+            sys.stdout = stdout
+
+    def test_matrices(self):
+        diff = self._diff(['chk0.pool', 'chk1.pool'])
+        self.assertEqual(diff.memSizes, {'A': [1., 1., 1.],
+                                         'B': [2., 2.5, 2.],
+                                         'C': [3., None, 3.],
+                                         'D': [None, 4., None]})
+        self.assertEqual(diff.diskSizes['B'], [2., 1.5, 2.])
+        self.assertEqual(diff.diskSizes['C'], [3., None, 2.])
+        self.assertEqual(diff.status(), 1)
+        self.assertEqual(diff.summary[-1], '## Comparison : [ERR]')
+        self.assertTrue('  + D' in diff.summary)
+        self.assertTrue('  - C' in diff.summary)
+
+    def test_matrix_summary(self):
+        diff = self._diff(['chk0.pool', 'chk1.pool'])
+        start = [i for i, l in enumerate(diff.summary)
+                 if l.startswith('::: mem-size deltas')]
+        self.assertEqual(len(start), 1)
+        rows = dict((l.split()[-1], l.split()[:-1])
+                    for l in diff.summary[start[0]+6:-2])
+        # (the containers of the same size in all the files are skipped)
+        self.assertEqual(rows, {'B': ['2.000', '+0.500', '='],
+                                'C': ['3.000', '-', '='],
+                                'D': ['-', '4.000', '-']})
+
+    def test_same_files(self):
+        diff = self._diff('chk1.pool')
+        # only the disk size of C differs
+        self.assertEqual(diff.status(), 0)
+        self.assertEqual(diff.chkFiles, [diff.chkFile])
+        self.assertFalse([l for l in diff.summary
+                          if l.startswith('::: mem-size deltas')])
+
+    def test_ignored(self):
+        self.files['chk1.pool'][1] = _record('B', 9., 9.)
+        diff = self._diff('chk1.pool', ignoreList=['B'])
+        self.assertEqual(diff.status(), 0)
+
+    def test_json_report(self):
+        import json, os, tempfile
+        diff = self._diff(['chk0.pool', 'chk1.pool'])
+        fd, fname = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            diff.saveReport(fname)
+            report = json.load(open(fname))
+        finally:
+            os.remove(fname)
+        self.assertEqual(report['ref'], 'ref.pool')
+        self.assertEqual(report['chk'], ['chk0.pool', 'chk1.pool'])
+        self.assertEqual(report['nentries'], [10, 10, 10])
+        self.assertEqual(report['status'], 1)
+        containers = report['containers']
+        self.assertEqual(sorted(containers.keys()), ['A', 'B', 'C', 'D'])
+        self.assertEqual(containers['B']['memSize'], [2., 2.5, 2.])
+        self.assertEqual(containers['B']['memSizeDelta'], [0.5, 0.])
+        self.assertEqual(containers['B']['diskSizeDelta'], [-0.5, 0.])
+        self.assertEqual(containers['C']['memSizeDelta'], [None, 0.])
+        self.assertEqual(containers['C']['diskSizeDelta'], [None, -1.])
+        self.assertEqual(containers['D']['memSizeDelta'], [None, None])
+
+    pass # class DiffFilesTest
+
+class _FakeBasket(object):
+    """a basket of the entries of `sizes` bytes, after a `keylen` key"""
+    def __init__(self, sizes, keylen=100):
+        self.keylen = keylen
+        self.offsets = [keylen + sum(sizes[:i]) for i in xrange(len(sizes))]
+        self.last = keylen + sum(sizes)
+    def GetNevBuf(self):
+        return len(self.offsets)
+    def GetLast(self):
+        return self.last
+    def GetKeylen(self):
+        return self.keylen
+    def GetEntryOffset(self):
+        return self.offsets
+
+class _FakeBranch(object):
+    """a branch of the `baskets` (entries, zipped bytes) pairs; the entries
+    being the number of entries of a fixed-size branch (of `entrySize`
+    bytes), the entry sizes of a variable-size one
+    """
+    def __init__(self, baskets, entrySize=None, nentries=None,
+                 unwritten=0, branches=()):
+        self.baskets = baskets
+        self.entrySize = entrySize
+        self.basketEntry = [0]
+        for entries, _ in baskets:
+            n = entries if entrySize is not None else len(entries)
+            self.basketEntry.append(self.basketEntry[-1] + n)
+        self.nentries = nentries
+        if nentries is None:
+            self.nentries = self.basketEntry[-1] + unwritten
+        self.branches = list(branches)
+        self.dropped = False
+    def GetWriteBasket(self):
+        return len(self.baskets)
+    def GetBasketEntry(self):
+        return self.basketEntry
+    def GetBasketBytes(self):
+        return [zipped for _, zipped in self.baskets]
+    def GetEntryOffsetLen(self):
+        return 0 if self.entrySize is not None else 4
+    def GetEntries(self):
+        return self.nentries
+    def GetTotBytes(self):
+        return (self.entrySize or 0) * self.nentries
+    def GetZipBytes(self, opt=''):
+        return sum(zipped for _, zipped in self.baskets)
+    def GetBasket(self, i):
+        entries = self.baskets[i][0]
+        if self.entrySize is not None:
+            entries = [self.entrySize] * entries
+        return _FakeBasket(entries)
+    def DropBaskets(self, opt):
+        self.dropped = True
+    def GetListOfBranches(self):
+        return self.branches
+
+class EntrySizesTest(unittest.TestCase):
+
+    def _sizes(self, branch, nentries):
+        memSizes, diskSizes = [0.] * nentries, [0.] * nentries
+        PF._fill_entry_sizes(branch, memSizes, diskSizes)
+        kb = PF.Units.kb
+        return ([sz * kb for sz in memSizes], [sz * kb for sz in diskSizes])
+
+    def test_fixed_size(self):
+        br = _FakeBranch([(2, 4.), (3, 12.)], entrySize=8)
+        mem, disk = self._sizes(br, 5)
+        self.assertEqual(mem, [8.] * 5)
+        self.assertEqual(disk, [2., 2., 4., 4., 4.])
+        self.assertFalse(br.dropped)
+
+    def test_variable_size(self):
+        sub = _FakeBranch([([10, 30], 20.), ([20], 10.)])
+        br = _FakeBranch([([4, 4, 4], 6.)], entrySize=None, branches=[sub])
+        mem, disk = self._sizes(br, 3)
+        self.assertEqual(mem, [14., 34., 24.])
+        self.assertEqual(disk, [2. + 5., 2. + 15., 2. + 10.])
+        self.assertTrue(br.dropped and sub.dropped)
+
+    def test_no_entries(self):
+        # written baskets, but no entry (nor size) to share them among
+        br = _FakeBranch([(2, 4.)], entrySize=8, nentries=0)
+        self.assertEqual(self._sizes(br, 2), ([0.] * 2, [0.] * 2))
+        sub = _FakeBranch([(2, 4.)], entrySize=8)
+        br = _FakeBranch([(2, 4.)], entrySize=0, branches=[sub])
+        self.assertEqual(self._sizes(br, 2), ([8.] * 2, [2.] * 2))
+
+    pass # class EntrySizesTest
+
+class EventSizeProfileTest(unittest.TestCase):
+
+    def _profile(self, sizes):
+        return PF.EventSizeProfile('c', [2 * sz for sz in sizes], sizes, 'B')
+
+    def test_percentiles(self):
+        p = self._profile([5., 1., 4., 2., 3., 10., 9., 8., 7., 6.])
+        self.assertEqual(p.nEntries, 10)
+        self.assertEqual(p.mean(), 5.5)
+        self.assertEqual(p.mean('mem'), 11.)
+        # nearest rank: the ceil(q*n/100)-th smallest size
+        self.assertEqual(p.percentile(0), 1.)
+        self.assertEqual(p.percentile(10), 1.)
+        self.assertEqual(p.percentile(11), 2.)
+        self.assertEqual(p.percentile(50), 5.)
+        self.assertEqual(p.percentile(95), 10.)
+        self.assertEqual(p.percentile(100), 10.)
+        self.assertEqual(p.percentile(50, 'mem'), 10.)
+        p = self._profile([3., 1., 2.])
+        self.assertEqual(p.percentile(50), 2.)
+        self.assertEqual(p.percentile(34), 2.)
+        self.assertEqual(p.percentile(33), 1.)
+        self.assertRaises(ValueError, p.percentile, 50, 'zip')
+
+    def test_histogram(self):
+        p = self._profile([0., 1., 1.5, 2., 4.])
+        edges, counts = p.histogram(nbins=4)
+        self.assertEqual(edges, [0., 1., 2., 3., 4.])
+        # (the max goes to the last bin)
+        self.assertEqual(counts, [1, 2, 1, 1])
+        edges, counts = self._profile([3., 3.]).histogram(nbins=2)
+        self.assertEqual(edges, [3., 4., 5.])
+        self.assertEqual(counts, [2, 0])
+
+    def test_largest(self):
+        p = self._profile([5., 1., 9., 2., 9.])
+        self.assertEqual(p.largest(3), [(2, 9.), (4, 9.), (0, 5.)])
+        self.assertEqual(p.largest(10, 'mem')[-1], (1, 2.))
+
+    def test_empty(self):
+        p = self._profile([])
+        self.assertEqual(p.mean(), 0.)
+        self.assertEqual(p.percentile(50), 0.)
+        self.assertEqual(p.histogram(nbins=2), ([0.] * 3, [0, 0]))
+        self.assertEqual(p.largest(), [])
+
+    pass # class EventSizeProfileTest
+
+class CodecTest(unittest.TestCase):
+
+    def test_get_codec(self):
+        import zlib, bz2
+        data = 'abcd' * 1000
+        for spec, zipped in (('zlib', zlib.compress(data, 6)),
+                             ('zlib:1', zlib.compress(data, 1)),
+                             ('zlib:0', zlib.compress(data, 0)),
+                             ('bz2', bz2.compress(data, 9)),
+                             ('bz2:1', bz2.compress(data, 1))):
+            compress, decompress = PF._get_codec(spec)
+            self.assertEqual(compress(data), zipped, spec)
+            self.assertEqual(decompress(zipped), data)
+        try:
+            compress, decompress = PF._get_codec('lzma:6')
+            self.assertEqual(decompress(compress(data)), data)
+        except ImportError:
+            pass # (no lzma module)
+
+    def test_invalid_codec(self):
+        for spec in ('gzip', 'gzip:6', 'zlib:10', 'zlib:-1', 'zlib:x',
+                     'bz2:0', 'lzma:10', ''):
+            self.assertRaises(ValueError, PF._get_codec, spec)
+
+    def test_compression_record(self):
+        rec = PF.CompressionRecord('c', 'B', 100., ('zlib:1', 'bz2:9'))
+        self.assertEqual(rec.zipSizes, {'zlib:1': 0, 'bz2:9': 0})
+        # no sample: the current size
+        self.assertEqual(rec.projectedDiskSize('zlib:1'), 100.)
+        self.assertEqual(rec.unzipThroughput('zlib:1'), 0.)
+        rec.sampleSize = 4 * PF.Units.Mb
+        rec.sampleZipSize = 2000
+        rec.zipSizes['zlib:1'] = 3000
+        rec.zipSizes['bz2:9'] = 1000
+        rec.unzipTimes['zlib:1'] = 0.5
+        self.assertEqual(rec.projectedDiskSize('zlib:1'), 150.)
+        self.assertEqual(rec.projectedDiskSize('bz2:9'), 50.)
+        self.assertEqual(rec.unzipThroughput('zlib:1'), 8.)
+        self.assertEqual(rec.unzipThroughput('bz2:9'), 0.)
+        self.assertRaises(KeyError, rec.projectedDiskSize, 'lzma:6')
+
+    pass # class CodecTest
+
+class _FakeWhatIfFile(object):
+    """the subset of PoolFile used by compressionWhatIf"""
+    def __init__(self, containers):
+        self.poolFile = object()
+        self.keys = []
+        self.containers = containers
+    def _eventContainers(self):
+        for name, branches in self.containers:
+            yield name, 'B', branches, None
+
+class CompressionWhatIfTest(unittest.TestCase):
+
+    def setUp(self):
+        import PyUtils.RootUtils as ru
+        self.ru = ru
+        self._basket_payload = ru.basket_payload
+        self.read = []
+        def _basket_payload(branch, ibasket):
+            self.read.append((branch.name, ibasket))
+            if branch.name == 'bad' and ibasket == 0:
+                return None
+            return ('%s:%i ' % (branch.name, ibasket)) * 200
+        ru.basket_payload = _basket_payload
+
+    def tearDown(self):
+        self.ru.basket_payload = self._basket_payload
+
+    def _branch(self, name, nbaskets, zipped=150, branches=()):
+        br = _FakeBranch([(10, zipped)] * nbaskets, entrySize=100,
+                         branches=branches)
+        br.name = name
+        return br
+
+    def test_what_if(self):
+        import zlib
+        sub = self._branch('sub', 2)
+        jets = self._branch('jets', 7, branches=[sub])
+        bad = self._branch('bad', 1)
+        empty = self._branch('empty', 0)
+        pf = _FakeWhatIfFile([('Jets', [jets]), ('Bad', [bad, empty]),
+                              ('Skipped', [self._branch('skipped', 1)])])
+        out = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            records = PF.PoolFile.compressionWhatIf.im_func(
+                pf, codecs=('zlib:1', 'zlib:9'), nbaskets=3, nprocs=1,
+                names=['Jets', 'Bad'])
+        finally:
+            sys.stdout = stdout
+        self.assertEqual([r.name for r in records], ['Jets', 'Bad'])
+        # 3 baskets sampled out of 7, evenly spread
+        self.assertEqual(sorted(self.read),
+                         [('bad', 0), ('jets', 0), ('jets', 2), ('jets', 4),
+                          ('sub', 0), ('sub', 1)])
+        self.assertTrue(jets.dropped and sub.dropped)
+        jets_rec, bad_rec = records
+        payloads = [('%s:%i ' % k) * 200 for k in
+                    (('jets', 0), ('jets', 2), ('jets', 4), ('sub', 0),
+                     ('sub', 1))]
+        self.assertEqual(jets_rec.diskSize, 7 * 150 / PF.Units.kb)
+        self.assertEqual(jets_rec.sampleSize, sum(len(p) for p in payloads))
+        # (the key of a fake basket is 100 bytes)
+        self.assertEqual(jets_rec.sampleZipSize, 5 * (150 - 100))
+        for level in (1, 9):
+            c = 'zlib:%i' % level
+            self.assertEqual(jets_rec.zipSizes[c],
+                             sum(len(zlib.compress(p, level))
+                                 for p in payloads))
+            self.assertTrue(jets_rec.unzipTimes[c] >= 0.)
+        # an unreadable basket is not sampled
+        self.assertEqual((bad_rec.sampleSize, bad_rec.sampleZipSize), (0, 0))
+        self.assertEqual(bad_rec.projectedDiskSize('zlib:1'),
+                         bad_rec.diskSize)
+
+    def test_shelve_file(self):
+        pf = _FakeWhatIfFile([])
+        pf.keys = None
+        out = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            self.assertEqual(PF.PoolFile.compressionWhatIf.im_func(pf), [])
+        finally:
+            sys.stdout = stdout
+
+    pass # class CompressionWhatIfTest
+
+### tests ---------------------------------------------------------------------
+def main():
+    loader = unittest.TestLoader()
+    testSuite = loader.loadTestsFromModule( sys.modules[ __name__ ] )
+
+    runner = unittest.TextTestRunner( verbosity = 2 )
+    if not runner.run( testSuite ).wasSuccessful():
+        return 1
+    print "OK"
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
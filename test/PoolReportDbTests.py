@@ -0,0 +1,131 @@
+# @file PyUtils/test/PoolReportDbTests.py
+# @purpose unit tests of PyUtils.PoolReportDb
+# @date October 2026
+from __future__ import with_statement
+
+import unittest, sys
+
+import PyUtils.PoolReportDb as PRD
+
+class _Record(object):
+    def __init__(self, name, memSize, diskSize, nEntries):
+        self.name = name
+        self.dirType = 'B'
+        self.memSize = memSize
+        self.diskSize = diskSize
+        self.memSizeNoZip = 0.
+        self.nEntries = nEntries
+
+class _FakePoolFile(object):
+    """the subset of PoolFile used by PoolReportDb.insert"""
+    def __init__(self, name, nEntries, sizes):
+        self._fileInfos = { 'name': name, 'size': 1000 }
+        self.dataHeader = _Record('DataHeader', 1., 1., nEntries)
+        self.data = [ _Record(n, 2. * sz, sz, nEntries)
+                      for n, sz in sorted(sizes.items()) ]
+
+class PoolReportDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = PRD.PoolReportDb(':memory:')
+        self.date = 0.
+        # deterministic, increasing, report dates
+        def _time():
+            self.date += 1.
+            return self.date
+        self._time, PRD.time.time = PRD.time.time, _time
+
+    def tearDown(self):
+        PRD.time.time = self._time
+        self.db.close()
+
+    def test_aggregates(self):
+        self.db.insert(_FakePoolFile('a.pool', 10, {'Jets': 10.}),
+                       release='rel_1', stream='AOD')
+        self.db.insert(_FakePoolFile('b.pool', 30, {'Jets': 50.}),
+                       release='rel_1', stream='AOD')
+        self.assertEqual(self.db.trend('Jets', stream='AOD'),
+                         [('rel_1', 2, 40, 120. / 40, 60. / 40)])
+
+    def test_duplicate_refused(self):
+        pf = _FakePoolFile('a.pool', 10, {'Jets': 10.})
+        self.db.insert(pf, release='rel_1', stream='AOD')
+        self.assertRaises(ValueError, self.db.insert, pf,
+                          release='rel_1', stream='AOD')
+        # the same file in another release or stream is fine
+        self.db.insert(pf, release='rel_2', stream='AOD')
+        self.db.insert(pf, release='rel_1', stream='ESD')
+        self.assertEqual(self.db.trend('Jets', stream='AOD'),
+                         [('rel_1', 1, 10, 2., 1.),
+                          ('rel_2', 1, 10, 2., 1.)])
+
+    def test_replace(self):
+        self.db.insert(_FakePoolFile('a.pool', 10, {'Jets': 10.}),
+                       release='rel_1', stream='AOD')
+        self.db.insert(_FakePoolFile('a.pool', 10, {'Jets': 20.}),
+                       release='rel_2', stream='AOD')
+        self.db.insert(_FakePoolFile('a.pool', 10, {'Jets': 30.}),
+                       release='rel_1', stream='AOD', replace=True)
+        # replaced, not double-counted, and rel_1 keeps its position
+        self.assertEqual(self.db.trend('Jets', stream='AOD'),
+                         [('rel_1', 1, 10, 6., 3.),
+                          ('rel_2', 1, 10, 4., 2.)])
+
+    def test_releases_ordered_by_date(self):
+        for rel in ('rel_5', 'rel_6', 'rel_0', 'rel_1'):
+            self.db.insert(_FakePoolFile('a.pool', 10, {'Jets': 10.}),
+                           release=rel, stream='AOD')
+        self.assertEqual(self.db.releases(),
+                         ['rel_5', 'rel_6', 'rel_0', 'rel_1'])
+        self.assertEqual(self.db.releases(last=2), ['rel_0', 'rel_1'])
+
+    def test_regressions(self):
+        for rel, sz in (('rel_1', 10.), ('rel_2', 10.2), ('rel_3', 12.)):
+            self.db.insert(_FakePoolFile('a.pool', 10, {'Jets': sz}),
+                           release=rel, stream='AOD')
+        flags = self.db.regressions(names=['Jets'], stream='AOD',
+                                    threshold=0.05)
+        self.assertEqual(len(flags), 1)
+        self.assertEqual(flags[0][:3], ('Jets', 'rel_2', 'rel_3'))
+
+    def test_unknown_mem_sizes(self):
+        # (fast mode: -1 per branch instead of the memory sizes)
+        fast = _FakePoolFile('b.pool', 30, {'Jets': 50.})
+        for r in [fast.dataHeader] + fast.data:
+            r.memSize = r.memSizeNoZip = -1. / 1024
+        self.db.insert(fast, release='rel_1', stream='AOD')
+        self.assertEqual(
+            self.db.conn.execute("SELECT mem_size, mem_size_nozip, disk_size"
+                                 " FROM containers WHERE name = 'Jets'"
+                                 ).fetchall(),
+            [(None, None, 50.)])
+        self.assertEqual(self.db.trend('Jets', stream='AOD'),
+                         [('rel_1', 1, 30, None, 50. / 30)])
+        # a sum including an unknown size is unknown
+        self.db.insert(_FakePoolFile('a.pool', 10, {'Jets': 10.}),
+                       release='rel_1', stream='AOD')
+        self.db.insert(_FakePoolFile('a.pool', 10, {'Jets': 10.}),
+                       release='rel_1', stream='ESD')
+        self.assertEqual(self.db.trend('Jets', stream='AOD'),
+                         [('rel_1', 2, 40, None, 60. / 40)])
+        self.assertEqual(self.db.trend('Jets', stream='ESD'),
+                         [('rel_1', 1, 10, 2., 1.)])
+        self.assertEqual(self.db.trend('Jets'),
+                         [('rel_1', 3, 50, None, 70. / 50)])
+        self.assertEqual(self.db.regressions(names=['Jets'], stream='AOD'), [])
+
+    pass # class PoolReportDbTest
+
+### tests ---------------------------------------------------------------------
+def main():
+    loader = unittest.TestLoader()
+    testSuite = loader.loadTestsFromModule( sys.modules[ __name__ ] )
+
+    runner = unittest.TextTestRunner( verbosity = 2 )
+    if not runner.run( testSuite ).wasSuccessful():
+        return 1
+    print "OK"
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())